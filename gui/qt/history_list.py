@@ -60,8 +60,9 @@ class HistoryList(MyTreeWidget):
         self.update_headers(headers)
 
     def get_domain(self):
-        '''Replaced in address_dialog.py'''
-        return self.wallet.get_addresses()
+        '''Replaced in address_dialog.py.  None selects the whole
+        wallet, which uses the wallet's cached history.'''
+        return None
 
     def on_update(self):
         self.wallet = self.parent.wallet
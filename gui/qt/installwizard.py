@@ -7,6 +7,7 @@ import PyQt4.QtCore as QtCore
 
 import electrum
 from electrum.wallet import Wallet
+from electrum.storage import delete_wallet
 from electrum.mnemonic import prepare_seed
 from electrum.util import UserCancelled
 from electrum.base_wizard import BaseWizard
@@ -167,7 +168,7 @@ class InstallWizard(QDialog, MessageBoxMixin, BaseWizard):
             file_list = '\n'.join(self.storage.split_accounts())
             msg = _('Your accounts have been moved to:\n %s.\n\nDo you want to delete the old file:\n%s' % (file_list, path))
             if self.question(msg):
-                os.remove(path)
+                delete_wallet(path)
                 self.show_warning(_('The file was removed'))
             return
 
@@ -189,7 +190,7 @@ class InstallWizard(QDialog, MessageBoxMixin, BaseWizard):
                     "Do you want to complete its creation now?") % path
             if not self.question(msg):
                 if self.question(_("Do you want to delete '%s'?") % path):
-                    os.remove(path)
+                    delete_wallet(path)
                     self.show_warning(_('The file was removed'))
                 return
             self.show()
@@ -245,15 +245,13 @@ def base_encode(v, base):
         chars = __b58chars
     elif base == 43:
         chars = __b43chars
-    long_value = 0L
-    for (i, c) in enumerate(v[::-1]):
-        long_value += (256**i) * ord(c)
-    result = ''
+    long_value = int(v.encode('hex'), 16) if v else 0
+    result = []
     while long_value >= base:
-        div, mod = divmod(long_value, base)
-        result = chars[mod] + result
-        long_value = div
-    result = chars[long_value] + result
+        long_value, mod = divmod(long_value, base)
+        result.append(chars[mod])
+    result.append(chars[long_value])
+    result = ''.join(reversed(result))
     # Bitcoin does a little leading-zero-compression:
     # leading 0-bytes in the input become leading-1s
     nPad = 0
@@ -270,14 +268,12 @@ def base_decode(v, length, base):
     elif base == 43:
         chars = __b43chars
     long_value = 0L
-    for (i, c) in enumerate(v[::-1]):
-        long_value += chars.find(c) * (base**i)
-    result = ''
-    while long_value >= 256:
-        div, mod = divmod(long_value, 256)
-        result = chr(mod) + result
-        long_value = div
-    result = chr(long_value) + result
+    for c in v:
+        long_value = long_value * base + chars.find(c)
+    if long_value < 0:
+        raise ValueError('invalid base%d string' % base)
+    result = '%x' % long_value
+    result = ('0' * (len(result) % 2) + result).decode('hex')
     nPad = 0
     for c in v:
         if c == chars[0]: nPad += 1
@@ -349,8 +345,7 @@ def public_key_from_private_key(sec):
     pkey = regenerate_key(sec)
     assert pkey
     compressed = is_compressed(sec)
-    public_key = GetPubKey(pkey.pubkey, compressed)
-    return public_key.encode('hex')
+    return pkey.get_public_key(compressed)
 
 
 def address_from_private_key(sec):
@@ -403,6 +398,7 @@ from ecdsa.ecdsa import curve_secp256k1, generator_secp256k1
 from ecdsa.curves import SECP256k1
 from ecdsa.ellipticcurve import Point
 from ecdsa.util import string_to_number, number_to_string
+from ecc_backend import backend as ecc
 
 def msg_magic(message):
     varint = var_int(len(message))
@@ -509,20 +505,31 @@ class MySigningKey(ecdsa.SigningKey):
 class EC_KEY(object):
 
     def __init__( self, k ):
-        secret = string_to_number(k)
-        self.pubkey = ecdsa.ecdsa.Public_key( generator_secp256k1, generator_secp256k1 * secret )
-        self.privkey = ecdsa.ecdsa.Private_key( self.pubkey, secret )
-        self.secret = secret
+        self.secret = string_to_number(k)
+        self.public_key = None
+
+    def get_public_key_bytes(self, compressed=True):
+        if self.public_key is None:
+            self.public_key = ecc.pubkey_from_secret(self.secret, False)
+        if compressed:
+            return chr(2 + (ord(self.public_key[-1]) & 1)) + self.public_key[1:33]
+        return self.public_key
 
     def get_public_key(self, compressed=True):
-        return point_to_ser(self.pubkey.point, compressed).encode('hex')
+        return self.get_public_key_bytes(compressed).encode('hex')
+
+    @property
+    def pubkey(self):
+        return ecdsa.ecdsa.Public_key(generator_secp256k1, ser_to_point(self.get_public_key_bytes(False)))
+
+    @property
+    def privkey(self):
+        return ecdsa.ecdsa.Private_key(self.pubkey, self.secret)
 
     def sign(self, msg_hash):
-        private_key = MySigningKey.from_secret_exponent(self.secret, curve = SECP256k1)
-        public_key = private_key.get_verifying_key()
-        signature = private_key.sign_digest_deterministic(msg_hash, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_string)
-        assert public_key.verify_digest(signature, msg_hash, sigdecode = ecdsa.util.sigdecode_string)
-        return signature
+        r, s = ecc.sign(self.secret, msg_hash)
+        assert ecc.verify(self.get_public_key_bytes(False), msg_hash, r, s)
+        return ecdsa.util.sigencode_string(r, s, generator_secp256k1.order())
 
     def sign_message(self, message, compressed, address):
         signature = self.sign(Hash(msg_magic(message)))
@@ -551,10 +558,11 @@ class EC_KEY(object):
         recid = nV - 27
 
         h = Hash(msg_magic(message))
-        public_key = MyVerifyingKey.from_signature(sig[1:], recid, h, curve = SECP256k1)
+        r, s = ecdsa.util.sigdecode_string(sig[1:], generator_secp256k1.order())
+        pubkey = ecc.recover(h, r, s, recid, compressed)
         # check public key
-        public_key.verify_digest(sig[1:], h, sigdecode = ecdsa.util.sigdecode_string)
-        pubkey = point_to_ser(public_key.pubkey.point, compressed)
+        if not ecc.verify(pubkey, h, r, s):
+            raise Exception("Bad signature")
         # check that we get the original signing address
         addr = public_key_to_bc_address(pubkey)
         if address != addr:
@@ -623,10 +631,9 @@ BIP32_PRIME = 0x80000000
 
 def get_pubkeys_from_secret(secret):
     # public key
-    private_key = ecdsa.SigningKey.from_string( secret, curve = SECP256k1 )
-    public_key = private_key.get_verifying_key()
-    K = public_key.to_string()
-    K_compressed = GetPubKey(public_key.pubkey,True)
+    key = EC_KEY(secret)
+    K = key.get_public_key_bytes(False)[1:]
+    K_compressed = key.get_public_key_bytes(True)
     return K, K_compressed
 
 
@@ -644,8 +651,7 @@ def CKD_priv(k, c, n):
 
 def _CKD_priv(k, c, s, is_prime):
     order = generator_secp256k1.order()
-    keypair = EC_KEY(k)
-    cK = GetPubKey(keypair.pubkey,True)
+    cK = EC_KEY(k).get_public_key_bytes(True)
     data = chr(0) + k + s if is_prime else cK + s
     I = hmac.new(c, data, hashlib.sha512).digest()
     k_n = number_to_string( (string_to_number(I[0:32]) + string_to_number(k)) % order , order )
@@ -664,15 +670,23 @@ def CKD_pub(cK, c, n):
 
 # helper function, callable with arbitrary string
 def _CKD_pub(cK, c, s):
-    order = generator_secp256k1.order()
     I = hmac.new(c, cK + s, hashlib.sha512).digest()
-    curve = SECP256k1
-    pubkey_point = string_to_number(I[0:32])*curve.generator + ser_to_point(cK)
-    public_key = ecdsa.VerifyingKey.from_public_point( pubkey_point, curve = SECP256k1 )
+    cK_n = ecc.pubkey_tweak_add(cK, string_to_number(I[0:32]) % generator_secp256k1.order(), True)
     c_n = I[32:]
-    cK_n = GetPubKey(public_key.pubkey,True)
     return cK_n, c_n
 
+# CKD_pub for several indexes of the same parent key, which is only
+# parsed once. Returns a list of (cK_n, c_n)
+def CKD_pub_many(cK, c, indexes):
+    order = generator_secp256k1.order()
+    tweaks, chain_codes = [], []
+    for n in indexes:
+        if n & BIP32_PRIME: raise
+        I = hmac.new(c, cK + rev_hex(int_to_hex(n,4)).decode('hex'), hashlib.sha512).digest()
+        tweaks.append(string_to_number(I[0:32]) % order)
+        chain_codes.append(I[32:])
+    return zip(ecc.pubkey_tweak_add_many(cK, tweaks, True), chain_codes)
+
 
 BITCOIN_HEADER_PRIV = "0488ade4"
 BITCOIN_HEADER_PUB = "0488b21e"
@@ -26,11 +26,45 @@
 
 
 import os
+import json
+import mmap
+import struct
+import threading
 import util
 from bitcoin import *
 
 MAX_TARGET = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
 
+# Block hashes of the main chain, taken from Bitcoin Core.  Chunks that
+# contain one of these heights must match it.  When the 'checkpoints'
+# option is set, proof of work and difficulty are not checked for
+# chunks that end below the last checkpoint; linking their hashes to a
+# checkpoint is enough.
+CHECKPOINTS = {
+    11111: '0000000069e244f73d78e8fd29ba2fd2ed618bd6fa2ee92559f542fdb26e7c1d',
+    33333: '000000002dd5588a74784eaa7ab0507a18ad16a236e7b1ce69f00d7ddfb5d0a6',
+    74000: '0000000000573993a3c9e41ce34471c079dcf5f52a0e824a81e7f953b8661a20',
+    105000: '00000000000291ce28027faea320c8d2b054b2e0fe44a773f3eefb151d6bdc97',
+    134444: '00000000000005b12ffd4cd315cd34ffd4a594f430ac814c91184a0d42d2b0fe',
+    168000: '000000000000099e61ea72015e79632f216fe6cb33d7899acb35b75c8303b763',
+    193000: '000000000000059f452a5f7340de6682a977387c17010ff6e6c3bd83ca8b1317',
+    210000: '000000000000048b95347e83192f69cf0366076336c639f9b7228e9ba171342e',
+    216116: '00000000000001b4f4b433e81ee46494af945cf96014816a4e2370f11b23df4e',
+    225430: '00000000000001c108384350f74090433e7fcf79a606b8e797f065b130575932',
+    250000: '000000000000003887df1f29024b06fc2200b55f8af8f35453d7be294df2d214',
+    279000: '0000000000000001ae8c72a0b0c301f67e3afca10e819efa9041e458e9bd7e40',
+    295000: '00000000000000004d9b4ef50f0f9d686fd69db2e03af35a100370c64632a983',
+}
+
+
+def bits_to_target(bits):
+    bitsN = (bits >> 24) & 0xff
+    assert bitsN >= 0x03 and bitsN <= 0x1d, "First part of bits should be in [0x03, 0x1d]"
+    bitsBase = bits & 0xffffff
+    assert bitsBase >= 0x8000 and bitsBase <= 0x7fffff, "Second part of bits should be in [0x8000, 0x7fffff]"
+    return bitsBase << (8 * (bitsN-3))
+
+
 class Blockchain(util.PrintError):
     '''Manages blockchain headers and their verification'''
     def __init__(self, config, network):
@@ -38,7 +72,20 @@ class Blockchain(util.PrintError):
         self.network = network
         self.headers_url = "https://headers.electrum.org/blockchain_headers"
         self.local_height = 0
+        # the headers file is kept open and mapped in memory
+        self.lock = threading.Lock()
+        self.headers_file = None
+        self.headers_map = None
+        # binary header hashes, 32 bytes per height.  Null bytes mean
+        # the hash has not been computed yet
+        self.hashes = bytearray()
+        # decoded headers, keyed by height
+        self.header_cache = util.LRUCache(2016)
+        # bits of each retarget period, keyed by chunk index
+        self.targets = {}
+        self.use_checkpoints = bool(config.get('checkpoints', False))
         self.set_local_height()
+        self.load_targets()
 
     def height(self):
         return self.local_height
@@ -48,33 +95,57 @@ class Blockchain(util.PrintError):
         self.set_local_height()
         self.print_error("%d blocks" % self.local_height)
 
-    def verify_header(self, header, prev_header, bits, target):
-        prev_hash = self.hash_header(prev_header)
+    def verify_header(self, header, prev_hash, bits, target):
+        '''Checks header against the hash of its predecessor.  Returns
+        the hash of header.'''
         assert prev_hash == header.get('prev_block_hash'), "prev hash mismatch: %s vs %s" % (prev_hash, header.get('prev_block_hash'))
         assert bits == header.get('bits'), "bits mismatch: %s vs %s" % (bits, header.get('bits'))
         _hash = self.hash_header(header)
         assert int('0x' + _hash, 16) <= target, "insufficient proof of work: %s vs target %s" % (int('0x' + _hash, 16), target)
+        return _hash
 
     def verify_chain(self, chain):
         first_header = chain[0]
-        prev_header = self.read_header(first_header.get('block_height') - 1)
+        prev_hash = self.get_hash(first_header.get('block_height') - 1)
         for header in chain:
             height = header.get('block_height')
             bits, target = self.get_target(height / 2016, chain)
-            self.verify_header(header, prev_header, bits, target)
-            prev_header = header
+            prev_hash = self.verify_header(header, prev_hash, bits, target)
+
+    def verify_raw_header(self, raw_header, prev_hash, bits, target):
+        '''Binary version of verify_header.  prev_hash is the binary
+        hash of the previous header, target a 32 bytes big-endian
+        string.  Returns the binary hash of raw_header.'''
+        assert raw_header[4:36] == prev_hash, "prev hash mismatch: %s vs %s" % (hash_encode(prev_hash), hash_encode(raw_header[4:36]))
+        _bits = struct.unpack_from('<I', raw_header, 72)[0]
+        assert bits == _bits, "bits mismatch: %s vs %s" % (bits, _bits)
+        _hash = Hash(raw_header)
+        # compare as big-endian byte strings
+        assert _hash[::-1] <= target, "insufficient proof of work: %s vs target %s" % (hash_encode(_hash), target.encode('hex'))
+        return _hash
 
     def verify_chunk(self, index, data):
         num = len(data) / 80
-        prev_header = None
-        if index != 0:
-            prev_header = self.read_header(index*2016 - 1)
+        prev_hash = self.get_raw_hash(index*2016 - 1)
+        assert prev_hash is not None, "missing header %d" % (index*2016 - 1)
+        checkpoints = dict((height - index*2016, h) for height, h in CHECKPOINTS.items()
+                           if index*2016 <= height < index*2016 + num)
+        if self.use_checkpoints and (index + 1)*2016 <= max(CHECKPOINTS):
+            # only check that the headers are linked
+            for i in range(num):
+                raw_header = data[i*80:(i+1) * 80]
+                assert raw_header[4:36] == prev_hash, "prev hash mismatch at %d" % (index*2016 + i)
+                prev_hash = Hash(raw_header)
+                if i in checkpoints:
+                    assert hash_encode(prev_hash) == checkpoints[i], "checkpoint mismatch at %d" % (index*2016 + i)
+            return
         bits, target = self.get_target(index)
+        target = ('%064x' % target).decode('hex')
         for i in range(num):
             raw_header = data[i*80:(i+1) * 80]
-            header = self.deserialize_header(raw_header)
-            self.verify_header(header, prev_header, bits, target)
-            prev_header = header
+            prev_hash = self.verify_raw_header(raw_header, prev_hash, bits, target)
+            if i in checkpoints:
+                assert hash_encode(prev_hash) == checkpoints[i], "checkpoint mismatch at %d" % (index*2016 + i)
 
     def serialize_header(self, res):
         s = int_to_hex(res.get('version'), 4) \
@@ -118,48 +189,127 @@ class Blockchain(util.PrintError):
             self.print_error("download failed. creating file", filename)
             open(filename, 'wb+').close()
 
-    def save_chunk(self, index, chunk):
+    def open_headers_file(self):
         filename = self.path()
-        f = open(filename, 'rb+')
-        f.seek(index * 2016 * 80)
-        h = f.write(chunk)
-        f.close()
-        self.set_local_height()
+        if not os.path.exists(filename):
+            return
+        self.headers_file = open(filename, 'rb+')
+        self.map_headers_file()
+
+    def map_headers_file(self):
+        f = self.headers_file
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        # an empty file cannot be mapped
+        self.headers_map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) if size else None
+        self.local_height = size / 80 - 1
+
+    def targets_path(self):
+        return self.path() + '_targets'
+
+    def load_targets(self):
+        try:
+            with open(self.targets_path(), 'r') as f:
+                d = json.loads(f.read())
+            self.targets = dict((int(k), v) for k, v in d.items())
+        except:
+            self.targets = {}
+
+    def save_targets(self):
+        s = json.dumps(self.targets)
+        with open(self.targets_path(), 'w') as f:
+            f.write(s)
+
+    def write_headers(self, height, data):
+        # difficulty of the following periods depends on these headers
+        stale = [index for index in self.targets.keys() if index > height / 2016]
+        if stale:
+            for index in stale:
+                self.targets.pop(index)
+            self.save_targets()
+        with self.lock:
+            if self.headers_file is None:
+                self.open_headers_file()
+            if self.headers_map:
+                self.headers_map.close()
+            f = self.headers_file
+            f.seek(height * 80)
+            f.write(data)
+            f.flush()
+            self.map_headers_file()
+            # hashes of overwritten headers are stale
+            del self.hashes[height * 32:]
+
+    def save_chunk(self, index, chunk):
+        self.write_headers(index * 2016, chunk)
+        self.header_cache.clear()
+        if len(chunk) == 2016 * 80 and not (self.use_checkpoints and (index + 1)*2016 <= max(CHECKPOINTS)):
+            # precompute the difficulty of the next period
+            self.get_target(index + 1)
+        self.save_targets()
 
     def save_header(self, header):
         data = self.serialize_header(header).decode('hex')
         assert len(data) == 80
         height = header.get('block_height')
-        filename = self.path()
-        f = open(filename, 'rb+')
-        f.seek(height * 80)
-        h = f.write(data)
-        f.close()
-        self.set_local_height()
+        self.write_headers(height, data)
+        self.header_cache.pop(height)
 
     def set_local_height(self):
-        name = self.path()
-        if os.path.exists(name):
-            h = os.path.getsize(name)/80 - 1
-            if self.local_height != h:
-                self.local_height = h
+        with self.lock:
+            if self.headers_file is None:
+                self.open_headers_file()
+
+    def read_raw_header(self, block_height):
+        if block_height < 0 or block_height > self.local_height:
+            return None
+        with self.lock:
+            if self.headers_map is None:
+                return None
+            return self.headers_map[block_height * 80:(block_height + 1) * 80]
 
     def read_header(self, block_height):
-        name = self.path()
-        if os.path.exists(name):
-            f = open(name, 'rb')
-            f.seek(block_height * 80)
-            h = f.read(80)
-            f.close()
-            if len(h) == 80:
-                h = self.deserialize_header(h)
-                return h
+        h = self.header_cache.get(block_height)
+        if h is not None:
+            return h
+        raw = self.read_raw_header(block_height)
+        if raw is not None:
+            h = self.deserialize_header(raw)
+            self.header_cache[block_height] = h
+            return h
+
+    def get_hash(self, block_height):
+        '''Hash of the stored header at block_height, '00..00' below the
+        genesis block and None if the header is missing.'''
+        h = self.get_raw_hash(block_height)
+        if h is not None:
+            return hash_encode(h)
+
+    def get_raw_hash(self, block_height):
+        if block_height < 0:
+            return '\x00' * 32
+        i = block_height * 32
+        h = bytes(self.hashes[i:i + 32])
+        if len(h) < 32 or h == '\x00' * 32:
+            raw = self.read_raw_header(block_height)
+            if raw is None:
+                return None
+            h = Hash(raw)
+            with self.lock:
+                if len(self.hashes) < i:
+                    self.hashes.extend('\x00' * (i - len(self.hashes)))
+                self.hashes[i:i + 32] = h
+        return h
 
     def get_target(self, index, chain=None):
         if index == 0:
             return 0x1d00ffff, MAX_TARGET
+        bits = self.targets.get(index)
+        if bits is not None:
+            return bits, bits_to_target(bits)
         first = self.read_header((index-1) * 2016)
         last = self.read_header(index*2016 - 1)
+        from_disk = last is not None
         if last is None:
             for h in chain:
                 if h.get('block_height') == index*2016 - 1:
@@ -167,11 +317,7 @@ class Blockchain(util.PrintError):
         assert last is not None
         # bits to target
         bits = last.get('bits')
-        bitsN = (bits >> 24) & 0xff
-        assert bitsN >= 0x03 and bitsN <= 0x1d, "First part of bits should be in [0x03, 0x1d]"
-        bitsBase = bits & 0xffffff
-        assert bitsBase >= 0x8000 and bitsBase <= 0x7fffff, "Second part of bits should be in [0x8000, 0x7fffff]"
-        target = bitsBase << (8 * (bitsN-3))
+        target = bits_to_target(bits)
         # new target
         nActualTimespan = last.get('timestamp') - first.get('timestamp')
         nTargetTimespan = 14 * 24 * 60 * 60
@@ -187,6 +333,8 @@ class Blockchain(util.PrintError):
             bitsN += 1
             bitsBase >>= 8
         new_bits = bitsN << 24 | bitsBase
+        if from_disk:
+            self.targets[index] = new_bits
         return new_bits, bitsBase << (8 * (bitsN-3))
 
     def connect_header(self, chain, header):
@@ -202,7 +350,7 @@ class Blockchain(util.PrintError):
             return previous_height
 
         # Does it connect to my chain?
-        prev_hash = self.hash_header(previous_header)
+        prev_hash = self.get_hash(previous_height)
         if prev_hash != header.get('prev_block_hash'):
             self.print_error("reorg")
             return previous_height
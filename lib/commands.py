@@ -127,6 +127,13 @@ class Commands:
         wallet."""
         raise BaseException('Not a JSON-RPC command')
 
+    @command('w')
+    def convert_to_sqlite(self):
+        """Convert the wallet file to a SQLite database. This is faster
+        for wallets with many transactions. The JSON wallet file is kept
+        with a '.json' extension."""
+        raise BaseException('Not a JSON-RPC command')
+
     @command('wp')
     def password(self):
         """Change wallet password. """
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2016 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''secp256k1 operations used for keys and signatures.
+
+libsecp256k1 is used through ctypes when it can be loaded; otherwise
+the pure Python ecdsa package is used.  Both backends have the same
+interface: secrets and signature values are integers, public keys are
+serialized points, digests are 32 byte strings.  Signatures are
+deterministic (RFC 6979) with low S values, so both backends produce
+the same signatures, except for digests larger than the group order.
+'''
+
+import ctypes
+import ctypes.util
+import hashlib
+import os
+
+import ecdsa
+from ecdsa import rfc6979
+from ecdsa.curves import SECP256k1
+from ecdsa.ellipticcurve import Point, INFINITY
+from ecdsa.numbertheory import inverse_mod
+from ecdsa.util import string_to_number, number_to_string
+
+from util import print_error
+
+G = SECP256k1.generator
+ORDER = G.order()
+CURVE = SECP256k1.curve
+P = CURVE.p()
+
+
+def point_to_ser(point, compressed=True):
+    if point == INFINITY:
+        raise ValueError('point at infinity')
+    if compressed:
+        return chr(2 + (point.y() & 1)) + number_to_string(point.x(), P)
+    return '\x04' + number_to_string(point.x(), P) + number_to_string(point.y(), P)
+
+
+def ser_to_point(ser):
+    '''Parses a serialized public key, and checks that it is on the
+    curve.'''
+    if len(ser) == 33 and ser[0] in '\x02\x03':
+        x = string_to_number(ser[1:])
+        alpha = (pow(x, 3, P) + CURVE.a() * x + CURVE.b()) % P
+        y = pow(alpha, (P + 1) // 4, P)
+        if (y & 1) != (ser[0] == '\x03'):
+            y = P - y
+    elif len(ser) == 65 and ser[0] == '\x04':
+        x = string_to_number(ser[1:33])
+        y = string_to_number(ser[33:])
+    else:
+        raise ValueError('invalid public key')
+    if x >= P or y >= P or not CURVE.contains_point(x, y):
+        raise ValueError('invalid public key')
+    return Point(CURVE, x, y, ORDER)
+
+
+class EcdsaBackend(object):
+    '''Pure Python implementation, with the ecdsa package'''
+
+    name = 'ecdsa'
+
+    def pubkey_from_secret(self, secret, compressed=True):
+        if not 0 < secret < ORDER:
+            raise ValueError('invalid secret')
+        return point_to_ser(secret * G, compressed)
+
+    def pubkey_tweak_add(self, pubkey, tweak, compressed=True):
+        '''Returns pubkey + tweak * G'''
+        if not 0 <= tweak < ORDER:
+            raise ValueError('invalid tweak')
+        return point_to_ser(ser_to_point(pubkey) + tweak * G, compressed)
+
+    def pubkey_tweak_add_many(self, pubkey, tweaks, compressed=True):
+        point = ser_to_point(pubkey)
+        result = []
+        for tweak in tweaks:
+            if not 0 <= tweak < ORDER:
+                raise ValueError('invalid tweak')
+            result.append(point_to_ser(point + tweak * G, compressed))
+        return result
+
+    def sign(self, secret, digest):
+        k = rfc6979.generate_k(ORDER, secret, hashlib.sha256, digest)
+        r = (k * G).x() % ORDER
+        s = inverse_mod(k, ORDER) * (string_to_number(digest) + secret * r) % ORDER
+        if r == 0 or s == 0:
+            raise ValueError('invalid nonce')
+        if s > ORDER / 2:
+            s = ORDER - s
+        return r, s
+
+    def verify(self, pubkey, digest, r, s):
+        if not (0 < r < ORDER and 0 < s < ORDER):
+            return False
+        point = ser_to_point(pubkey)
+        c = inverse_mod(s, ORDER)
+        u1 = string_to_number(digest) * c % ORDER
+        u2 = r * c % ORDER
+        xy = u1 * G + u2 * point
+        return xy != INFINITY and xy.x() % ORDER == r
+
+    def recover(self, digest, r, s, recid, compressed=True):
+        '''Public key from a signature, see SEC 1 v2, 4.1.6'''
+        if not (0 < r < ORDER and 0 < s < ORDER and 0 <= recid < 4):
+            raise ValueError('invalid signature')
+        x = r + (recid / 2) * ORDER
+        if x >= P:
+            raise ValueError('invalid signature')
+        R = ser_to_point(chr(2 + (recid & 1)) + number_to_string(x, P))
+        e = string_to_number(digest)
+        Q = inverse_mod(r, ORDER) * (s * R + (-e % ORDER) * G)
+        return point_to_ser(Q, compressed)
+
+
+SECP256K1_FLAGS_TYPE_CONTEXT = 1 << 0
+SECP256K1_FLAGS_TYPE_COMPRESSION = 1 << 1
+SECP256K1_FLAGS_BIT_CONTEXT_VERIFY = 1 << 8
+SECP256K1_FLAGS_BIT_CONTEXT_SIGN = 1 << 9
+SECP256K1_FLAGS_BIT_COMPRESSION = 1 << 8
+SECP256K1_CONTEXT_VERIFY = SECP256K1_FLAGS_TYPE_CONTEXT | SECP256K1_FLAGS_BIT_CONTEXT_VERIFY
+SECP256K1_CONTEXT_SIGN = SECP256K1_FLAGS_TYPE_CONTEXT | SECP256K1_FLAGS_BIT_CONTEXT_SIGN
+SECP256K1_EC_COMPRESSED = SECP256K1_FLAGS_TYPE_COMPRESSION | SECP256K1_FLAGS_BIT_COMPRESSION
+SECP256K1_EC_UNCOMPRESSED = SECP256K1_FLAGS_TYPE_COMPRESSION
+
+# library names, in the order they are tried
+LIBSECP256K1_NAMES = ['libsecp256k1.so.0', 'libsecp256k1.so', 'libsecp256k1.0.dylib',
+                      'libsecp256k1.dylib', 'libsecp256k1.dll']
+
+
+def load_libsecp256k1():
+    here = os.path.dirname(os.path.abspath(__file__))
+    names = [os.path.join(here, name) for name in LIBSECP256K1_NAMES] + LIBSECP256K1_NAMES
+    found = ctypes.util.find_library('secp256k1')
+    if found:
+        names.append(found)
+    for name in names:
+        try:
+            return ctypes.cdll.LoadLibrary(name)
+        except OSError:
+            continue
+
+
+class LibsecpBackend(object):
+    '''libsecp256k1, through ctypes'''
+
+    name = 'libsecp256k1'
+
+    def __init__(self, lib):
+        p, c, i, s = ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int, ctypes.POINTER(ctypes.c_size_t)
+        for name, args in [
+                ('secp256k1_context_create', [ctypes.c_uint]),
+                ('secp256k1_context_randomize', [p, c]),
+                ('secp256k1_ec_pubkey_create', [p, c, c]),
+                ('secp256k1_ec_pubkey_parse', [p, c, c, ctypes.c_size_t]),
+                ('secp256k1_ec_pubkey_serialize', [p, c, s, c, ctypes.c_uint]),
+                ('secp256k1_ec_pubkey_tweak_add', [p, c, c]),
+                ('secp256k1_ecdsa_sign', [p, c, c, c, p, p]),
+                ('secp256k1_ecdsa_verify', [p, c, c, c]),
+                ('secp256k1_ecdsa_signature_parse_compact', [p, c, c]),
+                ('secp256k1_ecdsa_signature_serialize_compact', [p, c, c]),
+                ('secp256k1_ecdsa_signature_normalize', [p, c, c]),
+                ('secp256k1_ecdsa_recoverable_signature_parse_compact', [p, c, c, i]),
+                ('secp256k1_ecdsa_recover', [p, c, c, c])]:
+            f = getattr(lib, name)
+            f.argtypes = args
+            f.restype = p if name == 'secp256k1_context_create' else i
+        self.lib = lib
+        self.ctx = lib.secp256k1_context_create(SECP256K1_CONTEXT_SIGN | SECP256K1_CONTEXT_VERIFY)
+        if not self.ctx:
+            raise RuntimeError('cannot create libsecp256k1 context')
+        # protects against side channels
+        if not lib.secp256k1_context_randomize(self.ctx, os.urandom(32)):
+            raise RuntimeError('cannot randomize libsecp256k1 context')
+
+    def parse_pubkey(self, pubkey):
+        out = ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ec_pubkey_parse(self.ctx, out, pubkey, len(pubkey)):
+            raise ValueError('invalid public key')
+        return out
+
+    def serialize_pubkey(self, point, compressed):
+        size = ctypes.c_size_t(65)
+        out = ctypes.create_string_buffer(65)
+        flags = SECP256K1_EC_COMPRESSED if compressed else SECP256K1_EC_UNCOMPRESSED
+        self.lib.secp256k1_ec_pubkey_serialize(self.ctx, out, ctypes.byref(size), point, flags)
+        return out.raw[:size.value]
+
+    def pubkey_from_secret(self, secret, compressed=True):
+        if not 0 < secret < ORDER:
+            raise ValueError('invalid secret')
+        point = ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ec_pubkey_create(self.ctx, point, number_to_string(secret, ORDER)):
+            raise ValueError('invalid secret')
+        return self.serialize_pubkey(point, compressed)
+
+    def pubkey_tweak_add(self, pubkey, tweak, compressed=True):
+        if not 0 <= tweak < ORDER:
+            raise ValueError('invalid tweak')
+        point = self.parse_pubkey(pubkey)
+        if not self.lib.secp256k1_ec_pubkey_tweak_add(self.ctx, point, number_to_string(tweak, ORDER)):
+            raise ValueError('invalid tweak')
+        return self.serialize_pubkey(point, compressed)
+
+    def pubkey_tweak_add_many(self, pubkey, tweaks, compressed=True):
+        parent = self.parse_pubkey(pubkey).raw
+        result = []
+        for tweak in tweaks:
+            if not 0 <= tweak < ORDER:
+                raise ValueError('invalid tweak')
+            point = ctypes.create_string_buffer(parent, 64)
+            if not self.lib.secp256k1_ec_pubkey_tweak_add(self.ctx, point, number_to_string(tweak, ORDER)):
+                raise ValueError('invalid tweak')
+            result.append(self.serialize_pubkey(point, compressed))
+        return result
+
+    def sign(self, secret, digest):
+        if not 0 < secret < ORDER or len(digest) != 32:
+            raise ValueError('invalid secret or digest')
+        sig = ctypes.create_string_buffer(64)
+        # the default nonce function is RFC 6979
+        if not self.lib.secp256k1_ecdsa_sign(self.ctx, sig, digest, number_to_string(secret, ORDER), None, None):
+            raise ValueError('cannot sign')
+        compact = ctypes.create_string_buffer(64)
+        self.lib.secp256k1_ecdsa_signature_serialize_compact(self.ctx, compact, sig)
+        return string_to_number(compact.raw[:32]), string_to_number(compact.raw[32:])
+
+    def verify(self, pubkey, digest, r, s):
+        if not (0 < r < ORDER and 0 < s < ORDER) or len(digest) != 32:
+            return False
+        point = self.parse_pubkey(pubkey)
+        sig = ctypes.create_string_buffer(64)
+        compact = number_to_string(r, ORDER) + number_to_string(s, ORDER)
+        if not self.lib.secp256k1_ecdsa_signature_parse_compact(self.ctx, sig, compact):
+            return False
+        # libsecp256k1 only accepts low S values
+        self.lib.secp256k1_ecdsa_signature_normalize(self.ctx, sig, sig)
+        return bool(self.lib.secp256k1_ecdsa_verify(self.ctx, sig, digest, point))
+
+    def recover(self, digest, r, s, recid, compressed=True):
+        if not (0 < r < ORDER and 0 < s < ORDER and 0 <= recid < 4) or len(digest) != 32:
+            raise ValueError('invalid signature')
+        sig = ctypes.create_string_buffer(65)
+        compact = number_to_string(r, ORDER) + number_to_string(s, ORDER)
+        if not self.lib.secp256k1_ecdsa_recoverable_signature_parse_compact(self.ctx, sig, compact, recid):
+            raise ValueError('invalid signature')
+        point = ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ecdsa_recover(self.ctx, point, sig, digest):
+            raise ValueError('invalid signature')
+        return self.serialize_pubkey(point, compressed)
+
+
+def load_backend():
+    lib = load_libsecp256k1()
+    if lib is not None:
+        try:
+            return LibsecpBackend(lib)
+        except Exception as e:
+            print_error("cannot use libsecp256k1:", e)
+    return EcdsaBackend()
+
+
+backend = load_backend()
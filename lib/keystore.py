@@ -170,8 +170,8 @@ class Xpub:
 
     def __init__(self):
         self.xpub = None
-        self.xpub_receive = None
-        self.xpub_change = None
+        # (xpub, for_change) -> (chain code, public key) of the branch
+        self.branches = {}
 
     def add_master_public_key(self, xpub):
         self.xpub = xpub
@@ -179,18 +179,21 @@ class Xpub:
     def get_master_public_key(self):
         return self.xpub
 
+    def get_branch(self, for_change):
+        key = (self.xpub, for_change)
+        if key not in self.branches:
+            _, _, _, c, cK = deserialize_xkey(self.xpub)
+            cK, c = CKD_pub(cK, c, for_change)
+            self.branches[key] = c, cK
+        return self.branches[key]
+
     def derive_pubkey(self, for_change, n):
-        xpub = self.xpub_change if for_change else self.xpub_receive
-        if xpub is None:
-            xpub = bip32_public_derivation(self.xpub, "", "/%d"%for_change)
-            if for_change:
-                self.xpub_change = xpub
-            else:
-                self.xpub_receive = xpub
-        _, _, _, c, cK = deserialize_xkey(xpub)
-        cK, c = CKD_pub(cK, c, n)
-        result = cK.encode('hex')
-        return result
+        return self.derive_pubkeys(for_change, n, 1)[0]
+
+    def derive_pubkeys(self, for_change, n, count):
+        """public keys n, n+1, ..., n+count-1 of a branch"""
+        c, cK = self.get_branch(for_change)
+        return [cK_n.encode('hex') for cK_n, c_n in CKD_pub_many(cK, c, range(n, n + count))]
 
     def get_xpubkey(self, c, i):
         s = ''.join(map(lambda x: bitcoin.int_to_hex(x,2), (c, i)))
@@ -373,8 +376,7 @@ class Old_KeyStore(Deterministic_KeyStore):
     @classmethod
     def mpk_from_seed(klass, seed):
         secexp = klass.stretch_key(seed)
-        master_private_key = ecdsa.SigningKey.from_secret_exponent(secexp, curve = SECP256k1)
-        master_public_key = master_private_key.get_verifying_key().to_string()
+        master_public_key = ecc.pubkey_from_secret(secexp, False)[1:]
         return master_public_key
 
     @classmethod
@@ -396,14 +398,17 @@ class Old_KeyStore(Deterministic_KeyStore):
     @classmethod
     def get_pubkey_from_mpk(self, mpk, for_change, n):
         z = self.get_sequence(mpk, for_change, n)
-        master_public_key = ecdsa.VerifyingKey.from_string(mpk, curve = SECP256k1)
-        pubkey_point = master_public_key.pubkey.point + z*SECP256k1.generator
-        public_key2 = ecdsa.VerifyingKey.from_public_point(pubkey_point, curve = SECP256k1)
-        return '04' + public_key2.to_string().encode('hex')
+        public_key2 = ecc.pubkey_tweak_add('\x04' + mpk, z % generator_secp256k1.order(), False)
+        return public_key2.encode('hex')
 
     def derive_pubkey(self, for_change, n):
         return self.get_pubkey_from_mpk(self.mpk, for_change, n)
 
+    def derive_pubkeys(self, for_change, n, count):
+        order = generator_secp256k1.order()
+        tweaks = [self.get_sequence(self.mpk, for_change, i) % order for i in range(n, n + count)]
+        return [K.encode('hex') for K in ecc.pubkey_tweak_add_many('\x04' + self.mpk, tweaks, False)]
+
     def get_private_key_from_stretched_exponent(self, for_change, n, secexp):
         order = generator_secp256k1.order()
         secexp = (secexp + self.get_sequence(self.mpk, for_change, n)) % order
@@ -421,8 +426,7 @@ class Old_KeyStore(Deterministic_KeyStore):
 
     def check_seed(self, seed):
         secexp = self.stretch_key(seed)
-        master_private_key = ecdsa.SigningKey.from_secret_exponent( secexp, curve = SECP256k1 )
-        master_public_key = master_private_key.get_verifying_key().to_string()
+        master_public_key = ecc.pubkey_from_secret(secexp, False)[1:]
         if master_public_key != self.mpk:
             print_error('invalid password (mpk)', self.mpk.encode('hex'), master_public_key.encode('hex'))
             raise InvalidPassword()
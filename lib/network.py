@@ -22,6 +22,7 @@
 # SOFTWARE.
 
 import time
+import heapq
 import Queue
 import os
 import errno
@@ -66,6 +67,13 @@ DEFAULT_SERVERS = {
 
 NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
+# seconds between two socket maintenance passes (pings, timeouts,
+# reconnections), and while connecting
+MAINTENANCE_INTERVAL = 1
+CONNECTING_INTERVAL = 0.1
+# header chunks requested ahead of the local blockchain
+MAX_CHUNK_REQUESTS = 8
+CHUNK_TIMEOUT = 10
 
 
 def parse_servers(result):
@@ -151,6 +159,150 @@ def deserialize_server(server_str):
 def serialize_server(host, port, protocol):
     return str(':'.join([host, port, protocol]))
 
+class Waker(object):
+    '''A pair of connected sockets.  Other threads write to it to
+    interrupt the select() of the network thread.'''
+
+    def __init__(self):
+        if hasattr(socket, 'socketpair'):
+            self.r, self.w = socket.socketpair()
+        else:
+            # Windows: select only works on sockets.  Do not go
+            # through a proxy.
+            server = socket._socketobject(socket.AF_INET, socket.SOCK_STREAM)
+            server.bind(('127.0.0.1', 0))
+            server.listen(1)
+            self.w = socket._socketobject(socket.AF_INET, socket.SOCK_STREAM)
+            self.w.connect(server.getsockname())
+            self.r, _ = server.accept()
+            server.close()
+        self.r.setblocking(0)
+        self.w.setblocking(0)
+
+    def fileno(self):
+        return self.r.fileno()
+
+    def wakeup(self):
+        try:
+            self.w.send('\0')
+        except socket.error:
+            # buffer full, a wakeup is pending anyway
+            pass
+
+    def clear(self):
+        try:
+            while self.r.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+
+class ChunkScheduler(util.PrintError):
+    '''Downloads header chunks from several interfaces at once.
+
+    Up to MAX_CHUNK_REQUESTS chunks following the local blockchain are
+    requested, each from the least busy interface whose height covers
+    it.  Chunks are validated and saved in order as they arrive.  A
+    chunk that times out, is refused or fails validation is requested
+    again from another interface.
+    '''
+
+    def __init__(self, network):
+        self.network = network
+        # chunk index -> (interface, request time)
+        self.requests = {}
+        # chunk index -> (interface, hex data), waiting for their turn
+        self.results = {}
+        # chunk index -> servers that failed to deliver it
+        self.failed = defaultdict(set)
+        self.next_idx = None
+        self.if_height = None
+
+    def start(self, if_height):
+        self.if_height = if_height
+        self.next_idx = (self.network.get_local_height() + 1) / 2016
+        for idx in self.results.keys():
+            if idx < self.next_idx:
+                self.results.pop(idx)
+        self.maintain()
+
+    def is_done(self):
+        return self.next_idx < 0 or self.network.get_local_height() >= self.if_height
+
+    def reset(self):
+        self.requests.clear()
+        self.results.clear()
+        self.failed.clear()
+        self.next_idx = None
+        self.if_height = None
+
+    def interface_for(self, idx):
+        interfaces = self.network.interfaces.values()
+        candidates = [i for i in interfaces
+                      if self.network.heights.get(i.server, 0) >= idx * 2016
+                      and i.server not in self.failed[idx]]
+        if not candidates:
+            # every server failed this chunk, give them another chance
+            self.failed.pop(idx, None)
+            candidates = [i for i in interfaces
+                          if self.network.heights.get(i.server, 0) >= idx * 2016]
+        if not candidates:
+            return None
+        load = defaultdict(int)
+        for i, t in self.requests.values():
+            load[i] += 1
+        return min(candidates, key=lambda i: load[i])
+
+    def maintain(self):
+        '''Expire lost requests and keep the request window full.'''
+        now = time.time()
+        interfaces = self.network.interfaces.values()
+        for idx, (interface, req_time) in self.requests.items():
+            if interface not in interfaces:
+                self.requests.pop(idx)
+            elif now - req_time > CHUNK_TIMEOUT:
+                interface.print_error("chunk %d request timed out" % idx)
+                self.failed[idx].add(interface.server)
+                self.requests.pop(idx)
+        last_idx = self.if_height / 2016
+        for idx in range(self.next_idx, min(last_idx + 1, self.next_idx + MAX_CHUNK_REQUESTS)):
+            if idx in self.requests or idx in self.results:
+                continue
+            interface = self.interface_for(idx)
+            if interface is None:
+                continue
+            interface.print_error("requesting chunk %d" % idx)
+            self.network.queue_request('blockchain.block.get_chunk', [idx], interface)
+            self.requests[idx] = (interface, now)
+
+    def on_chunk(self, interface, response):
+        idx = response['params'][0]
+        req = self.requests.get(idx)
+        # Ignore unsolicited chunks
+        if req is None or req[0] != interface:
+            return
+        self.requests.pop(idx)
+        if response.get('error'):
+            interface.print_error("chunk %d refused" % idx, response.get('error'))
+            self.failed[idx].add(interface.server)
+        else:
+            self.results[idx] = (interface, response['result'])
+            self.connect_chunks()
+        self.maintain()
+
+    def connect_chunks(self):
+        while self.next_idx in self.results:
+            idx = self.next_idx
+            interface, data = self.results.pop(idx)
+            self.next_idx = self.network.blockchain.connect_chunk(idx, data)
+            if self.next_idx < idx:
+                # either the server lies or our previous chunk is
+                # stale (reorg): fetch both again
+                self.failed[idx].add(interface.server)
+                self.results.pop(self.next_idx, None)
+                break
+
+
 class Network(util.DaemonThread):
     """The Network class manages a set of connections to remote electrum
     servers, each connected socket is handled by an Interface() object.
@@ -173,6 +325,7 @@ class Network(util.DaemonThread):
         self.blockchain = Blockchain(self.config, self)
         # A deque of interface header requests, processed left-to-right
         self.bc_requests = deque()
+        self.chunk_scheduler = ChunkScheduler(self)
         # Server for addresses and transactions
         self.default_server = self.config.get('server')
         # Sanitize default server
@@ -185,6 +338,11 @@ class Network(util.DaemonThread):
 
         self.lock = Lock()
         self.pending_sends = []
+        # wakes up the network thread when there is something to send
+        self.waker = Waker()
+        # heap of (time, seq, callback) calls scheduled on the network thread
+        self.timers = []
+        self.timer_seq = 0
         self.message_id = 0
         self.debug = False
         self.irc_servers = {} # returned by interface (list from irc)
@@ -606,6 +764,30 @@ class Network(util.DaemonThread):
         '''Messages is a list of (method, params) tuples'''
         with self.lock:
             self.pending_sends.append((messages, callback))
+        self.wakeup()
+
+    def wakeup(self):
+        '''Interrupt the wait of the network thread.  Can be called
+        from any thread.'''
+        self.waker.wakeup()
+
+    def call_later(self, delay, callback):
+        '''Schedule callback to be run by the network thread.  Only
+        call this from the network thread.'''
+        self.timer_seq += 1
+        heapq.heappush(self.timers, (time.time() + delay, self.timer_seq, callback))
+
+    def run_timers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            t, seq, callback = heapq.heappop(self.timers)
+            callback()
+
+    def next_timeout(self):
+        '''Seconds until the next scheduled call.'''
+        if not self.timers:
+            return MAINTENANCE_INTERVAL
+        return max(0, min(MAINTENANCE_INTERVAL, self.timers[0][0] - time.time()))
 
     def process_pending_sends(self):
         # Requests needs connectivity.  If we don't have an interface,
@@ -706,26 +888,10 @@ class Network(util.DaemonThread):
                 else:
                     self.switch_to_interface(self.default_server)
 
-    def request_chunk(self, interface, data, idx):
-        interface.print_error("requesting chunk %d" % idx)
-        self.queue_request('blockchain.block.get_chunk', [idx], interface)
-        data['chunk_idx'] = idx
-        data['req_time'] = time.time()
-
     def on_get_chunk(self, interface, response):
         '''Handle receiving a chunk of block headers'''
-        if self.bc_requests:
-            req_if, data = self.bc_requests[0]
-            req_idx = data.get('chunk_idx')
-            # Ignore unsolicited chunks
-            if req_if == interface and req_idx == response['params'][0]:
-                idx = self.blockchain.connect_chunk(req_idx, response['result'])
-                # If not finished, get the next chunk
-                if idx < 0 or self.get_local_height() >= data['if_height']:
-                    self.bc_requests.popleft()
-                    self.notify('updated')
-                else:
-                    self.request_chunk(interface, data, idx)
+        if self.bc_requests and self.bc_requests[0][1].get('chunks'):
+            self.chunk_scheduler.on_chunk(interface, response)
 
     def request_header(self, interface, data, height):
         interface.print_error("requesting header %d" % height)
@@ -763,7 +929,9 @@ class Network(util.DaemonThread):
         if if_height <= local_height:
             return False
         elif if_height > local_height + 50:
-            self.request_chunk(interface, data, (local_height + 1) / 2016)
+            data['chunks'] = True
+            data['req_time'] = time.time()
+            self.chunk_scheduler.start(if_height)
         else:
             self.request_header(interface, data, if_height)
         return True
@@ -779,7 +947,15 @@ class Network(util.DaemonThread):
                 continue
 
             req_time = data.get('req_time')
-            if not req_time:
+            if data.get('chunks'):
+                # Chunks are fetched from all interfaces; the
+                # scheduler handles timeouts itself
+                if self.chunk_scheduler.is_done():
+                    self.chunk_scheduler.reset()
+                    self.notify('updated')
+                    continue
+                self.chunk_scheduler.maintain()
+            elif not req_time:
                 # No requests sent yet.  This interface has a new height.
                 # Request headers if it is ahead of our blockchain
                 if not self.bc_request_headers(interface, data):
@@ -793,15 +969,13 @@ class Network(util.DaemonThread):
             break
 
     def wait_on_sockets(self):
-        # Python docs say Windows doesn't like empty selects.
-        # Sleep to prevent busy looping
-        if not self.interfaces:
-            time.sleep(0.1)
-            return
-        rin = [i for i in self.interfaces.values()]
+        '''Wait until a socket is ready, a timer is due or another
+        thread wakes us up.'''
+        # The waker is a socket, so the select is never empty
+        rin = [self.waker] + self.interfaces.values()
         win = [i for i in self.interfaces.values() if i.unsent_requests]
         try:
-            rout, wout, xout = select.select(rin, win, [], 0.1)
+            rout, wout, xout = select.select(rin, win, [], self.next_timeout())
         except socket.error as (code, msg):
             if code == errno.EINTR:
                 return
@@ -810,12 +984,27 @@ class Network(util.DaemonThread):
         for interface in wout:
             interface.send_requests()
         for interface in rout:
-            self.process_responses(interface)
+            if interface is self.waker:
+                self.waker.clear()
+            else:
+                self.process_responses(interface)
+
+    def maintain(self):
+        self.maintain_sockets()
+        if self.connecting or not self.is_connected():
+            self.call_later(CONNECTING_INTERVAL, self.maintain)
+        else:
+            self.call_later(MAINTENANCE_INTERVAL, self.maintain)
+
+    def stop(self):
+        util.DaemonThread.stop(self)
+        self.wakeup()
 
     def run(self):
         self.blockchain.init()
+        self.maintain()
         while self.is_running():
-            self.maintain_sockets()
+            self.run_timers()
             self.wait_on_sockets()
             self.handle_bc_requests()
             self.run_jobs()    # Synchronizer and Verifier
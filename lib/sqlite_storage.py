@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2016 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import copy
+import json
+import sqlite3
+import threading
+
+from storage import WalletStorage, StorageDict
+
+SQLITE_HEADER = 'SQLite format 3\x00'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS dict_items (name TEXT, key TEXT, value TEXT, PRIMARY KEY (name, key));
+CREATE TABLE IF NOT EXISTS transactions (tx_hash TEXT PRIMARY KEY, raw TEXT);
+CREATE TABLE IF NOT EXISTS outputs (tx_hash TEXT, address TEXT, n INTEGER, value INTEGER, is_coinbase INTEGER);
+CREATE INDEX IF NOT EXISTS outputs_tx_hash ON outputs (tx_hash);
+CREATE INDEX IF NOT EXISTS outputs_address ON outputs (address);
+CREATE TABLE IF NOT EXISTS spends (tx_hash TEXT, address TEXT, prevout TEXT, value INTEGER);
+CREATE INDEX IF NOT EXISTS spends_tx_hash ON spends (tx_hash);
+CREATE INDEX IF NOT EXISTS spends_prevout ON spends (prevout);
+CREATE TABLE IF NOT EXISTS history (address TEXT, pos INTEGER, tx_hash TEXT, height INTEGER, PRIMARY KEY (address, pos));
+CREATE INDEX IF NOT EXISTS history_tx_hash ON history (tx_hash);
+CREATE TABLE IF NOT EXISTS verified (tx_hash TEXT PRIMARY KEY, height INTEGER, timestamp INTEGER, pos INTEGER);
+'''
+
+
+def is_sqlite_file(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    except IOError:
+        return False
+
+
+class Table(object):
+    '''Stores the entries of a wallet dict as rows.  Entries with an
+    empty value are kept as a single row of NULLs.'''
+
+    def __init__(self, name, key, columns):
+        self.name = name
+        self.key = key
+        self.columns = columns
+
+    def delete(self, db, key=None):
+        if key is None:
+            db.execute('DELETE FROM %s' % self.name)
+        else:
+            db.execute('DELETE FROM %s WHERE %s=?' % (self.name, self.key), (key,))
+
+    def insert(self, db, key, value):
+        rows = self.rows(value) or [(None,) * len(self.columns)]
+        sql = 'INSERT INTO %s (%s, %s) VALUES (?%s)' % (self.name, self.key,
+            ', '.join(self.columns), ', ?' * len(self.columns))
+        db.executemany(sql, [(key,) + tuple(row) for row in rows])
+
+    def load(self, db):
+        d = {}
+        sql = 'SELECT %s, %s FROM %s ORDER BY rowid' % (self.key, ', '.join(self.columns), self.name)
+        for row in db.execute(sql):
+            key, row = row[0], row[1:]
+            if row[0] is None:
+                d.setdefault(key, self.empty())
+            else:
+                self.add_row(d.setdefault(key, self.empty()), row)
+        return d
+
+
+class AddressTable(Table):
+    '''txi and txo: tx_hash -> {address: [items]}'''
+
+    def empty(self):
+        return {}
+
+    def rows(self, value):
+        return [(addr,) + tuple(item) for addr, l in value.items() for item in l]
+
+    def add_row(self, value, row):
+        value.setdefault(row[0], []).append(list(row[1:]))
+
+
+class OutputTable(AddressTable):
+
+    def add_row(self, value, row):
+        addr, n, v, is_coinbase = row
+        value.setdefault(addr, []).append([n, v, bool(is_coinbase)])
+
+
+class HistoryTable(Table):
+    '''addr_history: address -> [(tx_hash, height)]'''
+
+    def empty(self):
+        return []
+
+    def rows(self, value):
+        # old servers returned ['*'] when the history was pruned; such
+        # histories are stored empty, and fetched again
+        return [(i, item[0], item[1]) for i, item in enumerate(value) if item != '*']
+
+    def add_row(self, value, row):
+        value.append([row[1], row[2]])
+
+
+class VerifiedTable(Table):
+    '''verified_tx3: tx_hash -> (height, timestamp, pos)'''
+
+    def rows(self, value):
+        return [tuple(value)]
+
+    def load(self, db):
+        sql = 'SELECT tx_hash, height, timestamp, pos FROM verified'
+        return dict((row[0], list(row[1:])) for row in db.execute(sql))
+
+
+class ItemTable(Table):
+    '''Any other dict, with JSON values'''
+
+    def __init__(self, name):
+        Table.__init__(self, 'dict_items', 'key', ['value'])
+        self.dict_name = name
+
+    def delete(self, db, key=None):
+        if key is None:
+            db.execute('DELETE FROM dict_items WHERE name=?', (self.dict_name,))
+        else:
+            db.execute('DELETE FROM dict_items WHERE name=? AND key=?', (self.dict_name, key))
+
+    def insert(self, db, key, value):
+        db.execute('INSERT INTO dict_items (name, key, value) VALUES (?, ?, ?)',
+                   (self.dict_name, key, json.dumps(value)))
+
+    def load(self, db):
+        sql = 'SELECT key, value FROM dict_items WHERE name=?'
+        return dict((row[0], json.loads(row[1])) for row in db.execute(sql, (self.dict_name,)))
+
+
+class RawTxTable(Table):
+
+    def insert(self, db, key, value):
+        db.execute('INSERT INTO transactions (tx_hash, raw) VALUES (?, ?)', (key, value))
+
+
+TABLES = {
+    'transactions': RawTxTable('transactions', 'tx_hash', ['raw']),
+    'txi': AddressTable('spends', 'tx_hash', ['address', 'prevout', 'value']),
+    'txo': OutputTable('outputs', 'tx_hash', ['address', 'n', 'value', 'is_coinbase']),
+    'addr_history': HistoryTable('history', 'address', ['pos', 'tx_hash', 'height']),
+    'verified_tx3': VerifiedTable('verified', 'tx_hash', ['height', 'timestamp', 'pos']),
+    'tx_fees': ItemTable('tx_fees'),
+    'pruned_txo': ItemTable('pruned_txo'),
+}
+
+
+class LazyTransactions(StorageDict):
+    '''Raw transactions, read from the database when accessed.  Only
+    the keys and the entries not yet written are held in memory; other
+    values are None.'''
+
+    def __init__(self, lock, db, keys):
+        StorageDict.__init__(self, lock)
+        self.db = db
+        for key in keys:
+            dict.__setitem__(self, key, None)
+
+    def fetch(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT raw FROM transactions WHERE tx_hash=?', (key,)).fetchone()
+        return str(row[0])
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        return self.fetch(key) if value is None else value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def itervalues(self):
+        for key in self.iterkeys():
+            yield self[key]
+
+    def iteritems(self):
+        for key in self.iterkeys():
+            yield key, self[key]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def pop(self, key, *args):
+        with self.lock:
+            if key in self:
+                value = self[key]
+                StorageDict.pop(self, key)
+                return value
+            return StorageDict.pop(self, key, *args)
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    def evict(self, keys):
+        '''Forget the values of written entries.'''
+        for key in keys:
+            if key in self:
+                dict.__setitem__(self, key, None)
+
+
+class SqliteStorage(WalletStorage):
+    '''Wallet storage in a SQLite database.  Transaction data is kept
+    in indexed tables, and raw transactions are only read when they
+    are accessed.  The items of other dicts obtained with get_dict are
+    stored as rows of dict_items, and other keys as JSON.
+
+    Changes are recorded like in WalletStorage, and written in a
+    single database transaction.'''
+
+    def read(self, path):
+        self.file_exists = os.path.exists(path)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+        for key, value in self.db.execute('SELECT key, value FROM kv'):
+            self.data[key] = json.loads(value)
+        for key, table in TABLES.items():
+            if key != 'transactions':
+                d = table.load(self.db)
+                if d:
+                    self.data[key] = d
+        # dicts not in TABLES stored in dict_items
+        self.item_dicts = set()
+        for (name,) in self.db.execute('SELECT DISTINCT name FROM dict_items'):
+            if name not in TABLES:
+                self.data[name] = ItemTable(name).load(self.db)
+                self.item_dicts.add(name)
+        keys = [row[0] for row in self.db.execute('SELECT tx_hash FROM transactions')]
+        self.data['transactions'] = LazyTransactions(self.lock, self.db, keys)
+
+    def _write(self):
+        if threading.currentThread().isDaemon():
+            self.print_error('warning: daemon thread cannot write wallet')
+            return
+        self.journal_dicts()
+        if not self.modified and not self.journal:
+            return
+        written = set()
+        with self.db:
+            for op in self.journal:
+                key = op[1]
+                table = TABLES.get(key)
+                if table is None:
+                    table = self.item_table(op)
+                if table is None:
+                    self.write_kv(key)
+                elif op[0] == 'update':
+                    for k in op[3]:
+                        table.delete(self.db, k)
+                    for k, v in op[2].items():
+                        table.delete(self.db, k)
+                        table.insert(self.db, k, v)
+                    if key == 'transactions':
+                        written |= set(op[2].keys())
+                else:
+                    table.delete(self.db)
+                    if op[0] == 'set':
+                        for k, v in op[2].items():
+                            table.insert(self.db, k, v)
+        self.data['transactions'].evict(written)
+        self.print_error("saved", self.path)
+        self.journal = []
+        self.modified = False
+        self.file_exists = True
+
+    def item_table(self, op):
+        '''Returns the ItemTable of a dict not in TABLES, or None if
+        the key is stored as JSON.  Dicts obtained with get_dict are
+        moved to dict_items when they are first updated.'''
+        key = op[1]
+        if op[0] != 'update':
+            if key in self.item_dicts:
+                ItemTable(key).delete(self.db)
+                self.item_dicts.discard(key)
+            return None
+        if key in self.item_dicts:
+            return ItemTable(key)
+        if isinstance(self.data.get(key), StorageDict):
+            table = ItemTable(key)
+            self.db.execute('DELETE FROM kv WHERE key=?', (key,))
+            for k, v in self.data[key].items():
+                table.insert(self.db, k, v)
+            self.item_dicts.add(key)
+            return table
+        return None
+
+    def write_kv(self, key):
+        value = self.data.get(key)
+        if value is None:
+            self.db.execute('DELETE FROM kv WHERE key=?', (key,))
+        else:
+            self.db.execute('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)',
+                            (key, json.dumps(value)))
+
+    def _compact(self):
+        self._write()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def convert_to_sqlite(path):
+    '''Converts the JSON wallet file at path to a SQLite database.  The
+    JSON file is kept as path + '.json'.  Returns its path.'''
+    storage = WalletStorage(path)
+    if isinstance(storage, SqliteStorage):
+        raise BaseException('Wallet is already a SQLite database')
+    if not storage.file_exists:
+        raise BaseException('Wallet file not found')
+    # merge the journal, so that the JSON copy is complete
+    storage.compact()
+    temp_path = path + '.sqlite.tmp'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    db = SqliteStorage(temp_path)
+    for key, value in storage.data.items():
+        db.put(key, value)
+    db.write()
+    db.close()
+    backup_path = path + '.json'
+    os.rename(path, backup_path)
+    os.rename(temp_path, path)
+    return backup_path
@@ -30,6 +30,7 @@ import random
 import time
 import json
 import copy
+import hashlib
 import re
 import stat
 
@@ -37,7 +38,95 @@ from i18n import _
 from util import NotEnoughFunds, PrintError, profiler
 from plugins import run_hook, plugin_loaders
 
+# The journal is merged into the wallet file once it grows past this
+# size, or past half the size of the wallet file
+JOURNAL_COMPACT_SIZE = 1024 * 1024
+
+
+def delete_wallet(path):
+    '''Removes the wallet file at path, and its journal.'''
+    os.remove(path)
+    if os.path.exists(path + '.journal'):
+        os.remove(path + '.journal')
+
+
+class StorageDict(dict):
+    '''A dict kept by reference in WalletStorage, see get_dict.
+    Assigned and removed entries are remembered, and only those are
+    serialized by the next write.  Values modified in place must be
+    flagged with touch().'''
+
+    def __init__(self, lock, *args):
+        dict.__init__(self, *args)
+        self.lock = lock
+        self.dirty = set()
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
+
+    def touch(self, key):
+        with self.lock:
+            self.dirty.add(key)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            dict.__setitem__(self, key, value)
+            self.dirty.add(key)
+
+    def __delitem__(self, key):
+        with self.lock:
+            dict.__delitem__(self, key)
+            self.dirty.add(key)
+
+    def pop(self, key, *args):
+        with self.lock:
+            if key in self:
+                self.dirty.add(key)
+            return dict.pop(self, key, *args)
+
+    def popitem(self):
+        with self.lock:
+            key, value = dict.popitem(self)
+            self.dirty.add(key)
+            return key, value
+
+    def setdefault(self, key, default=None):
+        with self.lock:
+            if key not in self:
+                self[key] = default
+            return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        with self.lock:
+            for key, value in dict(*args, **kwargs).iteritems():
+                self[key] = value
+
+    def clear(self):
+        with self.lock:
+            self.dirty.update(self.keys())
+            dict.clear(self)
+
 class WalletStorage(PrintError):
+    '''Wallet data is kept in a JSON file.  Changes made since the file
+    was last written are appended to a journal next to it, one JSON
+    line per write.  The journal is merged back (compacted) into the
+    file when it gets large.
+
+    The first line of the journal is ["base", sha256 of the wallet
+    file], and the journal is ignored if it does not match the file.
+    Each following line is the list of changes of one write, applied
+    entirely or not at all.  Changes are ["set", key, value],
+    ["del", key] and ["update", key, {subkey: value}, [removed
+    subkeys]] for changes inside a dict.
+    '''
+
+    def __new__(cls, path):
+        if cls is WalletStorage and path:
+            # wallets converted with convert_to_sqlite
+            from sqlite_storage import SqliteStorage, is_sqlite_file
+            if is_sqlite_file(path):
+                cls = SqliteStorage
+        return PrintError.__new__(cls)
 
     def __init__(self, path):
         self.lock = threading.RLock()
@@ -45,6 +134,12 @@ class WalletStorage(PrintError):
         self.path = path
         self.file_exists = False
         self.modified = False
+        # changes not yet written to the journal
+        self.journal = []
+        # size of the journal file, and hash of the wallet file it
+        # applies to
+        self.journal_size = 0
+        self.base_hash = None
         self.print_error("wallet path", self.path)
         if self.path:
             self.read(self.path)
@@ -64,6 +159,7 @@ class WalletStorage(PrintError):
             return
         if not data:
             return
+        self.base_hash = hashlib.sha256(data).hexdigest()
         try:
             self.data = json.loads(data)
         except:
@@ -88,6 +184,65 @@ class WalletStorage(PrintError):
                     continue
                 self.data[key] = value
         self.file_exists = True
+        self.read_journal()
+
+    def journal_path(self):
+        return self.path + '.journal'
+
+    def read_journal(self):
+        try:
+            f = open(self.journal_path(), "r")
+        except IOError:
+            return
+        with f:
+            good = 0
+            for line in f:
+                try:
+                    assert line.endswith('\n')
+                    ops = json.loads(line)
+                except:
+                    # interrupted write: drop the partial entry
+                    self.print_error("discarding journal after", good)
+                    break
+                if good == 0 and ops != ['base', self.base_hash]:
+                    # left over from a previous wallet file, or from
+                    # a compaction that was interrupted
+                    self.print_error("discarding journal of another wallet file")
+                    break
+                if good:
+                    for op in ops:
+                        self.apply(op)
+                good += len(line)
+        if good != os.path.getsize(self.journal_path()):
+            with open(self.journal_path(), "r+") as f:
+                f.truncate(good)
+        self.journal_size = good
+        self.print_error("journal size", good)
+
+    def apply(self, op):
+        if op[0] == 'set':
+            self.data[op[1]] = op[2]
+        elif op[0] == 'del':
+            self.data.pop(op[1], None)
+        elif op[0] == 'update':
+            d = self.data.setdefault(op[1], {})
+            d.update(op[2])
+            for k in op[3]:
+                d.pop(k, None)
+        else:
+            raise BaseException('unknown journal entry')
+
+    def get_dict(self, key):
+        '''Returns the dict stored under key, without copying it.  The
+        caller modifies it in place and put() is not needed; its
+        changes are serialized when the storage is written.  Hold
+        storage.lock when modifying values in place.'''
+        with self.lock:
+            d = self.data.get(key)
+            if not isinstance(d, StorageDict):
+                d = StorageDict(self.lock, d or {})
+                self.data[key] = d
+            return d
 
     def get(self, key, default=None):
         with self.lock:
@@ -107,12 +262,28 @@ class WalletStorage(PrintError):
             return
         with self.lock:
             if value is not None:
-                if self.data.get(key) != value:
+                old = self.data.get(key)
+                if value is old:
+                    return
+                if isinstance(old, StorageDict):
+                    old.clear()
+                    old.update(copy.deepcopy(value))
                     self.modified = True
-                    self.data[key] = copy.deepcopy(value)
+                elif old != value:
+                    self.modified = True
+                    value = copy.deepcopy(value)
+                    self.data[key] = value
+                    if type(old) is dict and type(value) is dict:
+                        changed = dict((k, v) for k, v in value.iteritems()
+                                       if k not in old or old[k] != v)
+                        removed = [k for k in old if k not in value]
+                        self.journal.append(['update', key, changed, removed])
+                    else:
+                        self.journal.append(['set', key, value])
             elif key in self.data:
                 self.modified = True
                 self.data.pop(key)
+                self.journal.append(['del', key])
 
     def write(self):
         with self.lock:
@@ -123,8 +294,42 @@ class WalletStorage(PrintError):
         if threading.currentThread().isDaemon():
             self.print_error('warning: daemon thread cannot write wallet')
             return
-        if not self.modified:
+        self.journal_dicts()
+        if not self.modified and not self.journal:
+            return
+        if not os.path.exists(self.path) or self.base_hash is None:
+            self._compact()
+            return
+        s = json.dumps(self.journal) + '\n'
+        if self.journal_size == 0:
+            s = json.dumps(['base', self.base_hash]) + '\n' + s
+        size = os.path.getsize(self.path)
+        if self.journal_size + len(s) > max(JOURNAL_COMPACT_SIZE, size / 2):
+            self._compact()
             return
+        with open(self.journal_path(), "a" if self.journal_size else "w") as f:
+            f.write(s)
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_size += len(s)
+        self.journal = []
+        self.modified = False
+
+    def journal_dicts(self):
+        for key, d in self.data.items():
+            if isinstance(d, StorageDict) and d.dirty:
+                changed = dict((k, d[k]) for k in d.dirty if k in d)
+                removed = [k for k in d.dirty if k not in d]
+                self.journal.append(['update', key, changed, removed])
+                d.dirty = set()
+
+    def compact(self):
+        '''Write all data to the wallet file and remove the journal.
+        The wallet file can then be read without the journal.'''
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
         s = json.dumps(self.data, indent=4, sort_keys=True)
         temp_path = "%s.tmp.%s" % (self.path, os.getpid())
         with open(temp_path, "w") as f:
@@ -140,7 +345,17 @@ class WalletStorage(PrintError):
             os.remove(self.path)
             os.rename(temp_path, self.path)
         os.chmod(self.path, mode)
+        # the journal does not match the new file anymore, even if
+        # removing it is interrupted
+        self.base_hash = hashlib.sha256(s).hexdigest()
+        if os.path.exists(self.journal_path()):
+            os.remove(self.journal_path())
         self.print_error("saved", self.path)
+        for d in self.data.values():
+            if isinstance(d, StorageDict):
+                d.dirty = set()
+        self.journal = []
+        self.journal_size = 0
         self.modified = False
 
     def requires_split(self):
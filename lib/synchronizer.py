@@ -24,13 +24,31 @@
 # SOFTWARE.
 
 
-from threading import Lock
+from threading import Lock, Thread
+from collections import deque, defaultdict
+from itertools import groupby
 import hashlib
+import Queue
 
 from bitcoin import Hash, hash_encode
 from transaction import Transaction
 from util import print_error, print_msg, ThreadJob
 
+# History and transaction requests are sent in groups of at most
+# SYNC_BATCH_SIZE, with at most SYNC_MAX_REQUESTS waiting for a
+# response.  Both can be set in the config.
+SYNC_BATCH_SIZE = 100
+SYNC_MAX_REQUESTS = 1000
+
+
+def history_status(h):
+    '''Status of an address history: the hash of its (tx_hash, height)
+    items, or None if it is empty.'''
+    if not h:
+        return None
+    status = ''.join('%s:%d:' % (tx_hash, height) for tx_hash, height in h)
+    return hashlib.sha256(status).digest().encode('hex')
+
 
 class Synchronizer(ThreadJob):
     '''The synchronizer keeps the wallet up-to-date with its set of
@@ -40,7 +58,8 @@ class Synchronizer(ThreadJob):
     we don't have the full history of, and requests binary transaction
     data of any transactions the wallet doesn't have.
 
-    External interface: __init__() and add() member functions.
+    External interface: __init__(), add() and add_addresses() member
+    functions.
     '''
 
     def __init__(self, wallet, network):
@@ -51,7 +70,23 @@ class Synchronizer(ThreadJob):
         self.requested_tx = set()
         self.requested_histories = {}
         self.requested_addrs = set()
+        # history and transaction requests not sent yet, as
+        # (method, params, callback)
+        self.queue = deque()
+        self.num_sent = 0
+        self.batch_size = network.config.get('sync_batch_size', SYNC_BATCH_SIZE)
+        self.max_requests = network.config.get('sync_max_requests', SYNC_MAX_REQUESTS)
+        # progress counters, per method
+        self.num_requested = defaultdict(int)
+        self.num_answered = defaultdict(int)
         self.lock = Lock()
+        # Received transactions are checked and parsed by a worker
+        # thread, then added to the wallet by run(), in order.
+        self.raw_txs = Queue.Queue()
+        self.parsed_txs = Queue.Queue()
+        self.parser = Thread(target=self.parse_txs, name='tx parser')
+        self.parser.daemon = True
+        self.parser.start()
         self.initialize()
 
     def parse_response(self, response):
@@ -66,43 +101,74 @@ class Synchronizer(ThreadJob):
 
     def release(self):
         self.network.unsubscribe(self.addr_subscription_response)
+        self.raw_txs.put(None)
+
+    def request(self, method, params, callback):
+        self.queue.append((method, params, callback))
+        self.num_requested[method] += 1
+
+    def answered(self, response):
+        self.num_sent -= 1
+        self.num_answered[response.get('method')] += 1
+
+    def send_requests(self):
+        '''Sends queued requests, as long as fewer than max_requests
+        are waiting for a response.'''
+        while self.queue and self.num_sent < self.max_requests:
+            n = min(len(self.queue), self.batch_size, self.max_requests - self.num_sent)
+            batch = [self.queue.popleft() for i in range(n)]
+            self.num_sent += n
+            for callback, requests in groupby(batch, lambda r: r[2]):
+                self.network.send([(method, params) for method, params, c in requests], callback)
+
+    def get_progress(self):
+        '''Returns the number of answered and requested histories and
+        transactions.'''
+        methods = ['blockchain.address.get_history', 'blockchain.transaction.get']
+        return sum(self.num_answered[m] for m in methods), sum(self.num_requested[m] for m in methods)
 
     def add(self, address):
         '''This can be called from the proxy or GUI threads.'''
+        self.add_addresses([address])
+
+    def add_addresses(self, addresses):
         with self.lock:
-            self.new_addresses.add(address)
+            self.new_addresses.update(addresses)
+        self.network.wakeup()
 
     def subscribe_to_addresses(self, addresses):
-        if addresses:
-            self.requested_addrs |= addresses
-            msgs = map(lambda addr: ('blockchain.address.subscribe', [addr]),
-                       addresses)
-            self.network.send(msgs, self.addr_subscription_response)
+        # Subscriptions are queued with the other requests, so that a
+        # large wallet does not send all of them at once on startup
+        addresses = addresses - self.requested_addrs
+        self.requested_addrs |= addresses
+        for addr in addresses:
+            self.request('blockchain.address.subscribe', [addr],
+                         self.addr_subscription_response)
 
     def get_status(self, h):
-        if not h:
-            return None
-        status = ''
-        for tx_hash, height in h:
-            status += tx_hash + ':%d:' % height
-        return hashlib.sha256(status).digest().encode('hex')
+        return history_status(h)
 
     def addr_subscription_response(self, response):
+        if response['params'][0] in self.requested_addrs:
+            # our request, not a notification
+            self.answered(response)
         params, result = self.parse_response(response)
         if not params:
             return
         addr = params[0]
-        history = self.wallet.get_address_history(addr)
-        if self.get_status(history) != result:
+        if self.wallet.get_address_status(addr) != result:
             if self.requested_histories.get(addr) is None:
                 self.requested_histories[addr] = result
-                self.network.send([('blockchain.address.get_history', [addr])],
-                                  self.addr_history_response)
+                self.request('blockchain.address.get_history', [addr],
+                             self.addr_history_response)
+        elif addr not in self.requested_histories:
+            self.wallet.set_server_status(addr, result)
         # remove addr from list only after it is added to requested_histories
         if addr in self.requested_addrs:  # Notifications won't be in
             self.requested_addrs.remove(addr)
 
     def addr_history_response(self, response):
+        self.answered(response)
         params, result = self.parse_response(response)
         if not params:
             return
@@ -126,44 +192,74 @@ class Synchronizer(ThreadJob):
         else:
             # Store received history
             self.wallet.receive_history_callback(addr, hist, tx_fees)
+            self.wallet.set_server_status(addr, server_status)
             # Request transactions we don't have
             self.request_missing_txs(hist)
         # Remove request; this allows up_to_date to be True
         self.requested_histories.pop(addr)
 
     def tx_response(self, response):
+        self.answered(response)
         params, result = self.parse_response(response)
         if not params:
             return
         tx_hash, tx_height = params
-        assert tx_hash == hash_encode(Hash(result.decode('hex')))
-        tx = Transaction(result)
-        try:
-            tx.deserialize()
-        except Exception:
-            self.print_msg("cannot deserialize transaction, skipping", tx_hash)
-            return
-        self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
-        self.requested_tx.remove((tx_hash, tx_height))
-        self.print_error("received tx %s height: %d bytes: %d" %
-                         (tx_hash, tx_height, len(tx.raw)))
-        # callbacks
-        self.network.trigger_callback('new_transaction', tx)
-        if not self.requested_tx:
-            self.network.trigger_callback('updated')
+        self.raw_txs.put((tx_hash, tx_height, result))
+
+    def parse_txs(self):
+        '''Worker thread: checks the hash of received transactions and
+        deserializes them.'''
+        while True:
+            item = self.raw_txs.get()
+            if item is None:
+                break
+            tx_hash, tx_height, raw = item
+            tx, error = None, None
+            try:
+                if tx_hash != hash_encode(Hash(raw.decode('hex'))):
+                    error = "transaction does not match its hash, skipping"
+                else:
+                    tx = Transaction(raw)
+                    tx.deserialize()
+            except Exception:
+                error = "cannot deserialize transaction, skipping"
+            self.parsed_txs.put((tx_hash, tx_height, tx, error))
+            self.network.wakeup()
+
+    def add_parsed_txs(self):
+        '''Adds parsed transactions to the wallet.  At most batch_size
+        are added per call, so that the network thread keeps serving
+        its sockets.'''
+        for i in range(self.batch_size):
+            try:
+                tx_hash, tx_height, tx, error = self.parsed_txs.get_nowait()
+            except Queue.Empty:
+                return
+            if error:
+                self.print_msg(error, tx_hash)
+                continue
+            self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
+            self.requested_tx.remove((tx_hash, tx_height))
+            self.print_error("received tx %s height: %d bytes: %d" %
+                             (tx_hash, tx_height, len(tx.raw)))
+            # callbacks
+            self.network.trigger_callback('new_transaction', tx)
+            if not self.requested_tx:
+                self.network.trigger_callback('updated')
+        if not self.parsed_txs.empty():
+            self.network.wakeup()
 
 
     def request_missing_txs(self, hist):
         # "hist" is a list of [tx_hash, tx_height] lists
         missing = set()
         for tx_hash, tx_height in hist:
-            if self.wallet.transactions.get(tx_hash) is None:
+            if tx_hash not in self.wallet.transactions:
                 missing.add((tx_hash, tx_height))
         missing -= self.requested_tx
-        if missing:
-            requests = [('blockchain.transaction.get', tx) for tx in missing]
-            self.network.send(requests, self.tx_response)
-            self.requested_tx |= missing
+        for tx in missing:
+            self.request('blockchain.transaction.get', tx, self.tx_response)
+        self.requested_tx |= missing
 
     def initialize(self):
         '''Check the initial state of the wallet.  Subscribe to all its
@@ -184,7 +280,8 @@ class Synchronizer(ThreadJob):
 
     def run(self):
         '''Called from the network proxy thread main loop.'''
-        # 1. Create new addresses
+        # 1. Add received transactions, create new addresses
+        self.add_parsed_txs()
         self.wallet.synchronize()
 
         # 2. Subscribe to new addresses
@@ -198,3 +295,9 @@ class Synchronizer(ThreadJob):
         if up_to_date != self.wallet.is_up_to_date():
             self.wallet.set_up_to_date(up_to_date)
             self.network.trigger_callback('updated')
+
+        # 4. Send queued history and transaction requests
+        self.send_requests()
+
+        # 5. Write pending changes if they are old enough
+        self.wallet.write_storage_if_due()
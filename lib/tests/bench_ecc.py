@@ -0,0 +1,41 @@
+'''Benchmarks for the elliptic curve backends.  Not collected by the
+test runner; run with
+
+    python -m lib.tests.bench_ecc [count]
+'''
+
+import sys
+import time
+
+from lib.bitcoin import Hash
+from lib.ecc_backend import EcdsaBackend, LibsecpBackend, load_libsecp256k1, ORDER
+
+
+def bench(name, func, items):
+    t0 = time.time()
+    for item in items:
+        func(*item)
+    t = time.time() - t0
+    print "%-24s %8.3fs %10.0f /s" % (name, t, len(items) / t)
+
+
+def main(count):
+    backends = [EcdsaBackend()]
+    lib = load_libsecp256k1()
+    if lib is not None:
+        backends.append(LibsecpBackend(lib))
+    secrets = [int(Hash('key%d' % i).encode('hex'), 16) % ORDER for i in range(count)]
+    digests = [Hash(str(i)) for i in range(count)]
+    for backend in backends:
+        print backend.name
+        pubkeys = [backend.pubkey_from_secret(secret) for secret in secrets]
+        sigs = [backend.sign(secret, digest) for secret, digest in zip(secrets, digests)]
+        bench('pubkey_from_secret', backend.pubkey_from_secret, [(x,) for x in secrets])
+        bench('pubkey_tweak_add', backend.pubkey_tweak_add, zip(pubkeys, secrets))
+        bench('sign', backend.sign, zip(secrets, digests))
+        bench('verify', backend.verify, [(K, h, r, s) for K, h, (r, s) in zip(pubkeys, digests, sigs)])
+        bench('recover', backend.recover, [(h, r, s, 0) for h, (r, s) in zip(digests, sigs)])
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
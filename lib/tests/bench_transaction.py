@@ -0,0 +1,81 @@
+'''Benchmarks for the transaction codec.  Not collected by the test
+runner; run with
+
+    python -m lib.tests.bench_transaction [num_tx]
+'''
+
+import os
+import sys
+import time
+
+from lib import transaction
+from lib.bitcoin import (TYPE_ADDRESS, hash_160_to_bc_address, public_key_to_bc_address,
+                         SecretToASecret, public_key_from_private_key, Hash)
+from lib.transaction import Transaction
+
+
+def make_tx(i, num_inputs=2, num_outputs=2):
+    '''A signed transaction, in the format parse_scriptSig reads back'''
+    pubkeys = ['02' + '%064x' % j for j in range(num_inputs)]
+    inputs = [{'prevout_hash': '%064x' % (i * num_inputs + j), 'prevout_n': j,
+               'address': public_key_to_bc_address(pubkeys[j].decode('hex')),
+               'num_sig': 1, 'signatures': ['30' * 71],
+               'pubkeys': [pubkeys[j]], 'x_pubkeys': [pubkeys[j]]}
+              for j in range(num_inputs)]
+    outputs = [(TYPE_ADDRESS, hash_160_to_bc_address(os.urandom(20), 5 if j % 2 else 0), 100000 + j)
+               for j in range(num_outputs)]
+    return Transaction.from_io(inputs, outputs)
+
+
+def make_consolidation(num_inputs, num_keys):
+    '''An unsigned transaction spending num_inputs coins of num_keys
+    addresses, and the keys to sign it'''
+    keys = []
+    for i in range(num_keys):
+        sec = SecretToASecret(('%064x' % (i + 1)).decode('hex'), compressed=True)
+        pubkey = public_key_from_private_key(sec)
+        keys.append((pubkey, sec, public_key_to_bc_address(pubkey.decode('hex'))))
+    inputs = []
+    for i in range(num_inputs):
+        pubkey, sec, address = keys[i % num_keys]
+        inputs.append({'prevout_hash': '%064x' % (i + 1), 'prevout_n': 0, 'address': address,
+                       'num_sig': 1, 'signatures': [None], 'pubkeys': [pubkey],
+                       'x_pubkeys': [pubkey], 'value': 100000})
+    outputs = [(TYPE_ADDRESS, keys[0][2], 100000 * num_inputs)]
+    keypairs = dict((pubkey, sec) for pubkey, sec, address in keys)
+    return Transaction.from_io(inputs, outputs), keypairs
+
+
+def bench(name, func, items):
+    t0 = time.time()
+    for item in items:
+        func(item)
+    t = time.time() - t0
+    print "%-24s %8.3fs %10.0f /s" % (name, t, len(items) / t)
+
+
+def main(num_tx):
+    txs = [make_tx(i) for i in range(num_tx)]
+    raws = [tx.serialize() for tx in txs]
+    bench('serialize', lambda tx: tx.serialize(), txs)
+    bench('serialize for signing', lambda tx: tx.serialize(for_sig=0), txs)
+    bench('estimated_size', lambda tx: tx.estimated_size(), txs)
+    bench('deserialize', transaction.deserialize, raws)
+    bench('hash', lambda raw: Transaction(raw).hash(), raws)
+    # hashes signed by the inputs of a large consolidation, computed
+    # from a full serialization per input, then with a SigHasher
+    tx, keypairs = make_consolidation(2000, 20)
+    hasher = transaction.SigHasher(tx)
+    bench('sighash (serialize)', lambda i: Hash(tx.serialize_bytes(for_sig=i)), range(0, 2000, 20))
+    bench('sighash (SigHasher)', hasher.digest, range(2000))
+    # signing is dominated by elliptic curve operations
+    tx, keypairs = make_consolidation(100, 20)
+    t0 = time.time()
+    tx.sign(keypairs)
+    t = time.time() - t0
+    assert tx.is_complete()
+    print "%-24s %8.3fs %10.0f inputs/s" % ('sign 100 inputs', t, 100 / t)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,58 @@
+import shutil
+import tempfile
+import unittest
+
+from lib.blockchain import Blockchain
+
+GENESIS = ('0100000000000000000000000000000000000000000000000000000000000000'
+           '000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa'
+           '4b1e5e4a29ab5f49ffff001d1dac2b7c').decode('hex')
+
+
+class Config(dict):
+
+    def __init__(self, path, **kwargs):
+        dict.__init__(self, **kwargs)
+        self.path = path
+
+
+class TestBlockchain(unittest.TestCase):
+
+    def setUp(self):
+        super(TestBlockchain, self).setUp()
+        self.config_dir = tempfile.mkdtemp()
+        self.blockchain = Blockchain(Config(self.config_dir), None)
+        open(self.blockchain.path(), 'wb').close()
+        self.blockchain.set_local_height()
+
+    def tearDown(self):
+        super(TestBlockchain, self).tearDown()
+        shutil.rmtree(self.config_dir)
+
+    def test_genesis_chunk(self):
+        b = self.blockchain
+        self.assertEqual(-1, b.height())
+        self.assertEqual(None, b.read_header(0))
+        b.verify_chunk(0, GENESIS)
+        b.save_chunk(0, GENESIS)
+        self.assertEqual(0, b.height())
+        self.assertEqual('000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f', b.get_hash(0))
+        self.assertEqual(b.hash_header(b.read_header(0)), b.get_hash(0))
+        self.assertEqual(None, b.get_hash(1))
+
+    def test_insufficient_work(self):
+        bad = GENESIS[:76] + '\x00' * 4
+        self.assertRaises(AssertionError, self.blockchain.verify_chunk, 0, bad)
+
+    def test_targets_invalidated(self):
+        b = self.blockchain
+        b.save_chunk(0, GENESIS)
+        b.targets = {1: 0x1d00ffff, 2: 0x1d00ffff}
+        b.save_targets()
+        self.assertEqual((0x1d00ffff, b.get_target(0)[1]), b.get_target(2))
+        header = b.read_header(0)
+        header['block_height'] = 2016
+        b.save_header(header)
+        self.assertEqual({1: 0x1d00ffff}, b.targets)
+        b.load_targets()
+        self.assertEqual({1: 0x1d00ffff}, b.targets)
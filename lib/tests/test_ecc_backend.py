@@ -0,0 +1,111 @@
+import hashlib
+import unittest
+
+import ecdsa
+from ecdsa.curves import SECP256k1
+from ecdsa.util import number_to_string, sigdecode_string
+
+from lib.bitcoin import MySigningKey, Hash
+from lib.ecc_backend import EcdsaBackend, LibsecpBackend, load_libsecp256k1, ORDER
+
+SECRETS = [1, 2, 0xdeadbeef, ORDER - 1, ORDER / 3, int('ab' * 32, 16) % ORDER]
+DIGESTS = [Hash(str(i)) for i in range(4)] + ['\x00' * 32, '\xff' * 32]
+
+
+class TestEcdsaBackend(unittest.TestCase):
+
+    backend = EcdsaBackend()
+
+    def test_pubkey_from_secret(self):
+        self.assertEqual(self.backend.pubkey_from_secret(1).encode('hex'),
+                         '0279be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798')
+        for secret in SECRETS:
+            key = ecdsa.SigningKey.from_secret_exponent(secret, curve=SECP256k1)
+            K = self.backend.pubkey_from_secret(secret, False)
+            self.assertEqual('\x04' + key.get_verifying_key().to_string(), K)
+            self.assertEqual(K[1:33], self.backend.pubkey_from_secret(secret)[1:])
+        self.assertRaises(ValueError, self.backend.pubkey_from_secret, 0)
+        self.assertRaises(ValueError, self.backend.pubkey_from_secret, ORDER)
+
+    def test_pubkey_tweak_add(self):
+        for secret in SECRETS:
+            K = self.backend.pubkey_from_secret(secret)
+            tweaked = self.backend.pubkey_tweak_add(K, 12345)
+            self.assertEqual(self.backend.pubkey_from_secret((secret + 12345) % ORDER), tweaked)
+        self.assertRaises(ValueError, self.backend.pubkey_tweak_add, '\x02' + '\x00' * 32, 1)
+
+    def test_sign(self):
+        # same signatures as the ecdsa package, with low S values
+        for secret in SECRETS:
+            key = MySigningKey.from_secret_exponent(secret, curve=SECP256k1)
+            K = self.backend.pubkey_from_secret(secret)
+            for digest in DIGESTS:
+                r, s = self.backend.sign(secret, digest)
+                sig = key.sign_digest_deterministic(digest, hashfunc=hashlib.sha256)
+                self.assertEqual(sigdecode_string(sig, ORDER), (r, s))
+                self.assertTrue(s <= ORDER / 2)
+                self.assertTrue(self.backend.verify(K, digest, r, s))
+                self.assertTrue(self.backend.verify(K, digest, r, ORDER - s))
+                self.assertFalse(self.backend.verify(K, Hash(digest), r, s))
+                self.assertFalse(self.backend.verify(K, digest, r, 0))
+
+    def test_recover(self):
+        for secret in SECRETS:
+            for compressed in [True, False]:
+                K = self.backend.pubkey_from_secret(secret, compressed)
+                r, s = self.backend.sign(secret, DIGESTS[0])
+                recovered = []
+                for recid in range(4):
+                    try:
+                        recovered.append(self.backend.recover(DIGESTS[0], r, s, recid, compressed))
+                    except ValueError:
+                        pass
+                self.assertIn(K, recovered)
+
+
+@unittest.skipIf(load_libsecp256k1() is None, 'libsecp256k1 not found')
+class TestLibsecpBackend(unittest.TestCase):
+    '''Both backends must give the same results'''
+
+    def setUp(self):
+        self.ecdsa = EcdsaBackend()
+        self.libsecp = LibsecpBackend(load_libsecp256k1())
+
+    def test_pubkeys(self):
+        for secret in SECRETS:
+            for compressed in [True, False]:
+                K = self.ecdsa.pubkey_from_secret(secret, compressed)
+                self.assertEqual(K, self.libsecp.pubkey_from_secret(secret, compressed))
+                for tweak in [0, 1, secret, ORDER - secret]:
+                    try:
+                        expected = self.ecdsa.pubkey_tweak_add(K, tweak, compressed)
+                    except ValueError:
+                        self.assertRaises(ValueError, self.libsecp.pubkey_tweak_add, K, tweak, compressed)
+                    else:
+                        self.assertEqual(expected, self.libsecp.pubkey_tweak_add(K, tweak, compressed))
+
+    def test_signatures(self):
+        for secret in SECRETS:
+            K = self.ecdsa.pubkey_from_secret(secret, False)
+            for digest in DIGESTS:
+                r, s = self.ecdsa.sign(secret, digest)
+                if digest < number_to_string(ORDER, ORDER):
+                    self.assertEqual((r, s), self.libsecp.sign(secret, digest))
+                else:
+                    # libsecp256k1 does not reduce the digest before
+                    # deriving the nonce, so the signatures differ
+                    self.assertTrue(self.ecdsa.verify(K, digest, *self.libsecp.sign(secret, digest)))
+                for sig in [(r, s), (r, ORDER - s), (r, s + 1), (r + 1, s)]:
+                    self.assertEqual(self.ecdsa.verify(K, digest, *sig), self.libsecp.verify(K, digest, *sig))
+                for recid in range(4):
+                    try:
+                        expected = self.ecdsa.recover(digest, r, s, recid)
+                    except ValueError:
+                        self.assertRaises(ValueError, self.libsecp.recover, digest, r, s, recid)
+                    else:
+                        self.assertEqual(expected, self.libsecp.recover(digest, r, s, recid))
+
+    def test_invalid_pubkey(self):
+        for K in ['\x02' + '\x00' * 32, '\x04' + '\x01' * 64, '\x05' + '\x00' * 32, '']:
+            self.assertRaises(ValueError, self.ecdsa.pubkey_tweak_add, K, 1)
+            self.assertRaises(ValueError, self.libsecp.pubkey_tweak_add, K, 1)
@@ -0,0 +1,32 @@
+import unittest
+
+from lib import keystore
+from lib.bitcoin import bip32_public_derivation, deserialize_xkey
+
+XPUB = 'xpub661MyMwAqRbcFtXgS5sYJABqqG9YLmC4Q1Rdap9gSE8NqtwybGhePY2gZ29ESFjqJoCu1Rupje8YtGqsefD265TMg7usUDFdp6W1EGMcet8'
+OLD_MPK = 'e9d4b7866dd1e91c862aebf62a49548c7dbf7bcc6e4b7b8c9da820c7737968df9c09d5a3e271dc814a29981f81b3faaf2737b551ef5dcc6189cf0f8252c442b3'
+
+
+class TestDerivation(unittest.TestCase):
+
+    def test_bip32(self):
+        ks = keystore.from_xpub(XPUB)
+        self.assertEqual('02756de182c5dd4b717ea87e693006da62dbb3cddaa4a5cad2ed1f5bbab755f0f5', ks.derive_pubkey(0, 0))
+        self.assertEqual('03e23498b07c9a262042c5544590310ac3670fe64383412f7a76fd8167b71afbbb', ks.derive_pubkey(1, 5))
+        for for_change in [0, 1]:
+            pubkeys = ks.derive_pubkeys(for_change, 3, 5)
+            self.assertEqual(5, len(pubkeys))
+            for i, pubkey in enumerate(pubkeys):
+                xpub = bip32_public_derivation(XPUB, "", "/%d/%d" % (for_change, 3 + i))
+                self.assertEqual(deserialize_xkey(xpub)[4].encode('hex'), pubkey)
+                self.assertEqual(ks.derive_pubkey(for_change, 3 + i), pubkey)
+
+    def test_old(self):
+        ks = keystore.from_old_mpk(OLD_MPK)
+        self.assertEqual('045f7ba332df2a7b4f5d13f246e307c9174cfa9b8b05f3b83410a3c23ef8958d61'
+                         '0be285963d67c7bc1feb082f168fa9877c25999963ff8b56b242a852b23e25ed', ks.derive_pubkey(0, 0))
+        self.assertEqual('041ea9afa5231dc4d65a2667789ebf6806829b6cf88bfe443228f95263730b7b70'
+                         'fb8b00b2b33777e168bcc7ad8e0afa5c7828842794ce3814c901e24193700f6c', ks.derive_pubkey(1, 5))
+        for for_change in [0, 1]:
+            pubkeys = ks.derive_pubkeys(for_change, 0, 4)
+            self.assertEqual([ks.derive_pubkey(for_change, i) for i in range(4)], pubkeys)
@@ -0,0 +1,107 @@
+import select
+import unittest
+
+from lib import network
+
+
+class StubInterface(object):
+
+    def __init__(self, server):
+        self.server = server
+
+    def print_error(self, *msg):
+        pass
+
+
+class StubBlockchain(object):
+    '''Accepts any chunk except those listed in bad, as (idx, data).'''
+
+    def __init__(self):
+        self.local_height = -1
+        self.connected = []
+        self.bad = set()
+
+    def connect_chunk(self, idx, data):
+        if (idx, data) in self.bad:
+            return idx - 1
+        self.connected.append(idx)
+        self.local_height = (idx + 1) * 2016 - 1
+        return idx + 1
+
+
+class StubNetwork(object):
+
+    def __init__(self, servers, height):
+        self.blockchain = StubBlockchain()
+        self.interfaces = dict((s, StubInterface(s)) for s in servers)
+        self.heights = dict((s, height) for s in servers)
+        self.sent = []
+
+    def get_local_height(self):
+        return self.blockchain.local_height
+
+    def queue_request(self, method, params, interface):
+        self.sent.append((interface, params[0]))
+
+
+class TestChunkScheduler(unittest.TestCase):
+
+    def setUp(self):
+        super(TestChunkScheduler, self).setUp()
+        self.network = StubNetwork(['a', 'b', 'c'], 20 * 2016)
+        self.scheduler = network.ChunkScheduler(self.network)
+
+    def answer(self, idx, data='ok', error=None):
+        interface = self.scheduler.requests[idx][0]
+        response = {'params': [idx], 'result': data, 'error': error}
+        self.scheduler.on_chunk(interface, response)
+        return interface
+
+    def test_requests_are_spread(self):
+        self.scheduler.start(20 * 2016)
+        sent = self.network.sent
+        self.assertEqual(range(network.MAX_CHUNK_REQUESTS), [idx for i, idx in sent])
+        self.assertEqual(3, len(set(i for i, idx in sent)))
+
+    def test_chunks_connected_in_order(self):
+        self.scheduler.start(20 * 2016)
+        self.answer(2)
+        self.answer(1)
+        self.assertEqual([], self.network.blockchain.connected)
+        self.answer(0)
+        self.assertEqual([0, 1, 2], self.network.blockchain.connected)
+        # the window moved forward
+        self.assertTrue(network.MAX_CHUNK_REQUESTS + 2 in self.scheduler.requests)
+        self.assertFalse(self.scheduler.is_done())
+
+    def test_retry_on_other_server(self):
+        self.scheduler.start(20 * 2016)
+        bad = self.answer(0, error='busy')
+        self.assertNotEqual(bad, self.scheduler.requests[0][0])
+        self.network.blockchain.bad.add((1, 'bogus'))
+        self.answer(0)
+        bad = self.answer(1, 'bogus')
+        self.assertEqual([0], self.network.blockchain.connected)
+        # chunk 0 is fetched again, chunk 1 from another server
+        self.assertTrue(0 in self.scheduler.requests)
+        self.assertTrue(1 in self.scheduler.requests)
+        self.assertNotEqual(bad, self.scheduler.requests[1][0])
+
+    def test_done(self):
+        self.scheduler.start(2016 + 100)
+        self.assertEqual([0, 1], [idx for i, idx in self.network.sent])
+        self.answer(0)
+        self.answer(1)
+        self.assertTrue(self.scheduler.is_done())
+
+
+class TestWaker(unittest.TestCase):
+
+    def test_wakeup(self):
+        waker = network.Waker()
+        self.assertEqual([], select.select([waker], [], [], 0)[0])
+        waker.wakeup()
+        waker.wakeup()
+        self.assertEqual([waker], select.select([waker], [], [], 1)[0])
+        waker.clear()
+        self.assertEqual([], select.select([waker], [], [], 0)[0])
@@ -0,0 +1,234 @@
+import shutil
+import tempfile
+import unittest
+import os
+import json
+
+from lib import storage, sqlite_storage
+from lib.storage import WalletStorage, delete_wallet
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        super(TestJournal, self).setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.wallet_path = os.path.join(self.user_dir, "somewallet")
+
+    def tearDown(self):
+        super(TestJournal, self).tearDown()
+        shutil.rmtree(self.user_dir)
+
+    def read_file(self):
+        with open(self.wallet_path, "r") as f:
+            return json.loads(f.read())
+
+    def read_journal(self, s):
+        with open(s.journal_path(), "r") as f:
+            return [json.loads(line) for line in f]
+
+    def test_changes_are_journaled(self):
+        s = WalletStorage(self.wallet_path)
+        s.put('transactions', {'a': '00', 'b': '01'})
+        s.put('labels', {})
+        s.write()
+        self.assertFalse(os.path.exists(s.journal_path()))
+
+        s.put('transactions', {'a': '00', 'c': '02'})
+        s.put('labels', None)
+        s.put('seed_version', 11)
+        s.write()
+        # the wallet file is not rewritten
+        self.assertEqual({'transactions': {'a': '00', 'b': '01'}, 'labels': {}}, self.read_file())
+        # one line per write, after the hash of the wallet file
+        header, ops = self.read_journal(s)
+        self.assertEqual(['base', s.base_hash], header)
+        self.assertEqual([['update', 'transactions', {'c': '02'}, ['b']],
+                          ['del', 'labels'],
+                          ['set', 'seed_version', 11]], ops)
+
+        s2 = WalletStorage(self.wallet_path)
+        self.assertEqual(s.data, s2.data)
+
+        s2.compact()
+        self.assertFalse(os.path.exists(s2.journal_path()))
+        self.assertEqual(s.data, self.read_file())
+
+    def test_partial_entry_discarded(self):
+        s = WalletStorage(self.wallet_path)
+        s.put('a', 1)
+        s.write()
+        s.put('a', 2)
+        s.write()
+        s.put('a', 3)
+        s.put('b', 3)
+        s.write()
+        # truncate the last write: none of its changes are applied
+        with open(s.journal_path(), "r+") as f:
+            f.truncate(os.path.getsize(s.journal_path()) - 10)
+        s2 = WalletStorage(self.wallet_path)
+        self.assertEqual(2, s2.get('a'))
+        self.assertEqual(None, s2.get('b'))
+        s2.put('b', 1)
+        s2.write()
+        self.assertEqual({'a': 2, 'b': 1}, WalletStorage(self.wallet_path).data)
+
+    def test_compaction(self):
+        s = WalletStorage(self.wallet_path)
+        s.put('a', 1)
+        s.write()
+        s.put('a', 'x' * storage.JOURNAL_COMPACT_SIZE)
+        s.write()
+        self.assertFalse(os.path.exists(s.journal_path()))
+        self.assertEqual(s.data, self.read_file())
+
+    def test_storage_dict(self):
+        s = WalletStorage(self.wallet_path)
+        s.put('a', 1)
+        s.write()
+        d = s.get_dict('txo')
+        self.assertTrue(d is s.get_dict('txo'))
+        d['x'] = {'addr': [[0, 1000, False]]}
+        d['y'] = {}
+        s.write()
+        d.pop('y')
+        d['x']['addr'].append([1, 2000, False])
+        d.touch('x')
+        s.write()
+        ops = self.read_journal(s)
+        self.assertEqual([['update', 'txo', {'x': {'addr': [[0, 1000, False], [1, 2000, False]]}}, ['y']]], ops[-1])
+        s2 = WalletStorage(self.wallet_path)
+        self.assertEqual({'x': {'addr': [[0, 1000, False], [1, 2000, False]]}}, s2.get('txo'))
+        # nothing changed
+        s.write()
+        self.assertEqual(len(ops), len(open(s.journal_path()).readlines()))
+
+    def test_journal_of_previous_file(self):
+        s = WalletStorage(self.wallet_path)
+        s.put('a', 1)
+        s.write()
+        s.put('a', 2)
+        s.write()
+        journal = open(s.journal_path()).read()
+        s.put('a', 3)
+        s.compact()
+        # compaction interrupted before the journal was removed
+        with open(s.journal_path(), "w") as f:
+            f.write(journal)
+        s2 = WalletStorage(self.wallet_path)
+        self.assertEqual(3, s2.get('a'))
+        s2.put('b', 1)
+        s2.write()
+        self.assertEqual({'a': 3, 'b': 1}, WalletStorage(self.wallet_path).data)
+
+    def test_delete_wallet(self):
+        s = WalletStorage(self.wallet_path)
+        s.put('a', 1)
+        s.write()
+        s.put('a', 2)
+        s.write()
+        journal = open(s.journal_path()).read()
+        delete_wallet(self.wallet_path)
+        self.assertFalse(os.path.exists(self.wallet_path))
+        self.assertFalse(os.path.exists(s.journal_path()))
+        # a journal left next to a new wallet file is not applied
+        s = WalletStorage(self.wallet_path)
+        s.put('b', 1)
+        s.write()
+        with open(s.journal_path(), "w") as f:
+            f.write(journal)
+        self.assertEqual({'b': 1}, WalletStorage(self.wallet_path).data)
+
+
+class TestSqliteStorage(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSqliteStorage, self).setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.wallet_path = os.path.join(self.user_dir, "somewallet")
+
+    def tearDown(self):
+        super(TestSqliteStorage, self).tearDown()
+        shutil.rmtree(self.user_dir)
+
+    def test_convert(self):
+        s = WalletStorage(self.wallet_path)
+        data = {
+            'wallet_type': 'imported',
+            'addresses': ['addr1', 'addr2'],
+            'transactions': {'aa': '0100', 'bb': '0200'},
+            'txi': {'aa': {}, 'bb': {'addr1': [['aa:0', 1000]]}},
+            'txo': {'aa': {'addr1': [[0, 1000, False], [1, 500, True]]}, 'bb': {}},
+            'addr_history': {'addr1': [['aa', 10], ['bb', 11]], 'addr2': []},
+            'verified_tx3': {'aa': [10, 1400000000, 3]},
+            'pruned_txo': {'cc:1': 'bb'},
+            'labels': {'aa': 'label'},
+        }
+        for key, value in data.items():
+            s.put(key, value)
+        s.write()
+        backup_path = sqlite_storage.convert_to_sqlite(self.wallet_path)
+        self.assertEqual(data, WalletStorage(backup_path).data)
+
+        db = WalletStorage(self.wallet_path)
+        self.assertTrue(isinstance(db, sqlite_storage.SqliteStorage))
+        for key, value in data.items():
+            self.assertEqual(value, db.get(key))
+        txs = db.get_dict('transactions')
+        self.assertEqual(None, dict.get(txs, 'aa'))
+        self.assertEqual('0100', txs['aa'])
+
+        # changes
+        txs['cc'] = '0300'
+        txo = db.get_dict('txo')
+        txo['cc'] = {'addr2': [[0, 300, False]]}
+        txo['aa']['addr1'].pop()
+        txo.touch('aa')
+        txo.pop('bb')
+        history = db.get_dict('addr_history')
+        history['addr2'] = [['cc', 12]]
+        db.put('labels', None)
+        db.put('stored_height', 20)
+        db.write()
+        self.assertEqual(None, dict.get(txs, 'cc'))
+        db.close()
+
+        db = WalletStorage(self.wallet_path)
+        self.assertEqual({'aa': '0100', 'bb': '0200', 'cc': '0300'}, db.get('transactions'))
+        self.assertEqual({'aa': {'addr1': [[0, 1000, False]]}, 'cc': {'addr2': [[0, 300, False]]}}, db.get('txo'))
+        self.assertEqual([['cc', 12]], db.get('addr_history')['addr2'])
+        self.assertEqual(None, db.get('labels'))
+        self.assertEqual(20, db.get('stored_height'))
+
+    def test_pruned_history(self):
+        # old servers returned ['*'] for pruned histories
+        s = WalletStorage(self.wallet_path)
+        s.put('addr_history', {'addr1': ['*'], 'addr2': [['aa', 10]]})
+        s.write()
+        sqlite_storage.convert_to_sqlite(self.wallet_path)
+        db = WalletStorage(self.wallet_path)
+        self.assertEqual({'addr1': [], 'addr2': [['aa', 10]]}, db.get('addr_history'))
+
+    def test_storage_dicts(self):
+        # dicts obtained with get_dict are written item by item
+        s = WalletStorage(self.wallet_path)
+        s.put('addr_status', {'addr1': 'status1', 'addr2': 'status2'})
+        s.put('labels', {'aa': 'label'})
+        s.write()
+        sqlite_storage.convert_to_sqlite(self.wallet_path)
+        db = WalletStorage(self.wallet_path)
+        d = db.get_dict('addr_status')
+        d['addr3'] = 'status3'
+        d.pop('addr1')
+        db.write()
+        self.assertEqual([], db.db.execute('SELECT * FROM kv WHERE key=?', ('addr_status',)).fetchall())
+        d['addr2'] = 'status4'
+        db.write()
+        db.close()
+        db = WalletStorage(self.wallet_path)
+        self.assertEqual({'addr2': 'status4', 'addr3': 'status3'}, db.get('addr_status'))
+        self.assertEqual({'aa': 'label'}, db.get('labels'))
+        db.get_dict('addr_status').clear()
+        db.write()
+        db.close()
+        self.assertEqual(None, WalletStorage(self.wallet_path).get('addr_status'))
@@ -0,0 +1,213 @@
+import time
+import unittest
+
+from lib.bitcoin import TYPE_ADDRESS
+from lib.synchronizer import Synchronizer, history_status
+from lib.transaction import Transaction
+from lib.wallet import TransactionCache
+
+ADDR = "15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma"
+
+
+class FakeConfig(dict):
+    pass
+
+
+class FakeNetwork(object):
+
+    def __init__(self, config):
+        self.config = config
+        self.sent = []
+
+    def send(self, messages, callback):
+        self.sent.append((messages, callback))
+
+    def wakeup(self):
+        pass
+
+    def unsubscribe(self, callback):
+        pass
+
+    def trigger_callback(self, *args):
+        pass
+
+
+class FakeWallet(object):
+
+    def __init__(self, addresses):
+        self.addresses = addresses
+        self.history = {}
+        self.server_status = {}
+        self.transactions = {}
+        self.received = []
+        self.up_to_date = False
+
+    def get_addresses(self):
+        return self.addresses
+
+    def get_address_history(self, addr):
+        return self.history.get(addr, [])
+
+    def get_address_status(self, addr):
+        return history_status(self.get_address_history(addr))
+
+    def set_server_status(self, addr, status):
+        self.server_status[addr] = status
+
+    def receive_history_callback(self, addr, hist, tx_fees):
+        self.history[addr] = hist
+
+    def receive_tx_callback(self, tx_hash, tx, tx_height):
+        self.transactions[tx_hash] = tx
+        self.received.append(tx_hash)
+
+    def synchronize(self):
+        pass
+
+    def is_up_to_date(self):
+        return self.up_to_date
+
+    def set_up_to_date(self, up_to_date):
+        self.up_to_date = up_to_date
+
+    def write_storage_if_due(self):
+        pass
+
+
+class SynchronizerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.addresses = ['addr%d' % i for i in range(250)]
+        self.wallet = FakeWallet(self.addresses)
+        config = FakeConfig(sync_batch_size=40, sync_max_requests=100)
+        self.network = FakeNetwork(config)
+        self.synchronizer = Synchronizer(self.wallet, self.network)
+
+    def tearDown(self):
+        self.synchronizer.release()
+
+    def take_sent(self, method):
+        sent = [(m, p, callback) for messages, callback in self.network.sent
+                for m, p in messages if m == method]
+        self.network.sent = [x for x in self.network.sent if x[0][0][0] != method]
+        return sent
+
+    def answer_subscriptions(self, statuses={}):
+        while self.synchronizer.requested_addrs:
+            self.synchronizer.run()
+            for method, params, callback in self.take_sent('blockchain.address.subscribe'):
+                callback({'method': method, 'params': params, 'result': statuses.get(params[0])})
+
+
+class TestRequestWindow(SynchronizerTestCase):
+
+    def test_histories(self):
+        sync = self.synchronizer
+        # subscriptions are sent by run, with the other requests
+        self.assertEqual([], self.network.sent)
+        self.assertFalse(sync.is_up_to_date())
+        subscribed = answered = 0
+        while not sync.is_up_to_date():
+            sync.run()
+            batches = [messages for messages, callback in self.network.sent]
+            self.assertTrue(all(len(b) <= 40 for b in batches))
+            self.assertTrue(sum(map(len, batches)) <= 100)
+            for method, params, callback in self.take_sent('blockchain.address.subscribe'):
+                callback({'method': method, 'params': params, 'result': 'status'})
+                subscribed += 1
+            for method, params, callback in self.take_sent('blockchain.address.get_history'):
+                # the server status of an empty history is None, see history_status
+                sync.requested_histories[params[0]] = None
+                callback({'method': method, 'params': params, 'result': []})
+                answered += 1
+            self.assertEqual(answered, sync.get_progress()[0])
+        self.assertEqual(250, subscribed)
+        self.assertEqual(250, answered)
+        self.assertEqual((250, 250), sync.get_progress())
+        sync.run()
+        self.assertTrue(self.wallet.up_to_date)
+
+    def test_transactions(self):
+        sync = self.synchronizer
+        self.answer_subscriptions()
+        hist = [('%064x' % i, 10) for i in range(150)]
+        sync.request_missing_txs(hist)
+        sync.request_missing_txs(hist)
+        self.assertEqual(150, len(sync.queue))
+        sync.run()
+        sent = self.take_sent('blockchain.transaction.get')
+        self.assertEqual(100, len(sent))
+        sync.run()
+        self.assertEqual([], self.take_sent('blockchain.transaction.get'))
+        # an error response frees its slot too
+        method, params, callback = sent[0]
+        callback({'method': method, 'params': params, 'error': 'not found'})
+        sync.run()
+        self.assertEqual(1, len(self.take_sent('blockchain.transaction.get')))
+        self.assertEqual((1, 150), sync.get_progress())
+
+    def test_known_transactions(self):
+        # stored transactions are not requested, nor parsed to check
+        # that we have them
+        sync = self.synchronizer
+        self.answer_subscriptions()
+        self.wallet.transactions = TransactionCache({'01' * 32: '00'})
+        sync.request_missing_txs([('01' * 32, 10), ('02' * 32, 10)])
+        self.assertEqual(set([('02' * 32, 10)]), sync.requested_tx)
+        self.assertEqual(0, len(self.wallet.transactions.cache))
+
+    def test_unchanged_addresses(self):
+        # addresses whose status matches the wallet are not fetched
+        sync = self.synchronizer
+        self.wallet.history['addr1'] = [('01' * 32, 10)]
+        status = history_status(self.wallet.history['addr1'])
+        self.answer_subscriptions({'addr1': status, 'addr2': 'changed'})
+        self.assertEqual(['addr2'], sync.requested_histories.keys())
+        self.assertEqual(status, self.wallet.server_status['addr1'])
+        self.assertEqual(249, len(self.wallet.server_status))
+        self.assertEqual((0, 1), sync.get_progress())
+
+
+class TestTxParser(SynchronizerTestCase):
+
+    def make_raw_tx(self, i):
+        txin = {'prevout_hash': '%064x' % (i + 1), 'prevout_n': 0, 'address': ADDR,
+                'is_coinbase': False, 'num_sig': 1, 'signatures': ['30' * 70],
+                'pubkeys': ['02' * 33], 'x_pubkeys': ['02' * 33]}
+        raw = Transaction.from_io([txin], [(TYPE_ADDRESS, ADDR, 1000 + i)]).serialize()
+        return Transaction(raw).hash(), raw
+
+    def wait_parsed(self, n):
+        for i in range(100):
+            if self.synchronizer.parsed_txs.qsize() == n:
+                return
+            time.sleep(0.05)
+        self.fail('transactions not parsed')
+
+    def test_parse(self):
+        sync = self.synchronizer
+        self.answer_subscriptions()
+        txs = [self.make_raw_tx(i) for i in range(60)]
+        sync.request_missing_txs([(tx_hash, 10) for tx_hash, raw in txs])
+        sync.run()
+        sent = dict((p[0], (m, p, c)) for m, p, c in self.take_sent('blockchain.transaction.get'))
+        # a transaction that does not match its hash is skipped
+        bad_hash, raw = txs.pop()
+        method, params, callback = sent[bad_hash]
+        callback({'method': method, 'params': params, 'result': txs[0][1]})
+        for tx_hash, raw in txs:
+            method, params, callback = sent[tx_hash]
+            callback({'method': method, 'params': params, 'result': raw})
+        self.assertEqual([], self.wallet.received)
+        self.wait_parsed(60)
+        # parsed transactions are added in the order they were
+        # received, batch_size per run
+        sync.run()
+        self.assertEqual([tx_hash for tx_hash, raw in txs[:39]], self.wallet.received)
+        sync.run()
+        self.assertEqual([tx_hash for tx_hash, raw in txs], self.wallet.received)
+        self.assertEqual(1000, self.wallet.transactions[txs[0][0]].outputs()[0][2])
+        self.assertEqual(set([(bad_hash, 10)]), sync.requested_tx)
+        sync.release()
+        sync.parser.join(5)
+        self.assertFalse(sync.parser.is_alive())
@@ -1,6 +1,7 @@
 import unittest
 from lib import transaction
 from lib.bitcoin import TYPE_ADDRESS
+from lib import bitcoin
 
 import pprint
 
@@ -49,6 +50,61 @@ class TestBCDataStream(unittest.TestCase):
         self.assertEquals(s.read_bytes(4), 'r')
         self.assertEquals(s.read_bytes(1), '')
 
+class TestCodec(unittest.TestCase):
+
+    def test_compact_size(self):
+        s = transaction.BCDataStream()
+        values = [0, 1, 252, 253, 2**16-1, 2**16, 2**32-1, 2**32, 2**64-1]
+        for v in values:
+            s.write_compact_size(v)
+        self.assertEquals(s.input, ''.join(map(transaction.compact_size, values)))
+        pos = 0
+        for v in values:
+            size, pos = transaction.read_compact_size(s.input, pos)
+            self.assertEquals(size, v)
+        self.assertEquals(pos, len(s.input))
+
+    def test_push_data(self):
+        for n in [0, 1, 0x4b, 0x4c, 0xfe, 0xff, 0x10000]:
+            data = 'a' * n
+            self.assertEquals(transaction.push_data(data).encode('hex'),
+                              transaction.push_script(data.encode('hex')))
+
+    def test_roundtrip(self):
+        raw = signed_blob.decode('hex')
+        d = transaction.deserialize_bytes(raw)
+        self.assertEquals(d, transaction.deserialize(signed_blob))
+        tx = transaction.Transaction(signed_blob)
+        self.assertEquals(tx.serialize_bytes(), raw)
+
+    def test_truncated(self):
+        raw = signed_blob.decode('hex')
+        for n in [10, 50, len(raw) - 40, len(raw) - 2]:
+            with self.assertRaises(Exception):
+                transaction.deserialize_bytes(raw[:n])
+
+    def test_output_scripts(self):
+        for script, address in [
+                ('76a914230ac37834073a42146f11ef8414ae929feaafc388ac', '14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs'),
+                ('a914230ac37834073a42146f11ef8414ae929feaafc387', '34tJU84dXdcwv7mEQHVFdyzmqzGFLxpFU3')]:
+            self.assertEquals(transaction.get_address_from_output_script(script.decode('hex')),
+                              (TYPE_ADDRESS, address))
+            self.assertEquals(transaction.Transaction.pay_script(TYPE_ADDRESS, address), script)
+
+    def test_estimated_input_size(self):
+        # one 0x48 byte signature per required key, as the coin
+        # chooser expects
+        pubkeys = ['02' + '%064x' % (j + 1) for j in range(3)]
+        p2pkh = {'prevout_hash': '11' * 32, 'prevout_n': 0,
+                 'address': bitcoin.public_key_to_bc_address(pubkeys[0].decode('hex')),
+                 'num_sig': 1, 'signatures': [None], 'pubkeys': pubkeys[:1], 'x_pubkeys': pubkeys[:1]}
+        multisig = {'prevout_hash': '22' * 32, 'prevout_n': 1, 'address': '34tJU84dXdcwv7mEQHVFdyzmqzGFLxpFU3',
+                    'redeemScript': transaction.Transaction.multisig_script(pubkeys, 2),
+                    'num_sig': 2, 'signatures': [None] * 3, 'pubkeys': pubkeys, 'x_pubkeys': pubkeys}
+        self.assertEquals(transaction.Transaction.estimated_input_size(p2pkh), 148)
+        self.assertEquals(transaction.Transaction.estimated_input_size(multisig), 297)
+
+
 class TestTransaction(unittest.TestCase):
 
     def test_tx_unsigned(self):
@@ -143,6 +199,54 @@ class TestTransaction(unittest.TestCase):
         self.assertEquals(res, (None, '1CQj15y1N7LDHp7wTt28eoD1QhHgFgxECH'))
 
 
+class TestSigning(unittest.TestCase):
+
+    def make_tx(self):
+        self.keypairs = {}
+        inputs = []
+        for i in range(3):
+            sec = bitcoin.SecretToASecret(chr(i + 1) * 32, compressed=True)
+            pubkey = bitcoin.public_key_from_private_key(sec)
+            self.keypairs[pubkey] = sec
+            inputs.append({'prevout_hash': '%064x' % (i + 1), 'prevout_n': i,
+                           'address': bitcoin.address_from_private_key(sec),
+                           'num_sig': 1, 'signatures': [None], 'sequence': 0xfffffffe,
+                           'pubkeys': [pubkey], 'x_pubkeys': [pubkey]})
+        # a 1 of 2 multisig input
+        pubkeys = sorted(self.keypairs)[:2]
+        redeem_script = transaction.Transaction.multisig_script(pubkeys, 1)
+        inputs.append({'prevout_hash': 'ff' * 32, 'prevout_n': 0,
+                       'address': bitcoin.hash_160_to_bc_address(bitcoin.hash_160(redeem_script.decode('hex')), 5),
+                       'num_sig': 1, 'signatures': [None, None], 'redeemScript': redeem_script,
+                       'pubkeys': pubkeys, 'x_pubkeys': list(pubkeys)})
+        outputs = [(TYPE_ADDRESS, '14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs', 1000000),
+                   (TYPE_ADDRESS, '34tJU84dXdcwv7mEQHVFdyzmqzGFLxpFU3', 2000000)]
+        return transaction.Transaction.from_io(inputs, outputs, locktime=100)
+
+    def test_sighash(self):
+        tx = self.make_tx()
+        hasher = transaction.SigHasher(tx)
+        for i in [0, 1, 2, 3, 1, 3, 0]:
+            self.assertEquals(hasher.digest(i), bitcoin.Hash(tx.serialize_bytes(for_sig=i)))
+
+    def test_sign(self):
+        tx = self.make_tx()
+        tx.sign(self.keypairs)
+        self.assertTrue(tx.is_complete())
+        order = bitcoin.generator_secp256k1.order()
+        for i, txin in enumerate(tx.inputs()):
+            for_sig = bitcoin.Hash(tx.serialize_bytes(for_sig=i))
+            j = [k for k, sig in enumerate(txin['signatures']) if sig][0]
+            public_key = bitcoin.ecdsa.VerifyingKey.from_public_point(
+                bitcoin.ser_to_point(txin['pubkeys'][j].decode('hex')), curve=bitcoin.SECP256k1)
+            self.assertTrue(public_key.verify_digest(txin['signatures'][j].decode('hex'), for_sig,
+                                                     sigdecode=bitcoin.ecdsa.util.sigdecode_der))
+        # a second signer gets the same transaction
+        tx2 = self.make_tx()
+        tx2.update_signatures(tx.raw)
+        self.assertEquals(tx.raw, tx2.serialize())
+
+
 class NetworkMock(object):
 
     def __init__(self, unspent):
@@ -1,5 +1,6 @@
+import socket
 import unittest
-from lib.util import format_satoshis, parse_URI
+from lib.util import format_satoshis, parse_URI, LRUCache, SocketPipe, timeout
 
 class TestUtil(unittest.TestCase):
 
@@ -68,3 +69,29 @@ class TestUtil(unittest.TestCase):
     def test_parse_URI_parameter_polution(self):
         self.assertRaises(Exception, parse_URI, 'bitcoin:15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma?amount=0.0003&label=test&amount=30.0')
 
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache[1] = 'a'
+        cache[2] = 'b'
+        self.assertEqual('a', cache.get(1))
+        # 2 is now the least recently used entry
+        cache[3] = 'c'
+        self.assertEqual(2, len(cache))
+        self.assertEqual(None, cache.get(2))
+        self.assertEqual('a', cache.get(1))
+        self.assertEqual('a', cache.pop(1))
+        self.assertFalse(1 in cache)
+
+    def test_socket_pipe(self):
+        a, b = socket.socketpair()
+        pipe = SocketPipe(b)
+        pipe.set_timeout(0.0)
+        a.sendall('{"id": 1}\n{"id"')
+        self.assertEqual({'id': 1}, pipe.get())
+        self.assertRaises(timeout, pipe.get)
+        a.sendall(': 2}\nnot json\n{"id": 3}\n')
+        self.assertEqual({'id': 2}, pipe.get())
+        self.assertEqual({'id': 3}, pipe.get())
+        a.close()
+        self.assertEqual(None, pipe.get())
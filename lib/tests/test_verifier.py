@@ -0,0 +1,58 @@
+import unittest
+
+from lib.verifier import SPV
+
+
+class FakeNetwork(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def get_local_height(self):
+        return 100
+
+    def send(self, messages, callback):
+        self.sent.extend((method, params, callback) for method, params in messages)
+
+
+class FakeWallet(object):
+
+    def __init__(self, unverified):
+        self.unverified = unverified
+
+    def get_unverified_txs(self):
+        return dict(self.unverified)
+
+
+class TestRetry(unittest.TestCase):
+
+    def setUp(self):
+        self.network = FakeNetwork()
+        self.wallet = FakeWallet({'01' * 32: 90})
+        self.spv = SPV(self.network, self.wallet)
+
+    def answer_error(self):
+        method, params, callback = self.network.sent.pop()
+        callback({'method': method, 'params': params, 'error': 'not found'})
+
+    def test_error(self):
+        self.spv.run()
+        self.assertEqual(1, len(self.network.sent))
+        self.answer_error()
+        # not requested again right away
+        self.spv.run()
+        self.assertEqual([], self.network.sent)
+        # but after retry_delay
+        tx_height, t = self.spv.retry_after['01' * 32]
+        self.spv.retry_after['01' * 32] = (tx_height, t - self.spv.retry_delay)
+        self.spv.run()
+        self.assertEqual(1, len(self.network.sent))
+
+    def test_height_change(self):
+        self.spv.run()
+        self.answer_error()
+        # the transaction was mined again in another block
+        self.wallet.unverified['01' * 32] = 91
+        self.spv.run()
+        self.assertEqual([('blockchain.transaction.get_merkle', ['01' * 32, 91])],
+                         [sent[:2] for sent in self.network.sent])
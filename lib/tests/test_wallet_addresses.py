@@ -0,0 +1,128 @@
+import shutil
+import tempfile
+import unittest
+import os
+
+from lib import keystore
+from lib.storage import WalletStorage
+from lib.wallet import Standard_Wallet, Imported_Wallet
+
+XPUB = 'xpub661MyMwAqRbcFtXgS5sYJABqqG9YLmC4Q1Rdap9gSE8NqtwybGhePY2gZ29ESFjqJoCu1Rupje8YtGqsefD265TMg7usUDFdp6W1EGMcet8'
+
+
+class FakeSynchronizer(object):
+
+    def __init__(self):
+        self.batches = []
+
+    def add_addresses(self, addresses):
+        self.batches.append(list(addresses))
+
+
+class WalletAddressesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(WalletAddressesTestCase, self).setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.user_dir, "somewallet")
+        storage = WalletStorage(self.path)
+        storage.put('wallet_type', 'standard')
+        storage.put('gap_limit', 30)
+        keystore.from_xpub(XPUB).save(storage, 'x/')
+        self.wallet = Standard_Wallet(storage)
+
+    def tearDown(self):
+        super(WalletAddressesTestCase, self).tearDown()
+        shutil.rmtree(self.user_dir)
+
+    def use(self, address, height=1):
+        self.wallet.history[address] = [('00' * 32, height)]
+
+
+class TestSynchronizeSequence(WalletAddressesTestCase):
+
+    def test_batches(self):
+        wallet = self.wallet
+        wallet.synchronizer = FakeSynchronizer()
+        wallet.synchronize()
+        receiving = wallet.get_receiving_addresses()
+        self.assertEqual(30, len(receiving))
+        self.assertEqual(6, len(wallet.get_change_addresses()))
+        self.assertEqual([receiving, wallet.get_change_addresses()], wallet.synchronizer.batches)
+        ks = wallet.keystore
+        self.assertEqual([ks.derive_pubkey(0, i) for i in range(30)], wallet.receiving_pubkeys)
+        self.assertEqual(map(wallet.pubkeys_to_address, wallet.receiving_pubkeys), receiving)
+        # using an address extends the sequence past it, in one batch
+        wallet.get_local_height = lambda: 100
+        self.use(receiving[9])
+        wallet.synchronize()
+        self.assertEqual(40, len(wallet.get_receiving_addresses()))
+        self.assertEqual(wallet.get_receiving_addresses()[30:], wallet.synchronizer.batches[-1])
+        wallet.synchronize()
+        self.assertEqual(3, len(wallet.synchronizer.batches))
+
+    def test_unconfirmed_use(self):
+        # addresses with recent transactions are not old
+        wallet = self.wallet
+        wallet.synchronize()
+        wallet.get_local_height = lambda: 100
+        self.use(wallet.get_receiving_addresses()[28], 0)
+        self.use(wallet.get_receiving_addresses()[29], 99)
+        wallet.synchronize()
+        self.assertEqual(30, len(wallet.get_receiving_addresses()))
+
+    def test_reload(self):
+        self.wallet.synchronize()
+        self.wallet.storage.write()
+        wallet = Standard_Wallet(WalletStorage(self.path))
+        self.assertEqual(self.wallet.get_receiving_addresses(), wallet.get_receiving_addresses())
+        self.assertEqual(self.wallet.get_change_addresses(), wallet.get_change_addresses())
+
+
+class TestAddressIndex(WalletAddressesTestCase):
+
+    def check_index(self, wallet):
+        for for_change, addresses in [(False, wallet.get_receiving_addresses()),
+                                      (True, wallet.get_change_addresses())]:
+            for n, address in enumerate(addresses):
+                self.assertTrue(wallet.is_mine(address))
+                self.assertEqual(for_change, wallet.is_change(address))
+                self.assertEqual((for_change, n), wallet.get_address_index(address))
+        self.assertEqual(len(wallet.get_addresses()), len(wallet.address_index))
+
+    def test_index(self):
+        wallet = self.wallet
+        wallet.synchronize()
+        self.check_index(wallet)
+        foreign = wallet.pubkeys_to_address(wallet.keystore.derive_pubkey(0, 100))
+        self.assertFalse(wallet.is_mine(foreign))
+        self.assertFalse(wallet.is_change(foreign))
+        self.assertRaises(Exception, wallet.get_address_index, foreign)
+        wallet.create_new_address(True)
+        self.check_index(wallet)
+        wallet.storage.write()
+        self.check_index(Standard_Wallet(WalletStorage(self.path)))
+
+    def test_is_beyond_limit(self):
+        wallet = self.wallet
+        wallet.storage.put('gap_limit', 5)
+        wallet.gap_limit = 5
+        wallet.create_new_addresses(False, 12)
+        addresses = wallet.get_receiving_addresses()
+        self.assertEqual([False] * 5 + [True] * 7, [wallet.is_beyond_limit(a, False) for a in addresses])
+        self.use(addresses[4])
+        self.assertEqual([False] * 10 + [True] * 2, [wallet.is_beyond_limit(a, False) for a in addresses])
+
+    def test_imported(self):
+        storage = WalletStorage(os.path.join(self.user_dir, "imported"))
+        storage.put('wallet_type', 'imported')
+        addresses = [self.wallet.pubkeys_to_address(p) for p in self.wallet.keystore.derive_pubkeys(0, 0, 3)]
+        storage.put('addresses', addresses[:2])
+        wallet = Imported_Wallet(storage)
+        self.assertTrue(wallet.is_mine(addresses[1]))
+        self.assertFalse(wallet.is_mine(addresses[2]))
+        wallet.add_address(addresses[2])
+        wallet.add_address(addresses[2])
+        self.assertEqual(addresses, wallet.get_addresses())
+        self.assertTrue(wallet.is_mine(addresses[2]))
+        self.assertFalse(wallet.is_change(addresses[2]))
@@ -0,0 +1,301 @@
+import json
+import shutil
+import tempfile
+import unittest
+import os
+
+from lib.bitcoin import TYPE_ADDRESS
+from lib.storage import WalletStorage
+from lib.synchronizer import history_status
+from lib.transaction import Transaction
+from lib.wallet import Imported_Wallet, TransactionCache
+
+
+ADDR1 = "15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma"
+ADDR2 = "1NJZ4xLd2ne3o3Jbr6LzGNozTwd2EYRRaJ"
+FOREIGN = "1KSezYMhAJMWqFbVFB2JshYg69UpmEXR4D"
+
+
+def make_tx(inputs, outputs):
+    '''Build an unserialized transaction.  inputs is a list of
+    (prevout_hash, prevout_n, address), outputs is a list of
+    (address, value).'''
+    txins = [{'prevout_hash': h, 'prevout_n': n, 'address': a,
+              'is_coinbase': False, 'num_sig': 1,
+              'signatures': ['30' * 70], 'pubkeys': ['02' * 33],
+              'x_pubkeys': ['02' * 33]} for h, n, a in inputs]
+    txouts = [(TYPE_ADDRESS, a, v) for a, v in outputs]
+    return Transaction.from_io(txins, txouts)
+
+
+class WalletHistoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(WalletHistoryTestCase, self).setUp()
+        self.user_dir = tempfile.mkdtemp()
+        storage = WalletStorage(os.path.join(self.user_dir, "somewallet"))
+        storage.put('wallet_type', 'imported')
+        storage.put('addresses', [ADDR1, ADDR2])
+        self.wallet = Imported_Wallet(storage)
+
+    def tearDown(self):
+        super(WalletHistoryTestCase, self).tearDown()
+        shutil.rmtree(self.user_dir)
+
+    def receive(self, tx_hash, tx, height, addresses):
+        for addr in addresses:
+            hist = self.wallet.get_address_history(addr) + [(tx_hash, height)]
+            self.wallet.receive_history_callback(addr, hist, {})
+        self.wallet.receive_tx_callback(tx_hash, tx, height)
+
+
+class TestUtxoCache(WalletHistoryTestCase):
+
+    def test_receive_and_spend(self):
+        tx1 = make_tx([('aa' * 32, 0, FOREIGN)], [(ADDR1, 100000)])
+        self.receive('01' * 32, tx1, 10, [ADDR1])
+        self.assertEqual((100000, 0, 0), self.wallet.get_addr_balance(ADDR1))
+        self.assertEqual(1, len(self.wallet.get_addr_utxo(ADDR1)))
+
+        tx2 = make_tx([('01' * 32, 0, ADDR1)], [(ADDR2, 60000), (FOREIGN, 30000)])
+        self.receive('02' * 32, tx2, 0, [ADDR1, ADDR2])
+        self.assertEqual((100000, -100000, 0), self.wallet.get_addr_balance(ADDR1))
+        self.assertEqual((0, 60000, 0), self.wallet.get_addr_balance(ADDR2))
+        self.assertEqual([], self.wallet.get_addr_utxo(ADDR1))
+        self.assertEqual((100000, -40000, 0), self.wallet.get_balance())
+
+        coins = self.wallet.get_spendable_coins()
+        self.assertEqual(1, len(coins))
+        self.assertEqual('02' * 32, coins[0]['prevout_hash'])
+
+    def test_history_update_refreshes_balance(self):
+        tx1 = make_tx([('aa' * 32, 0, FOREIGN)], [(ADDR1, 100000)])
+        self.receive('01' * 32, tx1, 0, [ADDR1])
+        self.assertEqual((0, 100000, 0), self.wallet.get_addr_balance(ADDR1))
+        # the transaction gets mined
+        self.wallet.receive_history_callback(ADDR1, [('01' * 32, 20)], {})
+        self.assertEqual((100000, 0, 0), self.wallet.get_addr_balance(ADDR1))
+        self.assertEqual(20, self.wallet.get_addr_utxo(ADDR1)[0]['height'])
+
+    def test_reload(self):
+        tx1 = make_tx([('aa' * 32, 0, FOREIGN)], [(ADDR1, 100000)])
+        tx2 = make_tx([('01' * 32, 0, ADDR1)], [(ADDR2, 60000), (FOREIGN, 30000)])
+        self.receive('01' * 32, tx1, 10, [ADDR1])
+        self.wallet.storage.write()
+        self.receive('02' * 32, tx2, 0, [ADDR1, ADDR2])
+        self.wallet.storage.write()
+        storage = WalletStorage(self.wallet.storage.path)
+        wallet = Imported_Wallet(storage)
+        # tuples are read back as lists
+        self.assertEqual(json.loads(json.dumps(self.wallet.txi)), wallet.txi)
+        self.assertEqual(json.loads(json.dumps(self.wallet.history)), wallet.history)
+        self.assertEqual(sorted(self.wallet.transactions.keys()), sorted(wallet.transactions.keys()))
+        self.assertEqual((100000, -40000, 0), wallet.get_balance())
+
+    def test_remove_transaction(self):
+        tx1 = make_tx([('aa' * 32, 0, FOREIGN)], [(ADDR1, 100000)])
+        self.receive('01' * 32, tx1, 10, [ADDR1])
+        self.assertEqual((100000, 0, 0), self.wallet.get_addr_balance(ADDR1))
+        # the server drops the transaction from the address history
+        self.wallet.receive_history_callback(ADDR1, [], {})
+        self.assertEqual((0, 0, 0), self.wallet.get_addr_balance(ADDR1))
+        self.assertEqual([], self.wallet.get_addr_utxo(ADDR1))
+
+    def test_change_while_computing(self):
+        # the network thread adds a transaction while another thread
+        # computes the balance: the stale result is not cached
+        tx1 = make_tx([('aa' * 32, 0, FOREIGN)], [(ADDR1, 100000)])
+        tx2 = make_tx([('bb' * 32, 0, FOREIGN)], [(ADDR1, 50000)])
+        self.receive('01' * 32, tx1, 10, [ADDR1])
+        get_addr_io = self.wallet.get_addr_io
+        def get_addr_io_racing(address):
+            result = get_addr_io(address)
+            self.wallet.get_addr_io = get_addr_io
+            self.receive('02' * 32, tx2, 11, [ADDR1])
+            return result
+        self.wallet.get_addr_io = get_addr_io_racing
+        self.assertEqual((100000, 0, 0), self.wallet.get_addr_balance(ADDR1))
+        self.assertEqual((150000, 0, 0), self.wallet.get_addr_balance(ADDR1))
+        self.wallet.get_addr_io = get_addr_io_racing
+        self.wallet.receive_history_callback(ADDR1, [('01' * 32, 10)], {})
+        self.assertEqual(1, len(self.wallet.get_addr_utxo(ADDR1)))
+        self.assertEqual(2, len(self.wallet.get_addr_utxo(ADDR1)))
+
+
+class TestSpentOutpoints(WalletHistoryTestCase):
+
+    def test_remove_and_readd_parent(self):
+        tx1 = make_tx([('aa' * 32, 0, FOREIGN)], [(ADDR1, 100000)])
+        tx2 = make_tx([('01' * 32, 0, ADDR1)], [(ADDR2, 60000)])
+        self.receive('01' * 32, tx1, 10, [ADDR1])
+        self.receive('02' * 32, tx2, 11, [ADDR1, ADDR2])
+        ser = '01' * 32 + ':0'
+        self.assertEqual({ser: '02' * 32}, self.wallet.spent_outpoints['01' * 32])
+
+        self.wallet.remove_transaction('01' * 32)
+        self.assertEqual({ser: '02' * 32}, self.wallet.pruned_txo)
+        self.assertEqual({}, self.wallet.txi['02' * 32])
+        self.assertTrue('02' * 32 in self.wallet.pruned_spends)
+        self.assertEqual(None, self.wallet.get_tx_delta('02' * 32, ADDR1))
+
+        # the parent shows up again and repairs the pruned input
+        self.wallet.add_transaction('01' * 32, tx1)
+        self.assertEqual({}, self.wallet.pruned_txo)
+        self.assertEqual({}, self.wallet.pruned_spends)
+        self.assertEqual({ADDR1: [(ser, 100000)]}, self.wallet.txi['02' * 32])
+        self.assertEqual(-100000, self.wallet.get_tx_delta('02' * 32, ADDR1))
+
+
+class TestWalletHistory(WalletHistoryTestCase):
+
+    def test_history_matches_domain_history(self):
+        tx1 = make_tx([('aa' * 32, 0, FOREIGN)], [(ADDR1, 100000)])
+        tx2 = make_tx([('01' * 32, 0, ADDR1)], [(ADDR2, 60000), (FOREIGN, 30000)])
+        self.receive('01' * 32, tx1, 10, [ADDR1])
+        self.receive('02' * 32, tx2, 0, [ADDR1, ADDR2])
+        domain = self.wallet.get_addresses()
+        self.assertEqual(self.wallet.get_history(domain), self.wallet.get_history())
+        self.assertEqual([('01' * 32, 10, 0, False, 100000, 100000),
+                          ('02' * 32, 0, 0, False, -40000, 60000)],
+                         self.wallet.get_history())
+
+        # cached history is updated when a transaction gets verified
+        self.wallet.receive_history_callback(ADDR1, [('01' * 32, 10), ('02' * 32, 5)], {})
+        self.wallet.receive_history_callback(ADDR2, [('02' * 32, 5)], {})
+        self.wallet.unverified_tx.pop('02' * 32)
+        with self.wallet.lock:
+            self.wallet.verified_tx['02' * 32] = (5, 1000, 1)
+        self.wallet.update_tx_position('02' * 32)
+        self.assertEqual([('02' * 32, 5, 0, 1000, -40000, -40000),
+                          ('01' * 32, 10, 0, False, 100000, 60000)],
+                         self.wallet.get_history())
+        self.assertEqual(self.wallet.get_history(domain), self.wallet.get_history())
+
+    def test_history_after_removal(self):
+        tx1 = make_tx([('aa' * 32, 0, FOREIGN)], [(ADDR1, 100000)])
+        self.receive('01' * 32, tx1, 10, [ADDR1])
+        self.assertEqual(1, len(self.wallet.get_history()))
+        self.wallet.receive_history_callback(ADDR1, [], {})
+        self.assertEqual([], self.wallet.get_history())
+
+    def test_delta_change_while_computing(self):
+        tx1 = make_tx([('aa' * 32, 0, FOREIGN)], [(ADDR1, 100000), (ADDR2, 50000)])
+        self.receive('01' * 32, tx1, 10, [ADDR1])
+        get_tx_delta = self.wallet.get_tx_delta
+        def get_tx_delta_racing(tx_hash, address):
+            result = get_tx_delta(tx_hash, address)
+            self.wallet.get_tx_delta = get_tx_delta
+            self.wallet.receive_history_callback(ADDR2, [('01' * 32, 10)], {})
+            return result
+        self.wallet.get_tx_delta = get_tx_delta_racing
+        self.assertEqual(100000, self.wallet.get_history_delta('01' * 32))
+        self.assertEqual(150000, self.wallet.get_history_delta('01' * 32))
+
+
+class TestAddressStatus(WalletHistoryTestCase):
+
+    def test_status(self):
+        self.assertIsNone(self.wallet.get_address_status(ADDR1))
+        tx1 = make_tx([('aa' * 32, 0, FOREIGN)], [(ADDR1, 100000)])
+        self.receive('01' * 32, tx1, 0, [ADDR1])
+        status = self.wallet.get_address_status(ADDR1)
+        self.assertEqual(history_status([('01' * 32, 0)]), status)
+        # histories read back from storage are lists
+        self.assertEqual(status, history_status([['01' * 32, 0]]))
+        # the transaction gets mined
+        self.wallet.receive_history_callback(ADDR1, [('01' * 32, 10)], {})
+        self.assertNotEqual(status, self.wallet.get_address_status(ADDR1))
+        self.assertEqual(history_status([('01' * 32, 10)]), self.wallet.get_address_status(ADDR1))
+        self.assertIsNone(self.wallet.get_address_status(ADDR2))
+        self.wallet.clear_history()
+        self.assertIsNone(self.wallet.get_address_status(ADDR1))
+
+    def test_server_status(self):
+        tx1 = make_tx([('aa' * 32, 0, FOREIGN)], [(ADDR1, 100000)])
+        self.receive('01' * 32, tx1, 10, [ADDR1])
+        status = history_status([('01' * 32, 10)])
+        self.wallet.set_server_status(ADDR1, status)
+        self.wallet.set_server_status(ADDR2, None)
+        self.assertEqual({ADDR1: status}, self.wallet.server_status)
+        self.wallet.storage.write()
+        # the saved status is used without hashing the history again
+        wallet = Imported_Wallet(WalletStorage(self.wallet.storage.path))
+        wallet.server_status[ADDR1] = 'saved'
+        self.assertEqual('saved', wallet.get_address_status(ADDR1))
+        # and dropped when the history changes
+        wallet.receive_history_callback(ADDR1, [], {})
+        self.assertEqual({}, wallet.server_status)
+        self.assertIsNone(wallet.get_address_status(ADDR1))
+
+
+class TestCoalescedWrites(WalletHistoryTestCase):
+
+    def setUp(self):
+        super(TestCoalescedWrites, self).setUp()
+        self.writes = 0
+        write = self.wallet.storage.write
+        def count_write():
+            self.writes += 1
+            write()
+        self.wallet.storage.write = count_write
+        self.wallet.write_batch = 20
+        self.wallet.write_interval = 3600
+
+    def receive_many(self, n):
+        for i in range(n):
+            tx = make_tx([('%064x' % (i + 1), 0, FOREIGN)], [(ADDR1, 100000)])
+            self.receive('%064x' % (1000 + i), tx, 10, [ADDR1])
+
+    def test_batch(self):
+        # two changes per transaction: history and transaction
+        self.receive_many(25)
+        self.assertEqual(2, self.writes)
+        self.assertEqual(10, self.wallet.unsaved_changes)
+        self.wallet.write_storage_if_due()
+        self.assertEqual(2, self.writes)
+        self.wallet.stop_threads()
+        self.assertEqual(3, self.writes)
+        self.assertEqual(0, self.wallet.unsaved_changes)
+        wallet = Imported_Wallet(WalletStorage(self.wallet.storage.path))
+        self.assertEqual(25, len(wallet.transactions))
+
+    def test_interval(self):
+        self.receive_many(1)
+        self.assertEqual(0, self.writes)
+        self.wallet.last_write -= 3600
+        self.wallet.write_storage_if_due()
+        self.assertEqual(1, self.writes)
+        self.wallet.write_storage_if_due()
+        self.assertEqual(1, self.writes)
+
+    def test_up_to_date(self):
+        self.receive_many(1)
+        self.wallet.set_up_to_date(True)
+        self.assertEqual(1, self.writes)
+
+
+class TestTransactionCache(unittest.TestCase):
+
+    def test_cache(self):
+        raw = {}
+        txs = TransactionCache(raw, maxsize=2)
+        tx1 = make_tx([('aa' * 32, 0, FOREIGN)], [(ADDR1, 100000)])
+        tx2 = make_tx([('bb' * 32, 0, FOREIGN)], [(ADDR1, 200000)])
+        txs['01' * 32] = tx1
+        txs['02' * 32] = tx2
+        self.assertEqual(str(tx1), raw['01' * 32])
+        self.assertTrue(txs['01' * 32] is tx1)
+        # transactions dropped from the cache are parsed again
+        txs.cache.clear()
+        tx = txs.get('02' * 32)
+        self.assertFalse(tx is tx2)
+        self.assertEqual(str(tx2), str(tx))
+        self.assertTrue(txs.get('02' * 32) is tx)
+        self.assertEqual(None, txs.get('03' * 32))
+        self.assertRaises(KeyError, lambda: txs['03' * 32])
+
+        self.assertEqual(str(tx1), str(txs.pop('01' * 32)))
+        self.assertEqual(['02' * 32], txs.keys())
+        self.assertFalse('01' * 32 in txs)
+        self.assertEqual(None, txs.pop('01' * 32, None))
+        self.assertEqual(1, len(txs))
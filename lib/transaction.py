@@ -396,6 +396,12 @@ def parse_scriptSig(d, bytes):
 
 
 def get_address_from_output_script(bytes):
+    # standard scripts, without decoding them
+    if len(bytes) == 25 and bytes[0:3] == '\x76\xa9\x14' and bytes[23:25] == '\x88\xac':
+        return TYPE_ADDRESS, hash_160_to_bc_address(bytes[3:23])
+    if len(bytes) == 23 and bytes[0:2] == '\xa9\x14' and bytes[22] == '\x87':
+        return TYPE_ADDRESS, hash_160_to_bc_address(bytes[2:22], 5)
+
     decoded = [ x for x in script_GetOp(bytes) ]
 
     # The Genesis Block, self-payments, and pay-by-IP-address payments look like:
@@ -421,13 +427,69 @@ def get_address_from_output_script(bytes):
 
 
 
-def parse_input(vds):
+UINT16 = struct.Struct('<H')
+UINT32 = struct.Struct('<I')
+INT32 = struct.Struct('<i')
+UINT64 = struct.Struct('<Q')
+INT64 = struct.Struct('<q')
+
+
+def read_compact_size(buf, pos):
+    '''Returns the compact size at pos in buf, and the position
+    after it.'''
+    size = ord(buf[pos])
+    if size < 253:
+        return size, pos + 1
+    elif size == 253:
+        return UINT16.unpack_from(buf, pos + 1)[0], pos + 3
+    elif size == 254:
+        return UINT32.unpack_from(buf, pos + 1)[0], pos + 5
+    else:
+        return UINT64.unpack_from(buf, pos + 1)[0], pos + 9
+
+
+def compact_size(size):
+    if size < 253:
+        return chr(size)
+    elif size < 2**16:
+        return '\xfd' + UINT16.pack(size)
+    elif size < 2**32:
+        return '\xfe' + UINT32.pack(size)
+    else:
+        return '\xff' + UINT64.pack(size)
+
+
+def push_data(data):
+    '''Bytes version of push_script'''
+    n = len(data)
+    if n < 0x4c:
+        return chr(n) + data
+    elif n < 0xff:
+        return '\x4c' + chr(n) + data
+    elif n < 0xffff:
+        return '\x4d' + UINT16.pack(n) + data
+    else:
+        return '\x4e' + UINT32.pack(n) + data
+
+
+def read_bytes(buf, pos, length):
+    end = pos + length
+    if end > len(buf):
+        raise SerializationError("attempt to read past end of buffer")
+    return buf[pos:end], end
+
+
+def parse_input(buf, pos):
+    '''Parses the input at pos in buf.  Returns it as a dict, and the
+    position of the next input.'''
     d = {}
-    prevout_hash = hash_encode(vds.read_bytes(32))
-    prevout_n = vds.read_uint32()
-    scriptSig = vds.read_bytes(vds.read_compact_size())
+    prevout_hash, pos = read_bytes(buf, pos, 32)
+    prevout_hash = prevout_hash[::-1].encode('hex')
+    prevout_n = UINT32.unpack_from(buf, pos)[0]
+    size, pos = read_compact_size(buf, pos + 4)
+    scriptSig, pos = read_bytes(buf, pos, size)
     d['scriptSig'] = scriptSig.encode('hex')
-    sequence = vds.read_uint32()
+    sequence = UINT32.unpack_from(buf, pos)[0]
     if prevout_hash == '00'*32:
         d['is_coinbase'] = True
     else:
@@ -440,37 +502,106 @@ def parse_input(vds):
         d['address'] = None
         if scriptSig:
             parse_scriptSig(d, scriptSig)
-    return d
+    return d, pos + 4
 
 
-def parse_output(vds, i):
+def parse_output(buf, pos, i):
+    '''Parses output number i at pos in buf.  Returns it as a dict,
+    and the position of the next output.'''
     d = {}
-    d['value'] = vds.read_int64()
-    scriptPubKey = vds.read_bytes(vds.read_compact_size())
+    d['value'] = INT64.unpack_from(buf, pos)[0]
+    size, pos = read_compact_size(buf, pos + 8)
+    scriptPubKey, pos = read_bytes(buf, pos, size)
     d['type'], d['address'] = get_address_from_output_script(scriptPubKey)
     d['scriptPubKey'] = scriptPubKey.encode('hex')
     d['prevout_n'] = i
-    return d
+    return d, pos
 
 
-def deserialize(raw):
-    vds = BCDataStream()
-    vds.write(raw.decode('hex'))
+def iter_inputs(buf, pos):
+    n, pos = read_compact_size(buf, pos)
+    for i in xrange(n):
+        d, pos = parse_input(buf, pos)
+        yield d, pos
+
+
+def iter_outputs(buf, pos):
+    n, pos = read_compact_size(buf, pos)
+    for i in xrange(n):
+        d, pos = parse_output(buf, pos, i)
+        yield d, pos
+
+
+def deserialize_bytes(buf):
+    '''Parses a serialized transaction.  Scripts, hashes and keys in
+    the result are hex encoded.'''
     d = {}
-    start = vds.read_cursor
-    d['version'] = vds.read_int32()
-    n_vin = vds.read_compact_size()
-    d['inputs'] = list(parse_input(vds) for i in xrange(n_vin))
-    n_vout = vds.read_compact_size()
-    d['outputs'] = list(parse_output(vds,i) for i in xrange(n_vout))
-    d['lockTime'] = vds.read_uint32()
+    d['version'] = INT32.unpack_from(buf, 0)[0]
+    pos = 4
+    d['inputs'] = []
+    for txin, pos in iter_inputs(buf, pos):
+        d['inputs'].append(txin)
+    d['outputs'] = []
+    for txout, pos in iter_outputs(buf, pos):
+        d['outputs'].append(txout)
+    d['lockTime'] = UINT32.unpack_from(buf, pos)[0]
     return d
 
 
+def deserialize(raw):
+    return deserialize_bytes(raw.decode('hex'))
+
+
 def push_script(x):
     return op_push(len(x)/2) + x
 
 
+class SigHasher(object):
+    '''Computes the hashes signed by the inputs of a transaction
+    (SIGHASH_ALL).  These serializations only differ in the script of
+    the signed input, the other scripts being empty; the rest is
+    serialized once and shared by all inputs.'''
+
+    def __init__(self, tx):
+        self.tx = tx
+        inputs = tx.inputs()
+        outputs = tx.outputs()
+        self.outpoints = [txin['prevout_hash'].decode('hex')[::-1] + UINT32.pack(txin['prevout_n'])
+                          for txin in inputs]
+        self.sequences = [UINT32.pack(txin.get('sequence', 0xffffffff)) for txin in inputs]
+        # inputs with an empty script, 41 bytes each
+        self.empty = ''.join(o + '\x00' + seq for o, seq in zip(self.outpoints, self.sequences))
+        self.prefix = hashlib.sha256(INT32.pack(1) + compact_size(len(inputs)))
+        self.prefix_pos = 0
+        s = [compact_size(len(outputs))]
+        for output_type, addr, amount in outputs:
+            script = tx.pay_script_bytes(output_type, addr)
+            s.append(INT64.pack(amount) + compact_size(len(script)) + script)
+        s.append(UINT32.pack(tx.locktime))
+        s.append(INT32.pack(1))                                      # hash type
+        self.suffix = ''.join(s)
+
+    def script(self, txin):
+        if txin.get('redeemScript') is not None:
+            return txin['redeemScript'].decode('hex')
+        return self.tx.pay_script_bytes(TYPE_ADDRESS, txin['address'])
+
+    def digest(self, i):
+        '''Hash signed by input i.  Cheapest when called in input
+        order.'''
+        if i < self.prefix_pos:
+            self.prefix = hashlib.sha256(INT32.pack(1) + compact_size(len(self.outpoints)))
+            self.prefix_pos = 0
+        self.prefix.update(buffer(self.empty, 41 * self.prefix_pos, 41 * (i - self.prefix_pos)))
+        self.prefix_pos = i
+        h = self.prefix.copy()
+        script = self.script(self.tx.inputs()[i])
+        h.update(self.outpoints[i] + compact_size(len(script)) + script + self.sequences[i])
+        h.update(buffer(self.empty, 41 * (i + 1)))
+        h.update(self.suffix)
+        return hashlib.sha256(h.digest()).digest()
+
+
 class Transaction:
 
     def __str__(self):
@@ -509,24 +640,28 @@ class Transaction:
     def update_signatures(self, raw):
         """Add new signatures to a transaction"""
         d = deserialize(raw)
+        hasher = SigHasher(self)
         for i, txin in enumerate(self.inputs()):
             sigs1 = txin.get('signatures')
             sigs2 = d['inputs'][i].get('signatures')
             for sig in sigs2:
                 if sig in sigs1:
                     continue
-                for_sig = Hash(self.tx_for_sig(i).decode('hex'))
+                for_sig = hasher.digest(i)
                 # der to string
                 order = ecdsa.ecdsa.generator_secp256k1.order()
                 r, s = ecdsa.util.sigdecode_der(sig.decode('hex'), order)
-                sig_string = ecdsa.util.sigencode_string(r, s, order)
                 pubkeys = txin.get('pubkeys')
                 compressed = True
                 for recid in range(4):
-                    public_key = MyVerifyingKey.from_signature(sig_string, recid, for_sig, curve = SECP256k1)
-                    pubkey = point_to_ser(public_key.pubkey.point, compressed).encode('hex')
+                    try:
+                        public_key = ecc.recover(for_sig, r, s, recid, compressed)
+                    except ValueError:
+                        continue
+                    pubkey = public_key.encode('hex')
                     if pubkey in pubkeys:
-                        public_key.verify_digest(sig_string, for_sig, sigdecode = ecdsa.util.sigdecode_string)
+                        if not ecc.verify(public_key, for_sig, r, s):
+                            raise Exception("Bad signature")
                         j = pubkeys.index(pubkey)
                         print_error("adding sig", i, j, pubkey, sig)
                         self._inputs[i]['signatures'][j] = sig
@@ -598,18 +733,20 @@ class Transaction:
 
     @classmethod
     def pay_script(self, output_type, addr):
+        return self.pay_script_bytes(output_type, addr).encode('hex')
+
+    @classmethod
+    def pay_script_bytes(self, output_type, addr):
         if output_type == TYPE_SCRIPT:
-            return addr.encode('hex')
+            return addr
         elif output_type == TYPE_ADDRESS:
             addrtype, hash_160 = bc_address_to_hash_160(addr)
             if addrtype == 0:
-                script = '76a9'                                      # op_dup, op_hash_160
-                script += push_script(hash_160.encode('hex'))
-                script += '88ac'                                     # op_equalverify, op_checksig
+                # op_dup, op_hash_160, hash, op_equalverify, op_checksig
+                script = '\x76\xa9' + push_data(hash_160) + '\x88\xac'
             elif addrtype == 5:
-                script = 'a9'                                        # op_hash_160
-                script += push_script(hash_160.encode('hex'))
-                script += '87'                                       # op_equal
+                # op_hash_160, hash, op_equal
+                script = '\xa9' + push_data(hash_160) + '\x87'
             else:
                 raise
         else:
@@ -665,15 +802,21 @@ class Transaction:
 
     @classmethod
     def serialize_input(self, txin, i, for_sig):
-        # Prev hash and index
-        s = txin['prevout_hash'].decode('hex')[::-1].encode('hex')
-        s += int_to_hex(txin['prevout_n'], 4)
-        # Script length, script, sequence
-        script = self.input_script(txin, i, for_sig)
-        s += var_int(len(script)/2)
-        s += script
-        s += int_to_hex(txin.get('sequence', 0xffffffff), 4)
-        return s
+        return self.serialize_input_bytes(txin, i, for_sig).encode('hex')
+
+    @classmethod
+    def serialize_input_bytes(self, txin, i, for_sig):
+        if i >= 0 and for_sig == i and txin.get('redeemScript') is None:
+            script = self.pay_script_bytes(TYPE_ADDRESS, txin['address'])
+        else:
+            script = self.input_script(txin, i, for_sig).decode('hex')
+        return ''.join([
+            txin['prevout_hash'].decode('hex')[::-1],                # prev hash
+            UINT32.pack(txin['prevout_n']),                          # prev index
+            compact_size(len(script)),
+            script,
+            UINT32.pack(txin.get('sequence', 0xffffffff)),
+        ])
 
     def set_sequence(self, n):
         for txin in self.inputs():
@@ -685,23 +828,25 @@ class Transaction:
         self._outputs.sort(key = lambda o: (o[2], self.pay_script(o[0], o[1])))
 
     def serialize(self, for_sig=None):
+        return self.serialize_bytes(for_sig).encode('hex')
+
+    def serialize_bytes(self, for_sig=None):
         inputs = self.inputs()
         outputs = self.outputs()
-        s = int_to_hex(1, 4)                                         # version
-        s += var_int(len(inputs))                                    # number of inputs
+        s = [INT32.pack(1)]                                          # version
+        s.append(compact_size(len(inputs)))                          # number of inputs
         for i, txin in enumerate(inputs):
-            s += self.serialize_input(txin, i, for_sig)
-        s += var_int(len(outputs))                                   # number of outputs
-        for output in outputs:
-            output_type, addr, amount = output
-            s += int_to_hex(amount, 8)                               # amount
-            script = self.pay_script(output_type, addr)
-            s += var_int(len(script)/2)                              #  script length
-            s += script                                              #  script
-        s += int_to_hex(self.locktime, 4)                            #  locktime
+            s.append(self.serialize_input_bytes(txin, i, for_sig))
+        s.append(compact_size(len(outputs)))                         # number of outputs
+        for output_type, addr, amount in outputs:
+            script = self.pay_script_bytes(output_type, addr)
+            s.append(INT64.pack(amount))                             # amount
+            s.append(compact_size(len(script)))                      # script length
+            s.append(script)                                         # script
+        s.append(UINT32.pack(self.locktime))                         # locktime
         if for_sig is not None and for_sig != -1:
-            s += int_to_hex(1, 4)                                    #  hash type
-        return s
+            s.append(INT32.pack(1))                                  # hash type
+        return ''.join(s)
 
     def tx_for_sig(self,i):
         return self.serialize(for_sig = i)
@@ -732,12 +877,12 @@ class Transaction:
     @profiler
     def estimated_size(self):
         '''Return an estimated tx size in bytes.'''
-        return len(self.serialize(-1)) / 2  # ASCII hex string
+        return len(self.serialize_bytes(-1))
 
     @classmethod
     def estimated_input_size(self, txin):
         '''Return an estimated of serialized input size in bytes.'''
-        return len(self.serialize_input(txin, -1, -1)) / 2
+        return len(self.serialize_input_bytes(txin, -1, -1))
 
     def signature_count(self):
         r = 0
@@ -763,6 +908,9 @@ class Transaction:
 
 
     def sign(self, keypairs):
+        hasher = SigHasher(self)
+        # x_pubkey -> (pubkey, secret, serialized public key)
+        keys = {}
         for i, txin in enumerate(self.inputs()):
             num = txin['num_sig']
             for x_pubkey in txin['x_pubkeys']:
@@ -770,30 +918,30 @@ class Transaction:
                 if len(signatures) == num:
                     # txin is complete
                     break
-                if x_pubkey in keypairs.keys():
+                if x_pubkey in keypairs:
                     print_error("adding signature for", x_pubkey)
+                    if x_pubkey not in keys:
+                        keys[x_pubkey] = self.signing_key(keypairs[x_pubkey])
+                    pubkey, secret, public_key = keys[x_pubkey]
                     # add pubkey to txin
-                    txin = self._inputs[i]
-                    x_pubkeys = txin['x_pubkeys']
-                    ii = x_pubkeys.index(x_pubkey)
-                    sec = keypairs[x_pubkey]
-                    pubkey = public_key_from_private_key(sec)
+                    ii = txin['x_pubkeys'].index(x_pubkey)
                     txin['x_pubkeys'][ii] = pubkey
                     txin['pubkeys'][ii] = pubkey
-                    self._inputs[i] = txin
                     # add signature
-                    for_sig = Hash(self.tx_for_sig(i).decode('hex'))
-                    pkey = regenerate_key(sec)
-                    secexp = pkey.secret
-                    private_key = bitcoin.MySigningKey.from_secret_exponent( secexp, curve = SECP256k1 )
-                    public_key = private_key.get_verifying_key()
-                    sig = private_key.sign_digest_deterministic( for_sig, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_der )
-                    assert public_key.verify_digest( sig, for_sig, sigdecode = ecdsa.util.sigdecode_der)
+                    for_sig = hasher.digest(i)
+                    r, s = ecc.sign(secret, for_sig)
+                    assert ecc.verify(public_key, for_sig, r, s)
+                    sig = ecdsa.util.sigencode_der(r, s, ecdsa.ecdsa.generator_secp256k1.order())
                     txin['signatures'][ii] = sig.encode('hex')
-                    self._inputs[i] = txin
         print_error("is_complete", self.is_complete())
         self.raw = self.serialize()
 
+    @classmethod
+    def signing_key(self, sec):
+        pkey = regenerate_key(sec)
+        compressed = is_compressed(sec)
+        public_key = pkey.get_public_key_bytes(compressed)
+        return public_key.encode('hex'), pkey.secret, public_key
 
     def get_outputs(self):
         """convert pubkeys to addresses"""
@@ -831,7 +979,7 @@ class Transaction:
         # see https://en.bitcoin.it/wiki/Transaction_fees
         #
         # size must be smaller than 1 kbyte for free tx
-        size = len(self.serialize(-1))/2
+        size = len(self.serialize_bytes(-1))
         if size >= 10000:
             return True
         # all outputs must be 0.01 BTC or larger for free tx
@@ -26,7 +26,7 @@
 import os, sys, re, json
 import platform
 import shutil
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from datetime import datetime
 from decimal import Decimal
 import traceback
@@ -511,9 +511,16 @@ import time
 
 class SocketPipe:
 
+    # bytes requested from the socket at once
+    recv_size = 65536
+
     def __init__(self, socket):
         self.socket = socket
-        self.message = ''
+        # Received data.  Messages before pos have been returned, and
+        # there is no newline between pos and scan.
+        self.buf = bytearray()
+        self.pos = 0
+        self.scan = 0
         self.set_timeout(0.1)
         self.recv_time = time.time()
 
@@ -523,13 +530,31 @@ class SocketPipe:
     def idle_time(self):
         return time.time() - self.recv_time
 
+    def parse_message(self):
+        '''Returns the next complete message in the buffer, or None.
+        Lines that are not valid JSON are skipped.'''
+        while True:
+            n = self.buf.find('\n', self.scan)
+            if n == -1:
+                # drop consumed data; only a partial message is moved
+                self.scan = len(self.buf) - self.pos
+                del self.buf[:self.pos]
+                self.pos = 0
+                return None
+            line = str(buffer(self.buf, self.pos, n - self.pos))
+            self.pos = self.scan = n + 1
+            try:
+                return json.loads(line)
+            except:
+                continue
+
     def get(self):
         while True:
-            response, self.message = parse_json(self.message)
+            response = self.parse_message()
             if response is not None:
                 return response
             try:
-                data = self.socket.recv(1024)
+                data = self.socket.recv(self.recv_size)
             except socket.timeout:
                 raise timeout
             except ssl.SSLError:
@@ -550,7 +575,7 @@ class SocketPipe:
 
             if not data:  # Connection closed remotely
                 return None
-            self.message += data
+            self.buf += data
             self.recv_time = time.time()
 
     def send(self, request):
@@ -622,6 +647,46 @@ class QueuePipe:
 
 
 
+class LRUCache(object):
+    '''A dict-like cache that keeps at most maxsize items, evicting
+    the least recently used one.'''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+            self.items[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.items.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
 class StoreDict(dict):
 
     def __init__(self, config, name):
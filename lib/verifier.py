@@ -24,6 +24,9 @@
 # SOFTWARE.
 
 
+import time
+from collections import defaultdict
+
 from util import ThreadJob
 from bitcoin import *
 
@@ -31,51 +34,121 @@ from bitcoin import *
 class SPV(ThreadJob):
     """ Simple Payment Verification """
 
+    # maximum number of merkle branch requests awaiting an answer
+    max_inflight = 200
+    # seconds before a merkle branch is requested again after an error
+    retry_delay = 60
+
     def __init__(self, network, wallet):
         self.wallet = wallet
         self.network = network
         # Keyed by tx hash.  Value is None if the merkle branch was
         # requested, and the merkle root once it has been verified
         self.merkle_roots = {}
+        self.inflight = 0
+        # tx hash -> (tx height, time) of the next request, after an error
+        self.retry_after = {}
+        # Received merkle branches waiting to be checked, keyed by
+        # block height so that txs of a block share the header lookup
+        self.pending = defaultdict(list)
+        # throughput statistics
+        self.num_verified = 0
+        self.verify_time = 0.
 
     def run(self):
+        self.verify_pending()
+        self.request_merkle_branches()
+
+    def request_merkle_branches(self):
+        n = self.max_inflight - self.inflight
+        if n <= 0:
+            return
         lh = self.network.get_local_height()
         unverified = self.wallet.get_unverified_txs()
-        for tx_hash, tx_height in unverified.items():
-            # do not request merkle branch before headers are available
-            if tx_height>0 and tx_hash not in self.merkle_roots and tx_height <= lh:
-                request = ('blockchain.transaction.get_merkle',
-                           [tx_hash, tx_height])
-                self.network.send([request], self.verify_merkle)
-                self.print_error('requested merkle', tx_hash)
-                self.merkle_roots[tx_hash] = None
+        now = time.time()
+        # do not request merkle branch before headers are available
+        todo = [(tx_height, tx_hash) for tx_hash, tx_height in unverified.items()
+                if tx_height > 0 and tx_hash not in self.merkle_roots and tx_height <= lh
+                and not self.must_wait(tx_hash, tx_height, now)]
+        if not todo:
+            return
+        # request by increasing height, so that answers for the same
+        # block arrive together
+        todo.sort()
+        requests = []
+        for tx_height, tx_hash in todo[:n]:
+            requests.append(('blockchain.transaction.get_merkle', [tx_hash, tx_height]))
+            self.merkle_roots[tx_hash] = None
+        self.network.send(requests, self.verify_merkle)
+        self.inflight += len(requests)
+        self.print_error('requested %d merkle branches' % len(requests))
+
+    def must_wait(self, tx_hash, tx_height, now):
+        '''After an error, the merkle branch of a tx is requested again
+        once retry_delay has passed, or if its height changed.'''
+        retry = self.retry_after.get(tx_hash)
+        if retry is None:
+            return False
+        if retry[0] != tx_height or now >= retry[1]:
+            self.retry_after.pop(tx_hash)
+            return False
+        return True
 
     def verify_merkle(self, r):
+        self.inflight -= 1
         if r.get('error'):
             self.print_error('received an error:', r)
+            # ask again later, see must_wait
+            tx_hash, tx_height = r['params']
+            self.merkle_roots.pop(tx_hash, None)
+            self.retry_after[tx_hash] = (tx_height, time.time() + self.retry_delay)
             return
 
         params = r['params']
         merkle = r['result']
+        tx_hash = params[0]
+        tx_height = merkle.get('block_height')
+        self.pending[tx_height].append((tx_hash, merkle))
+        # check the proofs now if no other answer is expected soon
+        if self.inflight == 0:
+            self.verify_pending()
+
+    def verify_pending(self):
+        if not self.pending:
+            return
+        t0 = time.time()
+        n = 0
+        pending, self.pending = self.pending, defaultdict(list)
+        for tx_height in sorted(pending.keys()):
+            header = self.network.get_header(tx_height)
+            for tx_hash, merkle in pending[tx_height]:
+                if self.verify_tx(tx_hash, tx_height, merkle, header):
+                    n += 1
+        self.num_verified += n
+        self.verify_time += time.time() - t0
+        self.print_error("verified %d txs in %d blocks (%.0f tx/s)"
+                         % (n, len(pending), self.get_throughput()))
+
+    def get_throughput(self):
+        '''Verified transactions per second of verification time.'''
+        return self.num_verified / self.verify_time if self.verify_time else 0.
 
+    def verify_tx(self, tx_hash, tx_height, merkle, header):
         # Verify the hash of the server-provided merkle branch to a
         # transaction matches the merkle root of its block
-        tx_hash = params[0]
-        tx_height = merkle.get('block_height')
         pos = merkle.get('pos')
         merkle_root = self.hash_merkle_root(merkle['merkle'], tx_hash, pos)
-        header = self.network.get_header(tx_height)
         if not header or header.get('merkle_root') != merkle_root:
             # FIXME: we should make a fresh connection to a server to
             # recover from this, as this TX will now never verify
             self.print_error("merkle verification failed for", tx_hash)
-            return
+            return False
 
         # we passed all the tests
         self.merkle_roots[tx_hash] = merkle_root
         self.print_error("verified %s" % tx_hash)
         self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos))
-
+        return True
 
     def hash_merkle_root(self, merkle_s, target_hash, pos):
         h = hash_decode(target_hash)
@@ -41,11 +41,12 @@ import json
 import copy
 import re
 import stat
+import bisect
 from functools import partial
 from collections import namedtuple, defaultdict
 
 from i18n import _
-from util import NotEnoughFunds, PrintError, profiler
+from util import NotEnoughFunds, PrintError, profiler, LRUCache
 
 from bitcoin import *
 from version import *
@@ -55,7 +56,7 @@ from transaction import Transaction
 from plugins import run_hook
 import bitcoin
 import coinchooser
-from synchronizer import Synchronizer
+from synchronizer import Synchronizer, history_status
 from verifier import SPV
 from mnemonic import Mnemonic
 
@@ -71,6 +72,71 @@ TX_STATUS = [
     _('Not Verified'),
 ]
 
+# number of Transaction objects kept in memory
+TX_CACHE_SIZE = 1000
+
+# changes to transaction data are written to disk after this many
+# seconds, or once this many changes are pending
+WRITE_INTERVAL = 30
+WRITE_BATCH = 1000
+
+
+class TransactionCache(object):
+    '''Maps tx hashes to Transaction objects.  Raw transactions stay in
+    the storage dict; Transaction objects are created when accessed,
+    and only the most recently used ones are kept.'''
+
+    def __init__(self, raw_transactions, maxsize=TX_CACHE_SIZE):
+        self.raw_transactions = raw_transactions
+        self.cache = LRUCache(maxsize)
+        # The JSON decoder returns unicode strings, which use 4 bytes
+        # per hex digit.  Keep byte strings instead; this does not
+        # change the wallet file.
+        for tx_hash, raw in dict.items(raw_transactions):
+            if type(raw) is unicode:
+                dict.__setitem__(raw_transactions, tx_hash, str(raw))
+
+    def get(self, tx_hash, default=None):
+        tx = self.cache.get(tx_hash)
+        if tx is None:
+            raw = self.raw_transactions.get(tx_hash)
+            if raw is None:
+                return default
+            tx = Transaction(raw)
+            self.cache[tx_hash] = tx
+        return tx
+
+    def __getitem__(self, tx_hash):
+        tx = self.get(tx_hash)
+        if tx is None:
+            raise KeyError(tx_hash)
+        return tx
+
+    def __setitem__(self, tx_hash, tx):
+        self.raw_transactions[tx_hash] = str(tx)
+        self.cache[tx_hash] = tx
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.raw_transactions
+
+    def __len__(self):
+        return len(self.raw_transactions)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return self.raw_transactions.keys()
+
+    def pop(self, tx_hash, *args):
+        tx = self.cache.pop(tx_hash)
+        raw = self.raw_transactions.pop(tx_hash, None)
+        if raw is None:
+            if args:
+                return args[0]
+            raise KeyError(tx_hash)
+        return tx if tx is not None else Transaction(raw)
+
 
 
 class Abstract_Wallet(PrintError):
@@ -90,13 +156,42 @@ class Abstract_Wallet(PrintError):
         self.verifier = None
 
         self.gap_limit_for_change = 6 # constant
+        # coalesced writes, see save_transactions
+        self.write_interval = WRITE_INTERVAL
+        self.write_batch = WRITE_BATCH
+        self.unsaved_changes = 0
+        self.last_write = time.time()
         # saved fields
         self.use_change            = storage.get('use_change', True)
         self.multiple_change       = storage.get('multiple_change', False)
         self.labels                = storage.get('labels', {})
         self.frozen_addresses      = set(storage.get('frozen_addresses',[]))
         self.stored_height         = storage.get('stored_height', 0)       # last known height (for offline mode)
-        self.history               = storage.get('addr_history',{})        # address -> list(txid, height)
+        self.history               = storage.get_dict('addr_history')      # address -> list(txid, height)
+        self.server_status         = storage.get_dict('addr_status')       # address -> status, see set_server_status
+
+        # Per-address caches of unspent outputs and balances.  Entries
+        # are dropped by invalidate_addr_cache when txi, txo or history
+        # change for an address, and rebuilt on the next query.
+        self.utxo_cache = {}
+        self.balance_cache = {}
+        # Incremented, under transaction_lock, whenever entries of the
+        # address or delta caches are dropped.  A value computed by
+        # another thread is only stored if it did not change meanwhile,
+        # see cache_value.
+        self.cache_version = 0
+        # address -> status of its history, see get_address_status.
+        # Entries are dropped when the history changes.
+        self.status_cache = {}
+
+        # Wallet history engine: transactions sorted by position, their
+        # cached deltas, and the last result of get_history.  The cache
+        # is valid while history_version and the local height match.
+        self.sorted_history = None   # list of (txpos, tx_hash)
+        self.tx_positions = {}
+        self.tx_deltas = {}
+        self.history_version = 0
+        self.history_cache = None
 
         self.load_keystore()
         self.load_addresses()
@@ -111,14 +206,16 @@ class Abstract_Wallet(PrintError):
         self.unverified_tx = defaultdict(int)
 
         # Verified transactions.  Each value is a (height, timestamp, block_pos) tuple.  Access with self.lock.
-        self.verified_tx = storage.get('verified_tx3', {})
+        self.verified_tx = storage.get_dict('verified_tx3')
 
         # there is a difference between wallet.up_to_date and interface.is_up_to_date()
         # interface.is_up_to_date() returns true when all requests have been answered and processed
         # wallet.up_to_date is true when the wallet is synchronized (stronger requirement)
         self.up_to_date = False
         self.lock = threading.Lock()
-        self.transaction_lock = threading.Lock()
+        # txi, txo etc. are modified in place, and serialized by
+        # storage.write: share its lock
+        self.transaction_lock = storage.lock
 
         self.check_history()
 
@@ -137,44 +234,67 @@ class Abstract_Wallet(PrintError):
 
     @profiler
     def load_transactions(self):
-        self.txi = self.storage.get('txi', {})
-        self.txo = self.storage.get('txo', {})
-        self.tx_fees = self.storage.get('tx_fees', {})
-        self.pruned_txo = self.storage.get('pruned_txo', {})
-        tx_list = self.storage.get('transactions', {})
-        self.transactions = {}
-        for tx_hash, raw in tx_list.items():
-            tx = Transaction(raw)
-            self.transactions[tx_hash] = tx
-            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in self.pruned_txo.values()):
+        # These dicts are owned by the storage and updated in place
+        self.txi = self.storage.get_dict('txi')
+        self.txo = self.storage.get_dict('txo')
+        self.tx_fees = self.storage.get_dict('tx_fees')
+        self.pruned_txo = self.storage.get_dict('pruned_txo')
+        self.build_spent_outpoints()
+        # Transactions are parsed when they are accessed
+        self.transactions = TransactionCache(self.storage.get_dict('transactions'))
+        for tx_hash in self.transactions.keys():
+            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in self.pruned_spends):
                 self.print_error("removing unreferenced tx", tx_hash)
-                self.transactions.pop(tx_hash)
+                self.pop_transaction(tx_hash)
+
+    def pop_transaction(self, tx_hash):
+        return self.transactions.pop(tx_hash)
 
-    @profiler
     def save_transactions(self, write=False):
+        '''Transaction data is kept in storage dicts, which are
+        serialized when the storage is written.  Writes are coalesced:
+        unless write is set, the storage is only written once
+        write_batch changes are pending, or write_interval seconds
+        after the last write.'''
+        with self.transaction_lock:
+            self.unsaved_changes += 1
+        if write:
+            self.write_storage()
+        else:
+            self.write_storage_if_due()
+
+    def write_storage_if_due(self):
+        if self.unsaved_changes and (self.unsaved_changes >= self.write_batch
+                                     or time.time() - self.last_write >= self.write_interval):
+            self.write_storage()
+
+    def write_storage(self):
         with self.transaction_lock:
-            tx = {}
-            for k,v in self.transactions.items():
-                tx[k] = str(v)
-            self.storage.put('transactions', tx)
-            self.storage.put('txi', self.txi)
-            self.storage.put('txo', self.txo)
-            self.storage.put('tx_fees', self.tx_fees)
-            self.storage.put('pruned_txo', self.pruned_txo)
-            self.storage.put('addr_history', self.history)
-            if write:
-                self.storage.write()
+            self.storage.write()
+            self.unsaved_changes = 0
+            self.last_write = time.time()
 
     def clear_history(self):
         with self.transaction_lock:
-            self.txi = {}
-            self.txo = {}
-            self.tx_fees = {}
-            self.pruned_txo = {}
-        self.save_transactions()
+            self.txi.clear()
+            self.txo.clear()
+            self.tx_fees.clear()
+            self.pruned_txo.clear()
+            self.spent_outpoints = {}
+            self.pruned_spends = {}
         with self.lock:
-            self.history = {}
+            self.history.clear()
             self.tx_addr_hist = {}
+            self.sorted_history = None
+            self.tx_positions = {}
+            self.history_version += 1
+            self.status_cache = {}
+            self.server_status.clear()
+        with self.transaction_lock:
+            self.cache_version += 1
+            self.tx_deltas = {}
+            self.utxo_cache = {}
+            self.balance_cache = {}
 
     @profiler
     def build_reverse_history(self):
@@ -185,17 +305,55 @@ class Abstract_Wallet(PrintError):
                 s.add(addr)
                 self.tx_addr_hist[tx_hash] = s
 
+    @profiler
+    def build_spent_outpoints(self):
+        # prevout_hash -> {ser: tx_hash}, for the coins spent in txi
+        self.spent_outpoints = {}
+        for tx_hash, d in self.txi.items():
+            for addr, l in d.items():
+                for ser, v in l:
+                    self.add_spent_outpoint(ser, tx_hash)
+        # tx_hash -> set(ser), reverse of pruned_txo
+        self.pruned_spends = {}
+        for ser, tx_hash in self.pruned_txo.items():
+            self.pruned_spends.setdefault(tx_hash, set()).add(ser)
+
+    def add_spent_outpoint(self, ser, tx_hash):
+        prevout_hash = ser.split(':')[0]
+        self.spent_outpoints.setdefault(prevout_hash, {})[ser] = tx_hash
+
+    def remove_spent_outpoint(self, ser):
+        prevout_hash = ser.split(':')[0]
+        d = self.spent_outpoints.get(prevout_hash, {})
+        d.pop(ser, None)
+        if not d:
+            self.spent_outpoints.pop(prevout_hash, None)
+
+    def add_pruned_txo(self, ser, tx_hash):
+        self.pruned_txo[ser] = tx_hash
+        self.pruned_spends.setdefault(tx_hash, set()).add(ser)
+
+    def pop_pruned_txo(self, ser):
+        tx_hash = self.pruned_txo.pop(ser, None)
+        s = self.pruned_spends.get(tx_hash)
+        if s is not None:
+            s.discard(ser)
+            if not s:
+                self.pruned_spends.pop(tx_hash)
+        return tx_hash
+
     @profiler
     def check_history(self):
         save = False
         for addr, hist in self.history.items():
             if not self.is_mine(addr):
                 self.history.pop(addr)
+                self.invalidate_status(addr)
                 save = True
                 continue
 
             for tx_hash, tx_height in hist:
-                if tx_hash in self.pruned_txo.values() or self.txi.get(tx_hash) or self.txo.get(tx_hash):
+                if tx_hash in self.pruned_spends or self.txi.get(tx_hash) or self.txo.get(tx_hash):
                     continue
                 tx = self.transactions.get(tx_hash)
                 if tx is not None:
@@ -217,6 +375,17 @@ class Abstract_Wallet(PrintError):
         self.change_pubkeys = d.get('change', [])
         self.receiving_addresses = map(self.pubkeys_to_address, self.receiving_pubkeys)
         self.change_addresses = map(self.pubkeys_to_address, self.change_pubkeys)
+        self.build_address_index()
+
+    def build_address_index(self):
+        # address -> (is_change, n)
+        self.address_index = {}
+        self.index_addresses(False, self.receiving_addresses)
+        self.index_addresses(True, self.change_addresses)
+
+    def index_addresses(self, for_change, addresses, start=0):
+        for n, address in enumerate(addresses, start):
+            self.address_index[address] = for_change, n
 
     def synchronize(self):
         pass
@@ -249,7 +418,7 @@ class Abstract_Wallet(PrintError):
         return changed
 
     def is_mine(self, address):
-        return address in self.get_addresses()
+        return address in self.address_index
 
     def is_change(self, address):
         if not self.is_mine(address):
@@ -260,10 +429,8 @@ class Abstract_Wallet(PrintError):
         return s[0] == 1
 
     def get_address_index(self, address):
-        if address in self.receiving_addresses:
-            return False, self.receiving_addresses.index(address)
-        if address in self.change_addresses:
-            return True, self.change_addresses.index(address)
+        if address in self.address_index:
+            return self.address_index[address]
         raise Exception("Address not found", address)
 
     def get_private_key(self, address, password):
@@ -296,13 +463,15 @@ class Abstract_Wallet(PrintError):
         # tx will be verified only if height > 0
         if tx_hash not in self.verified_tx:
             self.unverified_tx[tx_hash] = tx_height
+            self.update_tx_position(tx_hash)
 
     def add_verified_tx(self, tx_hash, info):
         # Remove from the unverified map and add to the verified map and
         self.unverified_tx.pop(tx_hash, None)
         with self.lock:
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
-        self.storage.put('verified_tx3', self.verified_tx)
+        self.update_tx_position(tx_hash)
+        self.save_transactions()
         height, conf, timestamp = self.get_tx_height(tx_hash)
         self.network.trigger_callback('verified', tx_hash, height, conf, timestamp)
 
@@ -314,11 +483,13 @@ class Abstract_Wallet(PrintError):
         '''Used by the verifier when a reorg has happened'''
         txs = []
         with self.lock:
-            for tx_hash, item in self.verified_tx:
+            for tx_hash, item in self.verified_tx.items():
                 tx_height, timestamp, pos = item
                 if tx_height >= height:
                     self.verified_tx.pop(tx_hash, None)
                     txs.append(tx_hash)
+        for tx_hash in txs:
+            self.update_tx_position(tx_hash)
         return txs
 
     def get_local_height(self):
@@ -359,7 +530,7 @@ class Abstract_Wallet(PrintError):
     def get_tx_delta(self, tx_hash, address):
         "effect of tx on address"
         # pruned
-        if tx_hash in self.pruned_txo.values():
+        if tx_hash in self.pruned_spends:
             return None
         delta = 0
         # substract the value of coins sent from address
@@ -374,7 +545,6 @@ class Abstract_Wallet(PrintError):
 
     def get_wallet_delta(self, tx):
         """ effect of tx on wallet """
-        addresses = self.get_addresses()
         is_relevant = False
         is_mine = False
         is_pruned = False
@@ -382,7 +552,7 @@ class Abstract_Wallet(PrintError):
         v_in = v_out = v_out_mine = 0
         for item in tx.inputs():
             addr = item.get('address')
-            if addr in addresses:
+            if self.is_mine(addr):
                 is_mine = True
                 is_relevant = True
                 d = self.txo.get(item['prevout_hash'], {}).get(addr, [])
@@ -402,7 +572,7 @@ class Abstract_Wallet(PrintError):
             is_partial = False
         for addr, value in tx.get_outputs():
             v_out += value
-            if addr in addresses:
+            if self.is_mine(addr):
                 v_out_mine += value
                 is_relevant = True
         if is_pruned:
@@ -434,7 +604,7 @@ class Abstract_Wallet(PrintError):
         height = conf = timestamp = None
         if tx.is_complete():
             tx_hash = tx.hash()
-            if tx_hash in self.transactions.keys():
+            if tx_hash in self.transactions:
                 label = self.get_label(tx_hash)
                 height, conf, timestamp = self.get_tx_height(tx_hash)
                 if height > 0:
@@ -487,10 +657,28 @@ class Abstract_Wallet(PrintError):
                 sent[txi] = height
         return received, sent
 
+    def invalidate_addr_cache(self, addresses):
+        with self.transaction_lock:
+            self.cache_version += 1
+            for addr in addresses:
+                self.utxo_cache.pop(addr, None)
+                self.balance_cache.pop(addr, None)
+
+    def cache_value(self, cache, key, value, version):
+        '''Stores value in cache, unless the wallet changed since
+        cache_version was read.'''
+        with self.transaction_lock:
+            if self.cache_version == version:
+                cache[key] = value
+
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
+        coins = self.utxo_cache.get(address)
+        if coins is None:
+            version = self.cache_version
+            coins, spent = self.get_addr_io(address)
+            for txi in spent:
+                coins.pop(txi)
+            self.cache_value(self.utxo_cache, address, coins, version)
         out = []
         for txo, v in coins.items():
             tx_height, value, is_cb = v
@@ -513,10 +701,18 @@ class Abstract_Wallet(PrintError):
 
     # return the balance of a bitcoin address: confirmed and matured, unconfirmed, unmatured
     def get_addr_balance(self, address):
+        local_height = self.get_local_height()
+        b = self.balance_cache.get(address)
+        # balances with coinbase outputs depend on the local height
+        if b is not None and b[0] in [None, local_height]:
+            return b[1:]
+        version = self.cache_version
         received, sent = self.get_addr_io(address)
         c = u = x = 0
+        has_cb = False
         for txo, (tx_height, v, is_cb) in received.items():
-            if is_cb and tx_height + COINBASE_MATURITY > self.get_local_height():
+            has_cb |= is_cb
+            if is_cb and tx_height + COINBASE_MATURITY > local_height:
                 x += v
             elif tx_height > 0:
                 c += v
@@ -527,6 +723,7 @@ class Abstract_Wallet(PrintError):
                     c -= v
                 else:
                     u -= v
+        self.cache_value(self.balance_cache, address, (local_height if has_cb else None, c, u, x), version)
         return c, u, x
 
     def get_spendable_coins(self, domain = None, exclude_frozen = True):
@@ -538,7 +735,7 @@ class Abstract_Wallet(PrintError):
         for addr in domain:
             utxos = self.get_addr_utxo(addr)
             for x in utxos:
-                if x['coinbase'] and x['tx_height'] + COINBASE_MATURITY > self.get_local_height():
+                if x['coinbase'] and x['height'] + COINBASE_MATURITY > self.get_local_height():
                     continue
                 coins.append(x)
                 continue
@@ -583,6 +780,34 @@ class Abstract_Wallet(PrintError):
         with self.lock:
             return self.history.get(address, [])
 
+    def get_address_status(self, address):
+        '''Status of the history of address, as announced by the
+        server.  Cached until the history changes.'''
+        with self.lock:
+            if address not in self.status_cache:
+                if address in self.server_status:
+                    status = self.server_status[address]
+                else:
+                    status = history_status(self.history.get(address, []))
+                self.status_cache[address] = status
+            return self.status_cache[address]
+
+    def set_server_status(self, address, status):
+        '''Records that the server announced status for the stored
+        history of address.  This is saved with the history, so that
+        on the next start the status of unchanged addresses is neither
+        fetched nor hashed again.'''
+        with self.lock:
+            if status is None:
+                self.server_status.pop(address, None)
+            elif self.server_status.get(address) != status:
+                self.server_status[address] = status
+            self.status_cache[address] = status
+
+    def invalidate_status(self, address):
+        self.status_cache.pop(address, None)
+        self.server_status.pop(address, None)
+
     def find_pay_to_pubkey_address(self, prevout_hash, prevout_n):
         dd = self.txo.get(prevout_hash, {})
         for addr, l in dd.items():
@@ -595,6 +820,9 @@ class Abstract_Wallet(PrintError):
         is_coinbase = tx.inputs()[0].get('is_coinbase') == True
         with self.transaction_lock:
             # add inputs
+            for addr, l in self.txi.get(tx_hash, {}).items():
+                for ser, v in l:
+                    self.remove_spent_outpoint(ser)
             self.txi[tx_hash] = d = {}
             for txi in tx.inputs():
                 addr = txi.get('address')
@@ -612,9 +840,11 @@ class Abstract_Wallet(PrintError):
                             if d.get(addr) is None:
                                 d[addr] = []
                             d[addr].append((ser, v))
+                            self.add_spent_outpoint(ser, tx_hash)
                             break
                     else:
-                        self.pruned_txo[ser] = tx_hash
+                        self.add_pruned_txo(ser, tx_hash)
+            self.invalidate_addr_cache(d.keys())
 
             # add outputs
             self.txo[tx_hash] = d = {}
@@ -632,13 +862,18 @@ class Abstract_Wallet(PrintError):
                         d[addr] = []
                     d[addr].append((n, v, is_coinbase))
                 # give v to txi that spends me
-                next_tx = self.pruned_txo.get(ser)
+                next_tx = self.pop_pruned_txo(ser)
                 if next_tx is not None:
-                    self.pruned_txo.pop(ser)
+                    self.txi.touch(next_tx)
                     dd = self.txi.get(next_tx, {})
                     if dd.get(addr) is None:
                         dd[addr] = []
                     dd[addr].append((ser, v))
+                    self.add_spent_outpoint(ser, next_tx)
+                    self.invalidate_addr_cache([addr])
+                    self.invalidate_tx_deltas([next_tx])
+            self.invalidate_addr_cache(d.keys())
+            self.invalidate_tx_deltas([tx_hash])
             # save
             self.transactions[tx_hash] = tx
 
@@ -646,23 +881,27 @@ class Abstract_Wallet(PrintError):
         with self.transaction_lock:
             self.print_error("removing tx from history", tx_hash)
             #tx = self.transactions.pop(tx_hash)
-            for ser, hh in self.pruned_txo.items():
-                if hh == tx_hash:
-                    self.pruned_txo.pop(ser)
+            for ser in list(self.pruned_spends.get(tx_hash, [])):
+                self.pop_pruned_txo(ser)
             # add tx to pruned_txo, and undo the txi addition
-            for next_tx, dd in self.txi.items():
+            for ser, next_tx in self.spent_outpoints.pop(tx_hash, {}).items():
+                self.txi.touch(next_tx)
+                dd = self.txi.get(next_tx, {})
                 for addr, l in dd.items():
-                    ll = l[:]
-                    for item in ll:
-                        ser, v = item
-                        prev_hash, prev_n = ser.split(':')
-                        if prev_hash == tx_hash:
+                    for item in l[:]:
+                        if item[0] == ser:
                             l.remove(item)
-                            self.pruned_txo[ser] = next_tx
+                            self.add_pruned_txo(ser, next_tx)
+                            self.invalidate_addr_cache([addr])
+                            self.invalidate_tx_deltas([next_tx])
                     if l == []:
                         dd.pop(addr)
-                    else:
-                        dd[addr] = l
+            for addr, l in self.txi.get(tx_hash, {}).items():
+                for ser, v in l:
+                    self.remove_spent_outpoint(ser)
+            self.invalidate_addr_cache(self.txi.get(tx_hash, {}).keys())
+            self.invalidate_addr_cache(self.txo.get(tx_hash, {}).keys())
+            self.invalidate_tx_deltas([tx_hash])
             try:
                 self.txi.pop(tx_hash)
                 self.txo.pop(tx_hash)
@@ -684,6 +923,8 @@ class Abstract_Wallet(PrintError):
                     if not self.tx_addr_hist[tx_hash]:
                         self.remove_transaction(tx_hash)
             self.history[addr] = hist
+            self.invalidate_status(addr)
+            self.invalidate_addr_cache([addr])
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
@@ -693,19 +934,78 @@ class Abstract_Wallet(PrintError):
             s.add(addr)
             self.tx_addr_hist[tx_hash] = s
             # if addr is new, we have to recompute txi and txo
-            tx = self.transactions.get(tx_hash)
-            if tx is not None and self.txi.get(tx_hash, {}).get(addr) is None and self.txo.get(tx_hash, {}).get(addr) is None:
-                self.add_transaction(tx_hash, tx)
+            if self.txi.get(tx_hash, {}).get(addr) is None and self.txo.get(tx_hash, {}).get(addr) is None:
+                tx = self.transactions.get(tx_hash)
+                if tx is not None:
+                    self.add_transaction(tx_hash, tx)
+
+        # the set of addresses involved in these transactions has changed
+        affected = set(map(lambda x: x[0], old_hist + hist))
+        self.invalidate_tx_deltas(affected)
+        for tx_hash in affected:
+            self.update_tx_position(tx_hash)
 
         # Write updated TXI, TXO etc.
         self.save_transactions()
         # Store fees
         self.tx_fees.update(tx_fees)
 
+    def invalidate_tx_deltas(self, tx_hashes):
+        with self.transaction_lock:
+            self.cache_version += 1
+            for tx_hash in tx_hashes:
+                self.tx_deltas.pop(tx_hash, None)
+        self.history_version += 1
+
+    def update_tx_position(self, tx_hash):
+        '''Move tx_hash to its current position in sorted_history, or
+        drop it if no address history references it anymore.'''
+        if self.sorted_history is None:
+            return
+        key = (self.get_txpos(tx_hash), tx_hash) if self.tx_addr_hist.get(tx_hash) else None
+        with self.lock:
+            self.history_version += 1
+            old_key = self.tx_positions.get(tx_hash)
+            if old_key == key:
+                return
+            if old_key is not None:
+                i = bisect.bisect_left(self.sorted_history, old_key)
+                self.sorted_history.pop(i)
+                self.tx_positions.pop(tx_hash)
+            if key is not None:
+                bisect.insort(self.sorted_history, key)
+                self.tx_positions[tx_hash] = key
+
+    @profiler
+    def build_sorted_history(self):
+        keys = [(self.get_txpos(tx_hash), tx_hash)
+                for tx_hash, addrs in self.tx_addr_hist.items() if addrs]
+        keys.sort()
+        with self.lock:
+            self.tx_positions = dict((key[1], key) for key in keys)
+            self.sorted_history = keys
+            self.history_version += 1
+
+    def get_history_delta(self, tx_hash):
+        "effect of tx on the wallet, None if pruned"
+        try:
+            return self.tx_deltas[tx_hash]
+        except KeyError:
+            pass
+        version = self.cache_version
+        delta = 0
+        for addr in list(self.tx_addr_hist.get(tx_hash, [])):
+            d = self.get_tx_delta(tx_hash, addr)
+            if d is None or delta is None:
+                delta = None
+            else:
+                delta += d
+        self.cache_value(self.tx_deltas, tx_hash, delta, version)
+        return delta
+
     def get_history(self, domain=None):
-        # get domain
         if domain is None:
-            domain = self.get_addresses()
+            return self.get_wallet_history()
         # 1. Get the history of each address in the domain, maintain the
         #    delta of a tx as the sum of its deltas on domain addresses
         tx_deltas = defaultdict(int)
@@ -746,6 +1046,37 @@ class Abstract_Wallet(PrintError):
 
         return h2
 
+    def get_wallet_history(self):
+        if self.sorted_history is None:
+            self.build_sorted_history()
+        local_height = self.get_local_height()
+        with self.lock:
+            version = self.history_version
+            cache = self.history_cache
+            sorted_history = self.sorted_history[:]
+        if cache and cache[0] == version and cache[1] == local_height:
+            return cache[2][:]
+        c, u, x = self.get_balance()
+        balance = c + u + x
+        h2 = []
+        for txpos, tx_hash in reversed(sorted_history):
+            delta = self.get_history_delta(tx_hash)
+            height, conf, timestamp = self.get_tx_height(tx_hash)
+            h2.append((tx_hash, height, conf, timestamp, delta, balance))
+            if balance is None or delta is None:
+                balance = None
+            else:
+                balance -= delta
+        h2.reverse()
+
+        # fixme: this may happen if history is incomplete
+        if balance not in [None, 0]:
+            self.print_error("Error: history not synchronized")
+            return []
+
+        self.history_cache = version, local_height, h2
+        return h2[:]
+
     def get_label(self, tx_hash):
         label = self.labels.get(tx_hash, '')
         if label is '':
@@ -897,7 +1228,7 @@ class Abstract_Wallet(PrintError):
         for tx_hash in self.transactions.keys():
             if tx_hash not in vr:
                 self.print_error("removing transaction", tx_hash)
-                self.transactions.pop(tx_hash)
+                self.pop_transaction(tx_hash)
 
     def start_threads(self, network):
         self.network = network
@@ -919,7 +1250,7 @@ class Abstract_Wallet(PrintError):
             # Now no references to the syncronizer or verifier
             # remain so they will be GC-ed
             self.storage.put('stored_height', self.get_local_height())
-        self.storage.write()
+        self.write_storage()
 
     def wait_until_synchronized(self, callback=None):
         def wait_for_wallet():
@@ -1183,6 +1514,8 @@ class Imported_Wallet(Abstract_Wallet):
 
     def load_addresses(self):
         self.addresses = self.storage.get('addresses', [])
+        self.address_index = {}
+        self.index_addresses(False, self.addresses)
 
     def has_password(self):
         return False
@@ -1218,8 +1551,9 @@ class Imported_Wallet(Abstract_Wallet):
         return self.addresses
 
     def add_address(self, address):
-        if address in self.addresses:
+        if address in self.address_index:
             return
+        self.index_addresses(False, [address], len(self.addresses))
         self.addresses.append(address)
         self.storage.put('addresses', self.addresses)
         self.storage.write()
@@ -1227,6 +1561,8 @@ class Imported_Wallet(Abstract_Wallet):
         # force resynchronization, because we need to re-run add_transaction
         if address in self.history:
             self.history.pop(address)
+            self.invalidate_status(address)
+        self.invalidate_addr_cache([address])
         if self.synchronizer:
             self.synchronizer.add(address)
         return address
@@ -1302,6 +1638,7 @@ class Deterministic_Wallet(Abstract_Wallet):
             n = len(addresses) - k + value
             self.receiving_pubkeys = self.receiving_pubkeys[0:n]
             self.receiving_addresses = self.receiving_addresses[0:n]
+            self.build_address_index()
             self.gap_limit = value
             self.storage.put('gap_limit', self.gap_limit)
             self.save_pubkeys()
@@ -1331,34 +1668,44 @@ class Deterministic_Wallet(Abstract_Wallet):
         return nmax + 1
 
     def add_address(self, address):
-        if address not in self.history:
-            self.history[address] = []
+        self.add_addresses([address])
+
+    def add_addresses(self, addresses):
+        for address in addresses:
+            if address not in self.history:
+                self.history[address] = []
         if self.synchronizer:
-            self.synchronizer.add(address)
+            self.synchronizer.add_addresses(addresses)
 
     def create_new_address(self, for_change):
+        return self.create_new_addresses(for_change, 1)[0]
+
+    def create_new_addresses(self, for_change, count):
         pubkey_list = self.change_pubkeys if for_change else self.receiving_pubkeys
         n = len(pubkey_list)
-        x = self.new_pubkeys(for_change, n)
-        pubkey_list.append(x)
+        pubkeys = self.new_pubkeys_many(for_change, n, count)
+        pubkey_list.extend(pubkeys)
         self.save_pubkeys()
-        address = self.pubkeys_to_address(x)
+        addresses = map(self.pubkeys_to_address, pubkeys)
         addr_list = self.change_addresses if for_change else self.receiving_addresses
-        addr_list.append(address)
-        self.add_address(address)
-        return address
+        self.index_addresses(for_change, addresses, len(addr_list))
+        addr_list.extend(addresses)
+        self.add_addresses(addresses)
+        return addresses
 
     def synchronize_sequence(self, for_change):
         limit = self.gap_limit_for_change if for_change else self.gap_limit
         while True:
             addresses = self.get_change_addresses() if for_change else self.get_receiving_addresses()
-            if len(addresses) < limit:
-                self.create_new_address(for_change)
-                continue
-            if map(lambda a: self.address_is_old(a), addresses[-limit:] ) == limit*[False]:
+            # the last limit addresses must be unused
+            num_unused = 0
+            for address in reversed(addresses):
+                if num_unused == limit or self.address_is_old(address):
+                    break
+                num_unused += 1
+            if num_unused == limit:
                 break
-            else:
-                self.create_new_address(for_change)
+            self.create_new_addresses(for_change, limit - num_unused)
 
     def synchronize(self):
         with self.lock:
@@ -1370,18 +1717,17 @@ class Deterministic_Wallet(Abstract_Wallet):
                     self.receiving_pubkeys = self.keystore.keypairs.keys()
                     self.save_pubkeys()
                     self.receiving_addresses = map(self.pubkeys_to_address, self.receiving_pubkeys)
+                    self.build_address_index()
                     for addr in self.receiving_addresses:
                         self.add_address(addr)
 
     def is_beyond_limit(self, address, is_change):
         addr_list = self.get_change_addresses() if is_change else self.get_receiving_addresses()
-        i = addr_list.index(address)
-        prev_addresses = addr_list[:max(0, i)]
+        i = self.get_address_index(address)[1]
         limit = self.gap_limit_for_change if is_change else self.gap_limit
-        if len(prev_addresses) < limit:
+        if i < limit:
             return False
-        prev_addresses = prev_addresses[max(0, i - limit):]
-        for addr in prev_addresses:
+        for addr in addr_list[i - limit:i]:
             if self.history.get(addr):
                 return False
         return True
@@ -1408,6 +1754,9 @@ class Standard_Wallet(Deterministic_Wallet, P2PK_Wallet):
     def new_pubkeys(self, c, i):
         return self.keystore.derive_pubkey(c, i)
 
+    def new_pubkeys_many(self, c, i, count):
+        return self.keystore.derive_pubkeys(c, i, count)
+
     def get_keystore(self):
         return self.keystore
 
@@ -1439,6 +1788,7 @@ class Standard_Wallet(Deterministic_Wallet, P2PK_Wallet):
         self.receiving_pubkeys.append(pubkey)
         self.save_pubkeys()
         addr = self.pubkeys_to_address(pubkey)
+        self.index_addresses(False, [addr], len(self.receiving_addresses))
         self.receiving_addresses.append(addr)
         self.add_address(addr)
         return addr
@@ -1470,6 +1820,9 @@ class Multisig_Wallet(Deterministic_Wallet):
     def new_pubkeys(self, c, i):
         return [k.derive_pubkey(c, i) for k in self.keystores.values()]
 
+    def new_pubkeys_many(self, c, i, count):
+        return map(list, zip(*[k.derive_pubkeys(c, i, count) for k in self.keystores.values()]))
+
     def load_keystore(self):
         self.keystores = {}
         for i in range(self.n):